@@ -6,17 +6,28 @@ from files.models import Attachment
 from files.forms import AttachmentForm
 
 from django.conf import settings
+from django.db.models import Q
 from django.core import urlresolvers
+from django.core.files.storage import get_storage_class
 from django.core.exceptions import ImproperlyConfigured
+from django.utils.encoding import smart_unicode
 from django.utils.importlib import import_module
 
 DEFAULT_FILE_STORAGE_BACKEND = "django.core.files.storage.FileSystemStorage"
+# Relations which are fetched along with the attachments by the listings,
+# as they show the creator, content type and site of each attachment.
+DEFAULT_SELECT_RELATED = ("creator", "content_type", "site")
+
 CONTRIB_BACKENDS = [
     DEFAULT_FILE_STORAGE_BACKEND,
+    "files.storage.FileSystemStorage",
     "files.storage.SQLiteStorage",
     "files.storage.PostgreSQLStorage",
+    "files.storage.PostgreSQLInlineStorage",
     "files.storage.MySQLStorage",
     "files.storage.OracleStorage",
+    "files.storage.RoutingStorage",
+    "files.storage.HybridStorage",
 ]
 
 
@@ -70,6 +81,58 @@ def get_form():
         return AttachmentForm
 
 
+def get_object_attachments(model, ctype, object_pk, user):
+    """
+    Returns the attachments of the object which are visible to the user,
+    as listed by the template tags and the listing views. object_pk may
+    also be a list of the pks of several objects.
+    """
+    if isinstance(object_pk, (list, tuple)):
+        qs = model.objects.filter(content_type=ctype,
+                                  object_id__in=[smart_unicode(pk) for pk in object_pk],
+                                  site__pk=settings.SITE_ID)
+    else:
+        qs = model.objects.filter(content_type=ctype,
+                                  object_id=smart_unicode(object_pk),
+                                  site__pk=settings.SITE_ID)
+    
+    # The 'is_public' field and the 'backend' fields are implementation
+    # details of the 'django-files' app. If present on the attachment
+    # model, filter on them.
+    field_names = [f.name for f in model._meta.fields]
+    if "is_public" in field_names:
+        # Filter public attachments only, but include users private.
+        q = Q(is_public=True)
+        if user is not None and user.is_authenticated():
+            q = q | Q(creator=user)
+        qs = qs.filter(q)
+    if "backend" in field_names:
+        engine = get_storage_class()
+        if not getattr(engine, "is_routing", False):
+            # Attachments stored in other backends can't be read
+            # unless the storage routes reads by backend.
+            qs = qs.filter(backend=str(engine.__name__))
+    # The binary data is never shown, so don't load it with the rows.
+    deferred = [name for name in ("blob", "data") if name in field_names]
+    if deferred:
+        qs = qs.defer(*deferred)
+    return qs
+
+
+def select_listing_related(qs, related=None):
+    """
+    Fetch the relations shown by the listings (settings.ATTACHMENT_SELECT_RELATED,
+    or related if given) along with the attachments of the queryset.
+    """
+    if related is None:
+        related = getattr(settings, "ATTACHMENT_SELECT_RELATED", DEFAULT_SELECT_RELATED)
+    field_names = [f.name for f in qs.model._meta.fields]
+    related = [name for name in related if name in field_names]
+    if related:
+        qs = qs.select_related(*related)
+    return qs
+
+
 def get_create_target():
     """
     Returns the target URL for the attachment form submission view
@@ -118,3 +181,13 @@ def get_download_url(attachment):
         return get_storage_backend().get_download_url(attachment)
     else:
         return urlresolvers.reverse("download-attachment", kwargs={"slug": attachment.slug})
+
+
+def get_derivative_url(attachment, spec):
+    """
+    Get the URL of a derivative (i.e. a thumbnail) of this attachment
+    """
+    if get_storage_backend_name() not in CONTRIB_BACKENDS and hasattr(get_storage_backend(), "get_derivative_url"):
+        return get_storage_backend().get_derivative_url(attachment, spec)
+    else:
+        return urlresolvers.reverse("derivative-attachment", kwargs={"slug": attachment.slug, "spec": spec})
@@ -3,11 +3,20 @@
 from django import forms
 from django.conf import settings
 from django.contrib import admin
+from django.contrib.admin import helpers
+from django.template.response import TemplateResponse
+from django.core.urlresolvers import reverse
 from django.contrib.contenttypes import generic
 from django.core.exceptions import ObjectDoesNotExist
+from django.utils.html import format_html
 from django.utils.translation import ugettext_lazy as _, ungettext
 
-from files.models import Attachment
+from files import bulk, pipeline, quotas
+from files.models import Attachment, AttachmentJob
+
+# Selections of more attachments than this are changed
+# or deleted by a background job.
+BACKGROUND_THRESHOLD = 10000
 
 
 class AttachmentAdminForm(forms.ModelForm):
@@ -37,9 +46,18 @@ class AttachmentAdminForm(forms.ModelForm):
             try:
                 ctype.get_object_for_this_type(pk=object_id)
             except ObjectDoesNotExist, e:
-                err_msg = " ".join((e.args[0], u"No matching %s object with pk: %d." % (ctype.name, object_id)))
+                err_msg = " ".join((e.args[0], u"No matching %s object with pk: %s." % (ctype.name, object_id)))
                 self._errors["object_id"] = self.error_class([err_msg])
                 del cleaned_data["object_id"]
+        
+        creator = cleaned_data.get("creator", None)
+        attachment = cleaned_data.get("attachment", None)
+        if quotas.is_enabled() and ctype and "object_id" in cleaned_data and creator and attachment:
+            try:
+                quotas.check(self.instance, creator.pk, ctype.pk, object_id, attachment.size)
+            except quotas.QuotaExceeded, e:
+                self._errors["attachment"] = self.error_class(e.messages)
+                del cleaned_data["attachment"]
         return cleaned_data
 
 
@@ -50,20 +68,21 @@ class AttachmentAdmin(admin.ModelAdmin):
     """
     form = AttachmentAdminForm
     readonly_fields = ("mimetype", "slug", "size", "checksum", "ip_address",
-                       "backend", "created", "modified")
+                       "backend", "encoding", "status", "created", "modified")
     fieldsets = [
         (None, {"fields": ("creator", "description", "attachment", "site", "is_public",
-                           "slug", "backend", "ip_address")}),
+                           "slug", "backend", "encoding", "ip_address")}),
         ("Object relations", {"fields": ("content_type", "object_id")}),
-        ("Metadata", {"fields": ("mimetype", "size", "checksum", "created", "modified")})
+        ("Metadata", {"fields": ("mimetype", "size", "checksum", "status", "created", "modified")})
     ]
     list_display = ("attachment", "mimetype", "creator", "content_type", "object_id",
-                    "backend", "created", "ip_address", "site", "is_public")
-    list_filter = ("created", "mimetype", "is_public", "site__domain", "content_type")
+                    "backend", "status", "created", "ip_address", "site", "is_public")
+    list_filter = ("created", "mimetype", "is_public", "status", "site__domain", "content_type")
     search_fields = ("attachment", "slug", "creator__username")
+    list_select_related = True
     date_hierarchy = "created"
     ordering = ("-created", "content_type")
-    actions = ["set_is_public", "set_is_private"]
+    actions = ["set_is_public", "set_is_private", "bulk_delete_selected"]
     
     class Media:
         css = {
@@ -82,10 +101,14 @@ class AttachmentAdmin(admin.ModelAdmin):
     #
     def get_actions(self, request):
         actions = super(AttachmentAdmin, self).get_actions(request)
+        # The stock delete action loads and deletes the attachments one
+        # at a time, bulk_delete_selected replaces it.
+        if "delete_selected" in actions:
+            actions.pop("delete_selected")
         # Only superusers should be able to delete attachments from
         # the admin interface.
-        if not request.user.is_superuser and "delete_selected" in actions:
-            actions.pop("delete_selected")
+        if not request.user.is_superuser and "bulk_delete_selected" in actions:
+            actions.pop("bulk_delete_selected")
         if not request.user.has_perm("files.can_moderate"):
             if "set_is_public" in actions:
                 actions.pop("set_is_public")
@@ -95,30 +118,109 @@ class AttachmentAdmin(admin.ModelAdmin):
     
     def set_is_public(self, request, queryset):
         """
-        Executes an SQL UPDATE on the queryset and
-        sets all objects is_public = True
+        Sets is_public = True on the selected attachments with
+        an SQL UPDATE per batch of attachments.
         """
-        queryset.update(is_public=True)
-        self._display_message(request, queryset,
-                  lambda n: ungettext("marked public", "marked public", n))
+        self._update(request, queryset, {"is_public": True},
+                     lambda n: ungettext("marked public", "marked public", n))
     set_is_public.short_description = _("Mark selected attachments as public")
     
     def set_is_private(self, request, queryset):
         """
-        Executes an SQL UPDATE on the queryset and
-        sets all objects is_public = False
+        Sets is_public = False on the selected attachments with
+        an SQL UPDATE per batch of attachments.
         """
-        queryset.update(is_public=False)
-        self._display_message(request, queryset,
-                  lambda n: ungettext("marked private", "marked private", n))
+        self._update(request, queryset, {"is_public": False},
+                     lambda n: ungettext("marked private", "marked private", n))
     set_is_private.short_description = _("Mark selected attachments as private")
     
-    def _display_message(self, request, queryset, message):
-        n = queryset.count()
+    def bulk_delete_selected(self, request, queryset):
+        """
+        Deletes the selected attachments in batches with
+        AttachmentManager.bulk_delete, after confirmation. Unlike the
+        stock delete_selected action, which it replaces, the confirmation
+        page does not list every attachment, so very large selections
+        can be deleted.
+        """
+        background = self._in_background(queryset)
+        if request.POST.get("post"):
+            if background:
+                job = pipeline.enqueue_bulk(queryset, pipeline.TASK_BULK_DELETE)
+                self._display_job_message(request, job,
+                                          lambda n: ungettext("deleted", "deleted", n))
+                return None
+            n = Attachment.objects.bulk_delete(queryset)
+            msg = ungettext(u"1 attachment was successfully deleted.",
+                            u"%(count)s attachments were successfully deleted.", n)
+            self.message_user(request, msg % {"count": n})
+            return None
+        opts = self.model._meta
+        context = {
+            "title": _("Are you sure?"),
+            "count": queryset.count(),
+            "background": background,
+            "selected": request.POST.getlist(helpers.ACTION_CHECKBOX_NAME),
+            "select_across": request.POST.get("select_across") == "1",
+            "action": "bulk_delete_selected",
+            "action_checkbox_name": helpers.ACTION_CHECKBOX_NAME,
+            "opts": opts,
+            "app_label": opts.app_label,
+        }
+        return TemplateResponse(request, "admin/files/attachment/bulk_delete_confirmation.html",
+                                context, current_app=self.admin_site.name)
+    bulk_delete_selected.short_description = _("Delete selected attachments")
+    
+    def _in_background(self, queryset):
+        """
+        Return True if the selection is larger than
+        settings.ATTACHMENT_ADMIN_BACKGROUND_THRESHOLD.
+        """
+        threshold = getattr(settings, "ATTACHMENT_ADMIN_BACKGROUND_THRESHOLD", BACKGROUND_THRESHOLD)
+        if not threshold:
+            return False
+        return bool(queryset.order_by().values_list("pk", flat=True)[threshold:threshold + 1])
+    
+    def _update(self, request, queryset, values, message):
+        if self._in_background(queryset):
+            job = pipeline.enqueue_bulk(queryset, pipeline.TASK_BULK_UPDATE, values)
+            self._display_job_message(request, job, message)
+            return
+        n = bulk.update(queryset, values)
+        self._display_message(request, n, message)
+    
+    def _display_message(self, request, n, message):
         msg = ungettext(u"1 attachment was successfully %(action)s.",
                         u"%(count)s attachments were successfully %(action)s.", n)
         self.message_user(request, msg % {"count": n, "action": message(n)})
     
+    def _display_job_message(self, request, job, message):
+        url = reverse("admin:files_attachmentjob_change", args=(job.pk, ), current_app=self.admin_site.name)
+        msg = ungettext(u"1 attachment will be %(action)s by {0}.",
+                        u"%(count)s attachments will be %(action)s by {0}.", job.total)
+        self.message_user(request, format_html(msg % {"count": job.total, "action": message(job.total)},
+                                               format_html(u'<a href="{0}">{1}</a>', url, _("a background job"))))
+    
+
+class AttachmentJobAdmin(admin.ModelAdmin):
+    """
+    Lists the jobs of the local job queue, with the
+    progress of the bulk jobs started in the admin.
+    """
+    list_display = ("task", "status", "progress_display", "attempts", "created", "modified")
+    list_filter = ("status", "task")
+    readonly_fields = ("task", "status", "attachment", "spool", "attempts", "progress",
+                       "total", "error", "created", "modified")
+    ordering = ("-created", )
+    
+    def has_add_permission(self, request):
+        return False
+    
+    def progress_display(self, obj):
+        if not obj.total:
+            return u""
+        return u"%d / %d (%d%%)" % (obj.progress, obj.total, obj.progress * 100 / obj.total)
+    progress_display.short_description = _("progress")
+    
 
 class AttachmentInlines(generic.GenericStackedInline):
     """
@@ -153,3 +255,4 @@ class AttachmentInlines(generic.GenericStackedInline):
     
 
 admin.site.register(Attachment, AttachmentAdmin)
+admin.site.register(AttachmentJob, AttachmentJobAdmin)
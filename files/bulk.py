@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+#
+# Bulk changes and deletion of attachments.
+#
+# update() changes the attachments of a queryset in batches of primary keys,
+# so selections of any size are updated with short UPDATE statements, and
+# returns the number of changed rows from the UPDATE row counts instead of
+# counting the queryset. The counters of the objects of each batch are
+# recounted afterwards.
+#
+# Deleting attachments one at a time (QuerySet.delete() or the admin's
+# delete action) loads every attachment, and unlinks its binary data in the
+# delete signals, one query and savepoint per attachment. delete() handles a
+# batch of attachments at once instead:
+#
+# * the large objects of the batch are unlinked with a single query,
+# * the rows of the batch, and of their derivatives and jobs, are deleted
+#   with a few DELETE ... WHERE id IN (...) queries in one transaction (or in
+#   the transaction of the caller, if it manages one; i.e. a view run with the
+#   TransactionMiddleware, which commits or rolls back all batches at once),
+# * the counters and the usage ledger are adjusted once per object,
+# * files are released (see `files.models.release_file`) by a pool of threads
+#   after the transaction is committed. Within the transaction of the caller,
+#   they are released after each batch, before that transaction is committed.
+#
+# The pre_delete and post_delete signals are not sent for the attachments,
+# post_bulk_unlink is sent for each batch instead. Other models with a
+# foreign key to the attachments are not deleted along with them.
+#
+
+import os
+from multiprocessing.pool import ThreadPool
+from django.db import transaction
+from django.db.models.sql import DeleteQuery
+from django.utils.encoding import smart_unicode
+from django.core.files.storage import get_storage_class, FileSystemStorage
+
+from files import counters, quotas
+from files.models import Attachment, AttachmentDerivative, AttachmentJob, DATABASE_BACKENDS, release_file
+from files.signals import post_bulk_unlink
+
+UPDATE_FIELDS = ("pk", "content_type", "object_id")
+FIELDS = ("pk", "backend", "attachment", "content_type", "object_id", "site", "creator", "is_public", "size")
+
+
+def update(queryset, values, batch_size=1000, progress=None):
+    """
+    Update the attachments of the queryset with the field values in
+    batches of batch_size. progress, if given, is called with the number
+    of attachments updated so far after each batch. Returns the number of
+    updated attachments.
+    """
+    using = queryset.db
+    total, last_pk = 0, None
+    while True:
+        qs = queryset.order_by("pk")
+        if last_pk is not None:
+            qs = qs.filter(pk__gt=last_pk)
+        rows = list(qs.values_list(*UPDATE_FIELDS)[:batch_size])
+        if not rows:
+            break
+        last_pk = rows[-1][0]
+        total += Attachment.objects.using(using).filter(pk__in=[row[0] for row in rows]).update(**values)
+        if counters.is_enabled():
+            counters.recount(set(row[1:] for row in rows), using)
+        if progress is not None:
+            progress(total)
+    return total
+
+
+def delete(queryset, batch_size=1000, workers=4, progress=None):
+    """
+    Delete the attachments of the queryset in batches of batch_size,
+    releasing files with a pool of workers threads. progress, if given,
+    is called with the number of attachments deleted so far after each
+    batch. Returns the number of deleted attachments.
+    """
+    using = queryset.db
+    pool = ThreadPool(workers) if workers > 1 else None
+    total, last_pk = 0, None
+    try:
+        while True:
+            qs = queryset.order_by("pk")
+            if last_pk is not None:
+                qs = qs.filter(pk__gt=last_pk)
+            rows = list(qs.values_list(*FIELDS)[:batch_size])
+            if not rows:
+                break
+            last_pk = rows[-1][0]
+            delete_batch(rows, using, pool)
+            total += len(rows)
+            if progress is not None:
+                progress(total)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return total
+
+
+def delete_batch(rows, using, pool=None):
+    """
+    Delete one batch of attachments, given as rows of the FIELDS.
+    The batch is committed, unless it is part of a transaction managed
+    by the caller.
+    """
+    pks = [row[0] for row in rows]
+    derivative_files = list(AttachmentDerivative.objects.using(using).filter(attachment__in=pks)
+                            .exclude(file="").values_list("file", flat=True))
+    if transaction.is_managed(using=using):
+        # Join the transaction of the caller (i.e. of the TransactionMiddleware),
+        # which commit_on_success would commit before the caller is done.
+        delete_rows(rows, using)
+    else:
+        with transaction.commit_on_success(using=using):
+            delete_rows(rows, using)
+    post_bulk_unlink.send(sender=Attachment, pks=pks, names=[row[2] for row in rows], using=using)
+
+    # The files are released once the rows are gone for good.
+    storage = Attachment._meta.get_field("attachment").storage
+    if not hasattr(storage, "location"):
+        # The RoutingStorage serves files from several backends.
+        storage = FileSystemStorage()
+    paths = [os.path.join(storage.location, row[2]) for row in rows if row[1] == "FileSystemStorage"]
+    derivative_storage = AttachmentDerivative._meta.get_field("file").storage
+    if pool is None:
+        map(release_file, paths)
+        map(derivative_storage.delete, derivative_files)
+    else:
+        pool.map(release_file, paths)
+        pool.map(derivative_storage.delete, derivative_files)
+
+
+def delete_rows(rows, using):
+    """
+    Unlink the binary data of a batch of attachments, and delete their
+    rows, derivatives and jobs.
+    """
+    from files.storage import BACKEND_STORAGES
+
+    pks = [row[0] for row in rows]
+    backends = {}
+    for row in rows:
+        backends.setdefault(row[1], []).append(row[0])
+    for backend, backend_pks in backends.items():
+        if backend not in DATABASE_BACKENDS:
+            continue
+        storage = get_storage_class(BACKEND_STORAGES[backend])(using)
+        if hasattr(storage, "_unlink_binaries"):
+            storage._unlink_binaries(backend_pks)
+    DeleteQuery(AttachmentDerivative).delete_batch(pks, using, AttachmentDerivative._meta.get_field("attachment"))
+    DeleteQuery(AttachmentJob).delete_batch(pks, using, AttachmentJob._meta.get_field("attachment"))
+    DeleteQuery(Attachment).delete_batch(pks, using)
+    adjust_counters(rows, using)
+
+
+def adjust_counters(rows, using):
+    """
+    Subtract the attachments from the counters and the usage ledger.
+    """
+    if counters.is_enabled():
+        deltas = {}
+        for pk, backend, name, content_type_id, object_id, site_id, creator_id, is_public, size in rows:
+            key = (content_type_id, smart_unicode(object_id), site_id, backend)
+            counters.add_delta(deltas, (key, is_public, size or 0), -1)
+        counters.apply_deltas(deltas, using)
+    if quotas.is_enabled():
+        deltas = {}
+        for pk, backend, name, content_type_id, object_id, site_id, creator_id, is_public, size in rows:
+            quotas.add_delta(deltas, (creator_id, content_type_id, object_id, size or 0), -1)
+        for key, (count, size) in deltas.items():
+            quotas.apply_delta(key, count, size, using)
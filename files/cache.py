@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+#
+# In-process LRU cache for small attachment blobs.
+#
+
+import threading
+from collections import OrderedDict
+from django.conf import settings
+
+from files import metrics
+
+
+class BlobCache(object):
+    """
+    A thread safe LRU cache holding the binary data of small attachments,
+    keyed by (name, checksum). The cache is bounded both by the total
+    number of bytes it may hold, and by the maximum size of a single item.
+
+    Note that the cache lives in the memory of the current process, and is
+    invalidated by the `post_write` and `post_unlink` signals. Other processes
+    serving the same database will not see those signals, so the storage
+    backends read the row first, and only use an entry matching its current
+    checksum. A cache hit saves reading the binary data, not the row.
+    """
+    def __init__(self, max_bytes=0, max_item_size=0):
+        self.max_bytes = max_bytes
+        self.max_item_size = max_item_size
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._names = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0 and self.max_item_size > 0
+
+    def get(self, name, checksum=None):
+        """
+        Return the cached data for name, or None. If checksum is given,
+        only an entry matching both name and checksum is returned.
+        """
+        if not self.enabled:
+            return None
+        with self._lock:
+            key = self._names.get(name)
+            if key is None or (checksum is not None and key[1] != checksum):
+                key = None
+                self.misses += 1
+            else:
+                data = self._entries.pop(key)
+                self._entries[key] = data  # Mark as most recently used
+                self.hits += 1
+        metrics.incr("cache.miss" if key is None else "cache.hit")
+        if key is None:
+            return None
+        return key[1], data
+
+    def set(self, name, checksum, data):
+        """
+        Add data to the cache, evicting the least recently used
+        entries until the cache fits within max_bytes.
+        """
+        size = len(data)
+        if not self.enabled or size > self.max_item_size or size > self.max_bytes:
+            return
+        with self._lock:
+            self._discard(name)
+            key = (name, checksum)
+            self._entries[key] = data
+            self._names[name] = key
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                (old_name, old_checksum), old_data = self._entries.popitem(last=False)
+                del self._names[old_name]
+                self.current_bytes -= len(old_data)
+
+    def invalidate(self, name):
+        with self._lock:
+            self._discard(name)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._names.clear()
+            self.current_bytes = 0
+
+    def _discard(self, name):
+        key = self._names.pop(name, None)
+        if key is not None:
+            self.current_bytes -= len(self._entries.pop(key))
+
+
+# The cache is enabled by setting ATTACHMENT_CACHE_MAX_BYTES in settings.py.
+# ATTACHMENT_CACHE_MAX_ITEM_SIZE defaults to 256 KB, and only disables the
+# cache if it is set to 0.
+blob_cache = BlobCache(max_bytes=getattr(settings, "ATTACHMENT_CACHE_MAX_BYTES", 0),
+                       max_item_size=getattr(settings, "ATTACHMENT_CACHE_MAX_ITEM_SIZE", 256 * 1024))
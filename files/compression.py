@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+#
+# Transparent compression of binary data stored in the database.
+#
+# The encoding of the stored data is recorded in Attachment.encoding, while
+# Attachment.size and Attachment.checksum always describe the uncompressed
+# file. Data compressed with "gzip" is a complete gzip stream, so it can be
+# sent as is to clients which accept Content-Encoding: gzip.
+#
+# Files in the FileSystemStorage are left as they are, but compressed copies
+# ("siblings", i.e. report.csv.gz and report.csv.br next to report.csv) can be
+# created by the workers in `files.pipeline`, for the download view to send
+# to clients which accept them.
+#
+
+import os
+import bz2
+import zlib
+import uuid
+import errno
+from django.conf import settings
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+GZIP = "gzip"
+BZIP2 = "bzip2"
+ENCODINGS = (GZIP, BZIP2)
+
+# Mimetypes which are worth compressing. Anything else (images, video,
+# audio, archives and the zip based office formats) is most likely
+# compressed already.
+COMPRESSIBLE_TYPES = (
+    "text/",
+    "application/json",
+    "application/xml",
+    "application/javascript",
+    "application/x-javascript",
+    "application/rtf",
+    "application/x-sql",
+    "application/x-tar",
+    "application/msword",
+    "application/vnd.ms-excel",
+    "application/vnd.ms-powerpoint",
+    "application/postscript",
+    "image/svg+xml",
+    "image/bmp",
+)
+
+
+def get_encoding(mimetype, size):
+    """
+    Return the encoding new data of the given mimetype and size
+    should be stored with, or an empty string to store it as is.
+    Compression is disabled unless settings.ATTACHMENT_COMPRESSION is set.
+    """
+    encoding = getattr(settings, "ATTACHMENT_COMPRESSION", None)
+    if not encoding:
+        return ""
+    if encoding not in ENCODINGS:
+        raise ValueError("Unknown compression %r, valid values are %s." % (encoding, ", ".join(ENCODINGS)))
+    if not is_compressible(mimetype, size):
+        return ""
+    return encoding
+
+
+def is_compressible(mimetype, size):
+    """
+    Return True if a file of the given mimetype and size is worth compressing.
+    """
+    if size < getattr(settings, "ATTACHMENT_COMPRESSION_MIN_SIZE", 1024):
+        return False
+    types = getattr(settings, "ATTACHMENT_COMPRESSIBLE_TYPES", COMPRESSIBLE_TYPES)
+    return bool(mimetype) and any(mimetype.startswith(t) for t in types)
+
+
+def compressor(encoding):
+    level = getattr(settings, "ATTACHMENT_COMPRESSION_LEVEL", 6)
+    if encoding == GZIP:
+        # wbits=31 writes a gzip header and trailer.
+        return zlib.compressobj(level, zlib.DEFLATED, 31)
+    if encoding == BZIP2:
+        return bz2.BZ2Compressor(max(level, 1))
+    raise ValueError("Unknown encoding %r." % encoding)
+
+
+def decompressor(encoding):
+    if encoding == GZIP:
+        return zlib.decompressobj(31)
+    if encoding == BZIP2:
+        return bz2.BZ2Decompressor()
+    raise ValueError("Unknown encoding %r." % encoding)
+
+
+def compress_chunks(chunks, encoding):
+    """
+    Compress an iterator of chunks. Returns the chunks
+    unchanged if encoding is empty.
+    """
+    if not encoding:
+        for chunk in chunks:
+            yield chunk
+        return
+    c = compressor(encoding)
+    for chunk in chunks:
+        data = c.compress(chunk)
+        if data:
+            yield data
+    data = c.flush()
+    if data:
+        yield data
+
+
+def decompress_chunks(chunks, encoding):
+    """
+    Decompress an iterator of chunks. Returns the chunks
+    unchanged if encoding is empty.
+    """
+    if not encoding:
+        for chunk in chunks:
+            yield chunk
+        return
+    d = decompressor(encoding)
+    for chunk in chunks:
+        data = d.decompress(chunk)
+        if data:
+            yield data
+    if encoding == GZIP:
+        data = d.flush()
+        if data:
+            yield data
+
+
+def compress(data, encoding):
+    return "".join(compress_chunks([data], encoding))
+
+
+def decompress(data, encoding):
+    return "".join(decompress_chunks([data], encoding))
+
+
+def parse_accept_encoding(accept_encoding):
+    """
+    Return a dict of content coding -> q value parsed from
+    the value of an Accept-Encoding header.
+    """
+    codings = {}
+    for item in accept_encoding.split(","):
+        params = item.split(";")
+        coding = params[0].strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params[1:]:
+            name, sep, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        codings[coding] = q
+    return codings
+
+
+def accepts_encoding(accept_encoding, encoding):
+    """
+    Return True if a client sending the Accept-Encoding header value
+    accepts the encoding. Codings with q=0 are refused, and "*" applies
+    to the codings which are not listed.
+    """
+    codings = parse_accept_encoding(accept_encoding)
+    return codings.get(encoding, codings.get("*", 0.0)) > 0
+
+
+# Content-Encoding and file name suffix of precompressed siblings, in order
+# of preference. Brotli is only used if the brotli package is installed.
+SIBLING_ENCODINGS = (
+    ("br", ".br"),
+    (GZIP, ".gz"),
+)
+
+
+def sibling_encodings():
+    return [(encoding, suffix) for encoding, suffix in SIBLING_ENCODINGS
+            if encoding != "br" or brotli is not None]
+
+
+def is_sibling(path):
+    """
+    Return the path of the file path is a precompressed sibling
+    of, or None if it is not a sibling (or the file does not exist).
+    """
+    for encoding, suffix in SIBLING_ENCODINGS:
+        if path.endswith(suffix) and os.path.exists(path[:-len(suffix)]):
+            return path[:-len(suffix)]
+    return None
+
+
+def _sibling_chunks(f, encoding, chunk_size=65536):
+    if encoding == "br":
+        compressor = brotli.Compressor()
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            data = compressor.process(chunk)
+            if data:
+                yield data
+        yield compressor.finish()
+    else:
+        for chunk in compress_chunks(iter(lambda: f.read(chunk_size), ""), encoding):
+            yield chunk
+
+
+def precompress(path, encoding, suffix):
+    """
+    Write the compressed sibling of the file at path. The sibling is
+    written to a temporary file and renamed into place, so concurrent
+    requests never see a partial file.
+    """
+    tmp = "%s.%s.tmp" % (path, uuid.uuid4().hex)
+    try:
+        with open(path, "rb") as f:
+            with open(tmp, "wb") as out:
+                for chunk in _sibling_chunks(f, encoding):
+                    out.write(chunk)
+        os.rename(tmp, path + suffix)
+    except Exception:
+        remove_file(tmp)
+        raise
+    return path + suffix
+
+
+def is_fresh(path, suffix):
+    """
+    Return True if the sibling exists, and is not older than the file itself.
+    """
+    try:
+        return os.stat(path + suffix).st_mtime >= os.stat(path).st_mtime
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise e
+    return False
+
+
+def get_sibling(path, encoding, suffix):
+    """
+    Return the path of the sibling, creating it if it is
+    missing or older than the file itself.
+    """
+    if is_fresh(path, suffix):
+        return path + suffix
+    return precompress(path, encoding, suffix)
+
+
+def get_stale_siblings(path):
+    """
+    Return the (encoding, suffix) of the siblings of the file
+    at path which are missing or older than the file.
+    """
+    return [(encoding, suffix) for encoding, suffix in sibling_encodings() if not is_fresh(path, suffix)]
+
+
+def get_precompressed(path, mimetype, size, accept_encoding):
+    """
+    Return (encoding, sibling path) of an up to date precompressed sibling
+    of the file at path which the client accepts, or None. Siblings are
+    never created here, as that takes as long as compressing the file; see
+    the precompress task in `files.pipeline`.
+    """
+    if not getattr(settings, "ATTACHMENT_PRECOMPRESS", False) or not is_compressible(mimetype, size):
+        return None
+    for encoding, suffix in sibling_encodings():
+        if accepts_encoding(accept_encoding, encoding) and is_fresh(path, suffix):
+            return encoding, path + suffix
+    return None
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise e
+
+
+def remove_precompressed(path):
+    """
+    Remove the precompressed siblings of the file at path.
+    """
+    for encoding, suffix in SIBLING_ENCODINGS:
+        remove_file(path + suffix)
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+#
+# Per-object attachment counters.
+#
+# With settings.ATTACHMENT_COUNTERS = True, the number and total size of
+# the attachments of each object are kept in the AttachmentCounter table,
+# keyed by (content_type, object_id, site, backend). Every attachment
+# remembers what it was counted as when it was loaded (post_init), and
+# saving or deleting it adds the difference to the counters, so a count
+# is a lookup on the unique index instead of a count over the attachments.
+#
+# Changes which bypass the model signals (QuerySet.update(), raw SQL, or
+# saving instances loaded with defer/only) are not counted. Recount with
+# `python manage.py reconcile_attachment_counters` after such changes.
+#
+
+from django.conf import settings
+from django.db import transaction, IntegrityError
+from django.db.models import F, Sum, Count
+from django.utils.encoding import smart_unicode
+from django.core.files.storage import get_storage_class
+
+import files
+from files.models import Attachment, AttachmentCounter
+
+# The order of the counted values in a delta.
+COUNT, SIZE, PUBLIC_COUNT, PUBLIC_SIZE = range(4)
+
+
+def is_enabled():
+    return getattr(settings, "ATTACHMENT_COUNTERS", False) is True
+
+
+def get_state(instance):
+    """
+    Return (key, is_public, size) of what the attachment is counted as.
+    """
+    key = (instance.content_type_id, smart_unicode(instance.object_id), instance.site_id, instance.backend)
+    return key, bool(instance.is_public), instance.size or 0
+
+
+def remember(instance):
+    if instance.pk is not None:
+        instance._counter_state = get_state(instance)
+
+
+def add_delta(deltas, state, sign):
+    key, is_public, size = state
+    delta = deltas.setdefault(key, [0, 0, 0, 0])
+    delta[COUNT] += sign
+    delta[SIZE] += sign * size
+    if is_public:
+        delta[PUBLIC_COUNT] += sign
+        delta[PUBLIC_SIZE] += sign * size
+
+
+def saved(instance, created):
+    deltas = {}
+    old = None if created else getattr(instance, "_counter_state", None)
+    if old is None and not created:
+        # Loaded before counting was enabled, so the old values are
+        # unknown. The counters are adjusted the next time it is saved.
+        remember(instance)
+        return
+    new = get_state(instance)
+    if old is not None:
+        add_delta(deltas, old, -1)
+    add_delta(deltas, new, 1)
+    apply_deltas(deltas, instance._state.db)
+    instance._counter_state = new
+
+
+def deleted(instance):
+    deltas = {}
+    add_delta(deltas, getattr(instance, "_counter_state", None) or get_state(instance), -1)
+    apply_deltas(deltas, instance._state.db)
+
+
+def apply_deltas(deltas, using):
+    for key, delta in deltas.items():
+        if any(delta):
+            apply_delta(key, delta, using)
+
+
+def apply_delta(key, delta, using):
+    """
+    Add the delta to the counter with an UPDATE, so concurrent
+    changes of the same counter are not lost.
+    """
+    content_type_id, object_id, site_id, backend = key
+    qs = AttachmentCounter.objects.using(using).filter(content_type__pk=content_type_id, object_id=object_id,
+                                                       site__pk=site_id, backend=backend)
+    values = dict(count=F("count") + delta[COUNT], size=F("size") + delta[SIZE],
+                  public_count=F("public_count") + delta[PUBLIC_COUNT],
+                  public_size=F("public_size") + delta[PUBLIC_SIZE])
+    if qs.update(**values) or delta[COUNT] <= 0:
+        # A missing counter of an attachment which was removed or changed
+        # was never counted; it is created by reconcile().
+        return
+    try:
+        sid = transaction.savepoint(using)
+        AttachmentCounter.objects.using(using).create(
+            content_type_id=content_type_id, object_id=object_id, site_id=site_id, backend=backend,
+            count=delta[COUNT], size=delta[SIZE],
+            public_count=delta[PUBLIC_COUNT], public_size=delta[PUBLIC_SIZE])
+        transaction.savepoint_commit(sid, using=using)
+    except IntegrityError:
+        # Created by a concurrent request in the meantime.
+        transaction.savepoint_rollback(sid, using=using)
+        qs.update(**values)
+
+
+def get_count(ctype, object_pk, user=None):
+    """
+    Return the number of attachments of the object which are visible to
+    the user; the counted public attachments, and the private attachments
+    of the user. The counters only hold the public count, so for
+    authenticated users the private attachments are counted with a
+    query on the attachment table.
+    """
+    qs = AttachmentCounter.objects.filter(content_type=ctype, object_id=smart_unicode(object_pk),
+                                          site__pk=settings.SITE_ID)
+    engine = get_storage_class()
+    if not getattr(engine, "is_routing", False):
+        qs = qs.filter(backend=str(engine.__name__))
+    count = qs.aggregate(count=Sum("public_count"))["count"] or 0
+    if user is not None and user.is_authenticated():
+        count += files.get_object_attachments(Attachment, ctype, object_pk, user).filter(is_public=False).count()
+    return count
+
+
+def count_attachments(attachments):
+    """
+    Count the attachments of the queryset. Returns a dict of the
+    key of each counter to its values [count, size, public_count, public_size].
+    """
+    counts = {}
+    rows = attachments.order_by().values("content_type", "object_id", "site", "backend", "is_public") \
+        .annotate(count=Count("pk"), size=Sum("size"))
+    for row in rows.iterator():
+        key = (row["content_type"], smart_unicode(row["object_id"]), row["site"], row["backend"])
+        values = counts.setdefault(key, [0, 0, 0, 0])
+        values[COUNT] += row["count"]
+        values[SIZE] += row["size"] or 0
+        if row["is_public"]:
+            values[PUBLIC_COUNT] += row["count"]
+            values[PUBLIC_SIZE] += row["size"] or 0
+    return counts
+
+
+def reconcile(using=None, dry_run=False, batch_size=500):
+    """
+    Recount the attachments of every object, and correct the counters
+    which are wrong. Returns (fixed, created, removed).
+    """
+    return reconcile_counters(Attachment.objects.using(using), AttachmentCounter.objects.using(using),
+                              using, dry_run, batch_size)
+
+
+def get_objects(attachments):
+    """
+    Return the (content_type_id, object_id) of the objects which
+    the attachments of the queryset are attached to.
+    """
+    return set(attachments.order_by().values_list("content_type", "object_id").distinct())
+
+
+def recount(objects, using=None, batch_size=500):
+    """
+    Recount the attachments of the objects, as returned by get_objects(),
+    i.e. after changing the attachments with QuerySet.update().
+    """
+    object_ids = {}
+    for content_type_id, object_id in objects:
+        object_ids.setdefault(content_type_id, []).append(object_id)
+    for content_type_id, ids in object_ids.items():
+        for i in range(0, len(ids), batch_size):
+            lookup = dict(content_type__pk=content_type_id, object_id__in=ids[i:i + batch_size])
+            reconcile_counters(Attachment.objects.using(using).filter(**lookup),
+                               AttachmentCounter.objects.using(using).filter(**lookup),
+                               using, False, batch_size)
+
+
+def reconcile_counters(attachments, counters, using, dry_run, batch_size):
+    """
+    Count the attachments of the queryset attachments, and correct
+    the queryset of their counters. Returns (fixed, created, removed).
+    """
+    fixed = removed = 0
+    actual = count_attachments(attachments)
+    existing = set()
+    for counter in counters.iterator():
+        key = (counter.content_type_id, counter.object_id, counter.site_id, counter.backend)
+        existing.add(key)
+        values = actual.get(key)
+        if values is None:
+            removed += 1
+            if not dry_run:
+                AttachmentCounter.objects.using(using).filter(pk=counter.pk).delete()
+        elif values != [counter.count, counter.size, counter.public_count, counter.public_size]:
+            fixed += 1
+            if not dry_run:
+                AttachmentCounter.objects.using(using).filter(pk=counter.pk).update(
+                    count=values[COUNT], size=values[SIZE],
+                    public_count=values[PUBLIC_COUNT], public_size=values[PUBLIC_SIZE])
+
+    missing = []
+    for key, values in actual.items():
+        if key not in existing:
+            content_type_id, object_id, site_id, backend = key
+            missing.append(AttachmentCounter(
+                content_type_id=content_type_id, object_id=object_id, site_id=site_id, backend=backend,
+                count=values[COUNT], size=values[SIZE],
+                public_count=values[PUBLIC_COUNT], public_size=values[PUBLIC_SIZE]))
+    if not dry_run:
+        for i in range(0, len(missing), batch_size):
+            AttachmentCounter.objects.using(using).bulk_create(missing[i:i + batch_size])
+        transaction.commit_unless_managed(using=using)
+    return fixed, len(missing), removed
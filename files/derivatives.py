@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+#
+# Thumbnails and previews of image attachments.
+#
+# Derivatives are generated from the original file according to named
+# specifications (settings.ATTACHMENT_DERIVATIVE_SPECS), and stored in the
+# AttachmentDerivative table, keyed by (attachment, spec, checksum). They are
+# generated by the workers in `files.pipeline`, never while a request waits;
+# the job is queued by the first request, or when the image is uploaded if
+# settings.ATTACHMENT_DERIVATIVES_BACKGROUND is True.
+#
+# Images larger than settings.ATTACHMENT_DERIVATIVE_MAX_PIXELS are refused
+# before they are decoded, as a small file can decode to a huge image. The
+# refusal is stored as an empty derivative, so the image is only read once.
+#
+# Requires the Python Imaging Library (PIL or Pillow). Without it, no
+# derivatives are generated.
+#
+
+import logging
+from StringIO import StringIO
+from django.conf import settings
+from django.db import transaction, IntegrityError
+from django.core.files.base import ContentFile
+
+from files import pipeline
+from files.models import AttachmentDerivative
+from files.storage import get_attachment_storage
+
+try:
+    from PIL import Image
+except ImportError:
+    try:
+        import Image
+    except ImportError:
+        Image = None
+
+DEFAULT_SPECS = {
+    "thumbnail": {"size": (128, 128)},
+    "preview": {"size": (640, 640)},
+}
+
+# Width x height of the largest image which is decoded
+DEFAULT_MAX_PIXELS = 50 * 1000 * 1000
+
+# Output formats -> (mimetype, file extension)
+FORMATS = {
+    "JPEG": ("image/jpeg", "jpg"),
+    "PNG": ("image/png", "png"),
+}
+
+logger = logging.getLogger(__name__)
+
+
+class ImageTooLarge(Exception):
+    pass
+
+
+def get_specs():
+    """
+    Return the derivative specifications. Each specification is a dict with
+    the bounding box "size" (width, height), and optionally the output
+    "format" ("JPEG" or "PNG", default is PNG for images with transparency,
+    and JPEG for anything else) and JPEG "quality" (default is 85).
+    """
+    return getattr(settings, "ATTACHMENT_DERIVATIVE_SPECS", DEFAULT_SPECS)
+
+
+def is_supported(attachment):
+    """
+    Return True if derivatives can be generated for the attachment.
+    """
+    return Image is not None and attachment.is_ready and bool(attachment.mimetype) and \
+        attachment.mimetype.startswith("image/") and attachment.mimetype != "image/svg+xml"
+
+
+def render(f, spec):
+    """
+    Scale the image in the file f to fit the specification.
+    Returns (data, format, (width, height)). Raises ImageTooLarge
+    if the image has more than settings.ATTACHMENT_DERIVATIVE_MAX_PIXELS.
+    """
+    # Only the header is read until the image is loaded
+    image = Image.open(f)
+    width, height = image.size
+    if width * height > getattr(settings, "ATTACHMENT_DERIVATIVE_MAX_PIXELS", DEFAULT_MAX_PIXELS):
+        raise ImageTooLarge("The image is %d x %d pixels." % (width, height))
+    # Let the JPEG decoder scale down while decoding, which is
+    # much faster than decoding the full image.
+    image.draft("RGB", spec["size"])
+    fmt = spec.get("format")
+    if fmt is None:
+        fmt = "PNG" if image.mode in ("RGBA", "LA", "P") else "JPEG"
+    if fmt == "JPEG" and image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    image.thumbnail(spec["size"], Image.ANTIALIAS)
+    out = StringIO()
+    image.save(out, fmt, quality=spec.get("quality", 85))
+    return out.getvalue(), fmt, image.size
+
+
+def generate(attachment, spec_name):
+    """
+    Generate (or regenerate) the derivative of the attachment, and
+    remove derivatives of earlier versions of the file. If the image
+    is too large, an empty derivative is stored instead.
+    """
+    using = attachment._state.db
+    spec = get_specs()[spec_name]
+    f = get_attachment_storage(attachment).open(attachment.attachment.name)
+    try:
+        data, fmt, (width, height) = render(f, spec)
+    except ImageTooLarge, e:
+        logger.warning("No %s for attachment %s: %s", spec_name, attachment.pk, e)
+        data, fmt, (width, height) = "", None, (0, 0)
+    finally:
+        f.close()
+    mimetype, ext = FORMATS.get(fmt, ("", ""))
+
+    derivative = AttachmentDerivative(attachment=attachment, spec=spec_name, checksum=attachment.checksum,
+                                      mimetype=mimetype, size=len(data), width=width, height=height)
+    if data and attachment.backend == "FileSystemStorage":
+        derivative.file.save("%s-%s.%s" % (spec_name, attachment.checksum, ext),
+                             ContentFile(data), save=False)
+    elif data:
+        derivative.data = buffer(data)
+    try:
+        sid = transaction.savepoint(using)
+        derivative.save(using=using)
+        transaction.savepoint_commit(sid, using=using)
+    except IntegrityError:
+        # Generated by another worker in the meantime.
+        transaction.savepoint_rollback(sid, using=using)
+        if derivative.file:
+            derivative.file.storage.delete(derivative.file.name)
+        return AttachmentDerivative.objects.using(using).get(attachment=attachment, spec=spec_name,
+                                                             checksum=attachment.checksum)
+    AttachmentDerivative.objects.using(using).filter(attachment=attachment, spec=spec_name) \
+        .exclude(checksum=attachment.checksum).delete()
+    transaction.commit_unless_managed(using=using)
+    return derivative
+
+
+def get_derivative(attachment, spec_name, create=True):
+    """
+    Return the derivative of the attachment, or None if it is not
+    available yet. Missing derivatives are queued if create is True.
+    Raises ImageTooLarge if the image is too large for derivatives.
+    """
+    if spec_name not in get_specs() or not is_supported(attachment):
+        return None
+    try:
+        derivative = AttachmentDerivative.objects.using(attachment._state.db) \
+            .get(attachment=attachment, spec=spec_name, checksum=attachment.checksum)
+    except AttachmentDerivative.DoesNotExist:
+        if create:
+            schedule(attachment)
+        return None
+    if not derivative.size:
+        raise ImageTooLarge("No %s is available for this attachment." % spec_name)
+    return derivative
+
+
+def schedule(attachment):
+    """
+    Queue a job which generates all derivatives of the attachment,
+    unless one is already queued.
+    """
+    if not is_supported(attachment):
+        return
+    pipeline.enqueue_once(attachment, pipeline.TASK_GENERATE_DERIVATIVES)
+
+
+def generate_all(attachment):
+    """
+    Generate the missing derivatives of the attachment.
+    """
+    if not is_supported(attachment):
+        return
+    existing = set(AttachmentDerivative.objects.using(attachment._state.db)
+                   .filter(attachment=attachment, checksum=attachment.checksum)
+                   .values_list("spec", flat=True))
+    for spec_name in get_specs():
+        if spec_name not in existing:
+            generate(attachment, spec_name)
@@ -7,7 +7,8 @@ from django.forms.util import ErrorDict
 from django.utils.crypto import salted_hmac, constant_time_compare
 from django.utils.translation import ugettext_lazy as _
 
-from files.models import Attachment
+from files import quotas
+from files.models import Attachment, UploadSession
 from django.contrib.contenttypes.models import ContentType
 
 
@@ -112,6 +113,14 @@ class AttachmentForm(forms.ModelForm):
         if max_size and attachment.size > max_size:
             raise forms.ValidationError(_("File is too large! " \
                   "Please keep attachment size under %d bytes." % max_size))
+        if quotas.is_enabled():
+            # The creator is set on the instance by the views.
+            ctype = ContentType.objects.get_for_model(self.target_object)
+            try:
+                quotas.check(self.instance, self.instance.creator_id, ctype.pk,
+                             self.target_object._get_pk_val(), attachment.size)
+            except quotas.QuotaExceeded, e:
+                raise forms.ValidationError(e.messages)
         return attachment
         
     def clean_timestamp(self):
@@ -131,3 +140,35 @@ class AttachmentForm(forms.ModelForm):
         if value:
             raise forms.ValidationError(self.fields["honeypot"].label)
         return value
+
+
+class UploadSessionForm(AttachmentForm):
+    """
+    Form for starting a resumable upload. Uses the same
+    security checks as the AttachmentForm.
+    """
+    
+    class Meta:
+        model = UploadSession
+        fields = ("content_type", "object_id", "description", "is_public", "filename",
+                  "mimetype", "length", "timestamp", "security_hash", "honeypot")
+    
+    def clean_length(self):
+        """
+        Make sure the announced file size is allowed.
+        """
+        length = self.cleaned_data["length"]
+        max_size = getattr(settings, "ATTACHMENT_MAX_SIZE", None)
+        if max_size and length > max_size:
+            raise forms.ValidationError(_("File is too large! " \
+                  "Please keep attachment size under %d bytes." % max_size))
+        if length < 0:
+            raise forms.ValidationError(_("Invalid upload length."))
+        if quotas.is_enabled():
+            ctype = ContentType.objects.get_for_model(self.target_object)
+            try:
+                quotas.check(None, self.instance.creator_id, ctype.pk,
+                             self.target_object._get_pk_val(), length)
+            except quotas.QuotaExceeded, e:
+                raise forms.ValidationError(e.messages)
+        return length
@@ -0,0 +1,393 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import socket
+import resource
+import tempfile
+import datetime
+import itertools
+import threading
+from optparse import make_option
+
+import django
+from django.conf import settings
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.contrib.auth.models import User
+from django.contrib.sites.models import Site
+from django.core.files.uploadedfile import UploadedFile
+from django.core.management.base import BaseCommand, CommandError
+from django.template import Template, Context
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+
+from files.cache import blob_cache
+from files.models import Attachment
+from files.storage import BACKEND_STORAGES, RoutingStorage, get_backend_storage
+from files.views import AttachmentDownloadView
+
+UPLOAD = "upload"
+DOWNLOAD = "download"
+LIST = "list"
+
+SIZE_UNITS = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+# Database storage backends only work with their own database.
+BACKEND_VENDORS = {
+    "SQLiteStorage": "sqlite",
+    "PostgreSQLStorage": "postgresql",
+    "PostgreSQLInlineStorage": "postgresql",
+    "MySQLStorage": "mysql",
+    "OracleStorage": "oracle",
+}
+
+# Queries are only counted for files up to this size, as the debug
+# cursor keeps the parameters (i.e. the binary data) of each query.
+QUERY_COUNT_MAX_SIZE = 1024 ** 2
+
+LIST_TEMPLATE = Template("{% load attachments %}"
+                         "{% get_attachment_list for target as attachments %}"
+                         "{% for attachment in attachments %}{% get_download_url attachment %}{% endfor %}")
+
+
+def parse_size(value):
+    value = value.strip().upper().rstrip("B")
+    if value and value[-1] in SIZE_UNITS:
+        return int(float(value[:-1]) * SIZE_UNITS[value[-1]])
+    return int(value)
+
+
+def format_size(size):
+    for unit in ("G", "M", "K"):
+        if size >= SIZE_UNITS[unit] and size % SIZE_UNITS[unit] == 0:
+            return "%d%s" % (size / SIZE_UNITS[unit], unit)
+    return str(size)
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def max_rss():
+    """
+    High-water mark of the resident set size of this process, in KB.
+    This is the peak over the lifetime of the process rather than of a
+    single measurement, so it is only reported once per run.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class BenchmarkStorage(RoutingStorage):
+    """
+    Routing storage which writes new files to one given backend.
+    """
+    def __init__(self, backend, using=None):
+        super(BenchmarkStorage, self).__init__(using)
+        self.backend = backend
+
+    def get_backend_name(self, content):
+        return self.backend
+
+
+class Command(BaseCommand):
+    """
+    Measure upload throughput, download latency and throughput, and
+    listing time for the storage backends, across file sizes and
+    concurrency levels. The results can be written as JSON and compared
+    with an earlier run.
+
+    Attachments are created on the current Site object, and removed
+    when the benchmark is done. Don't run it against a production database.
+    Uploads are processed in the request, even if
+    ATTACHMENT_DEFERRED_PROCESSING is enabled.
+    """
+    help = "Benchmark uploads, downloads and listings for the storage backends."
+    option_list = BaseCommand.option_list + (
+        make_option("--backends", dest="backends", default=None,
+                    help="Comma separated backend names. Default is FileSystemStorage and "
+                         "the database backends for the current database."),
+        make_option("--sizes", dest="sizes", default="1K,64K,1M,16M",
+                    help="Comma separated file sizes, i.e. 1K,1M,1G. Default is 1K,64K,1M,16M."),
+        make_option("--concurrency", dest="concurrency", default="1,4",
+                    help="Comma separated numbers of concurrent threads. Default is 1,4."),
+        make_option("--iterations", type="int", dest="iterations", default=10,
+                    help="Operations per thread for each measurement. Default is 10."),
+        make_option("--seed", type="int", dest="seed", default=0,
+                    help="Seed for the generated file contents. Default is 0."),
+        make_option("--output", dest="output", default=None,
+                    help="Write the results as JSON to this file."),
+        make_option("--compare", dest="compare", default=None,
+                    help="Compare the results with an earlier JSON output file."),
+    )
+
+    def handle(self, *args, **options):
+        self.options = options
+        self.verbosity = int(options["verbosity"])
+        vendor = connections[DEFAULT_DB_ALIAS].vendor
+        if options["backends"]:
+            backends = [b.strip() for b in options["backends"].split(",")]
+        else:
+            backends = ["FileSystemStorage"] + sorted(b for b, v in BACKEND_VENDORS.items() if v == vendor)
+        for backend in backends:
+            if backend not in BACKEND_STORAGES:
+                raise CommandError("Unknown backend %r. Valid backends are %s." % (
+                    backend, ", ".join(sorted(BACKEND_STORAGES))))
+            if BACKEND_VENDORS.get(backend, vendor) != vendor:
+                raise CommandError("The %s backend requires a %s database." % (backend, BACKEND_VENDORS[backend]))
+            # Fail early if the backend is not implemented.
+            get_backend_storage(backend)
+        sizes = [parse_size(s) for s in options["sizes"].split(",")]
+        levels = [int(c) for c in options["concurrency"].split(",")]
+
+        self.directory = tempfile.mkdtemp(prefix="files-benchmark-")
+        self.target = Site.objects.get_current()
+        self.user, created_user = User.objects.get_or_create(username="files-benchmark")
+        self.user.is_superuser = True
+        self.factory = RequestFactory()
+        results = []
+        field = Attachment._meta.get_field("attachment")
+        original_storage = field.storage
+        try:
+            for backend in backends:
+                field.storage = BenchmarkStorage(backend)
+                # The write_binary and unlink_binary receivers look up
+                # the storage class, which routes by Attachment.backend.
+                # Deferred uploads would not be ready for download.
+                with override_settings(DEFAULT_FILE_STORAGE="files.storage.RoutingStorage",
+                                       ATTACHMENT_DEFERRED_PROCESSING=False):
+                    results.extend(self.run_backend(backend, sizes, levels))
+        finally:
+            field.storage = original_storage
+            shutil.rmtree(self.directory, ignore_errors=True)
+            if created_user:
+                self.user.delete()
+
+        self.stdout.write("Peak RSS %d MB\n" % (max_rss() / 1024))
+        output = {"meta": self.get_meta(backends, sizes, levels), "results": results}
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                json.dump(output, f, indent=2, sort_keys=True)
+        if options["compare"]:
+            with open(options["compare"]) as f:
+                self.compare(json.load(f)["results"], results)
+
+    def run_backend(self, backend, sizes, levels):
+        results = []
+        created = []
+        try:
+            for size in sizes:
+                source = self.make_source(size)
+                for concurrency in levels:
+                    pks = []
+                    result = self.measure(backend, UPLOAD, size, concurrency,
+                                          lambda: self.upload(source, size, pks))
+                    created.extend(pks)
+                    results.append(result)
+                    # Download each of the uploaded files in turn, starting
+                    # with an empty blob cache, so the cache only serves
+                    # repeated downloads (see cache_hits in the results).
+                    blob_cache.clear()
+                    turn = itertools.count()
+                    results.append(self.measure(backend, DOWNLOAD, size, concurrency,
+                                                lambda: self.download(pks[turn.next() % len(pks)])))
+                os.remove(source)
+            for concurrency in levels:
+                results.append(self.measure(backend, LIST, len(created), concurrency, self.list))
+        finally:
+            self.cleanup(created)
+        return results
+
+    def cleanup(self, pks):
+        """
+        Delete the attachments one at a time, so the backends unlink their
+        binary data. The instances must not be deferred, as the delete
+        signals are only sent for the Attachment class itself.
+        """
+        for attachment in Attachment.objects.filter(pk__in=pks).iterator():
+            attachment.delete()
+
+    def make_source(self, size):
+        """
+        Write a file of the given size, with reproducible contents
+        which are not compressible.
+        """
+        rand = random.Random(self.options["seed"])
+        block = "".join(chr(rand.randint(0, 255)) for i in xrange(65536))
+        path = os.path.join(self.directory, format_size(size))
+        with open(path, "wb") as f:
+            remaining = size
+            while remaining > 0:
+                f.write(block[:remaining])
+                remaining -= len(block)
+        return path
+
+    def upload(self, source, size, pks):
+        with open(source, "rb") as f:
+            content = UploadedFile(f, "benchmark-%s.bin" % format_size(size), "application/octet-stream", size)
+            attachment = Attachment(content_object=self.target, creator=self.user, attachment=content)
+            attachment.save()
+        pks.append(attachment.pk)
+        return size, None
+
+    def download(self, pk):
+        attachment = Attachment.objects.defer("blob", "data").get(pk=pk)
+        request = self.factory.get(attachment.get_absolute_url())
+        request.user = self.user
+        started = time.time()
+        response = AttachmentDownloadView.as_view()(request, slug=attachment.slug)
+        nbytes, first = 0, None
+        for chunk in response.streaming_content:
+            if first is None:
+                first = time.time() - started
+            nbytes += len(chunk)
+        if response.status_code != 200 or nbytes != attachment.size:
+            raise ValueError("Download returned %d with %d of %d bytes." % (
+                response.status_code, nbytes, attachment.size))
+        return nbytes, first
+
+    def list(self):
+        LIST_TEMPLATE.render(Context({"target": self.target, "user": self.user}))
+        return 0, None
+
+    def measure(self, backend, operation, size, concurrency, func):
+        """
+        Run func iterations times in each of concurrency threads.
+        """
+        iterations = self.options["iterations"]
+        latencies, first_bytes, errors = [], [], []
+
+        # One untimed run, which also counts the queries of the operation.
+        queries = None
+        connection = connections[DEFAULT_DB_ALIAS]
+        count_queries = size <= QUERY_COUNT_MAX_SIZE or operation == LIST
+        if count_queries:
+            connection.use_debug_cursor, start = True, len(connection.queries)
+        try:
+            func()
+        except Exception, e:
+            errors.append("%s: %s" % (e.__class__.__name__, e))
+        if count_queries:
+            queries = len(connection.queries) - start
+            connection.use_debug_cursor = None
+            del connection.queries[start:]
+
+        nbytes = [0]
+        lock = threading.Lock()
+        cache_hits = blob_cache.hits
+
+        def worker():
+            try:
+                for i in range(iterations):
+                    started = time.time()
+                    try:
+                        n, first = func()
+                    except Exception, e:
+                        with lock:
+                            errors.append("%s: %s" % (e.__class__.__name__, e))
+                        continue
+                    elapsed = time.time() - started
+                    with lock:
+                        latencies.append(elapsed)
+                        nbytes[0] += n
+                        if first is not None:
+                            first_bytes.append(first)
+            finally:
+                connections[DEFAULT_DB_ALIAS].close()
+
+        started = time.time()
+        threads = [threading.Thread(target=worker) for i in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = max(time.time() - started, 0.000001)
+
+        result = {
+            "backend": backend,
+            "operation": operation,
+            "size": size,
+            "concurrency": concurrency,
+            "operations": len(latencies),
+            "errors": len(errors),
+            "seconds": elapsed,
+            "ops_per_second": len(latencies) / elapsed,
+            "bytes_per_second": nbytes[0] / elapsed if operation != LIST else None,
+            "latency_mean": sum(latencies) / len(latencies) if latencies else None,
+            "latency_p50": percentile(latencies, 50),
+            "latency_p95": percentile(latencies, 95),
+            "latency_max": max(latencies) if latencies else None,
+            "first_byte_p50": percentile(first_bytes, 50),
+            "queries_per_operation": queries,
+            "cache_hits": blob_cache.hits - cache_hits if blob_cache.enabled else None,
+        }
+        self.report(result, errors)
+        return result
+
+    def report(self, result, errors):
+        line = "%-24s %-8s %6s x%-3d %8.1f ops/s" % (
+            result["backend"], result["operation"],
+            format_size(result["size"]) if result["operation"] != LIST else result["size"],
+            result["concurrency"], result["ops_per_second"])
+        if result["bytes_per_second"] is not None:
+            line += " %9.1f MB/s" % (result["bytes_per_second"] / 1048576)
+        if result["latency_p50"] is not None:
+            line += "  p50 %7.1f ms  p95 %7.1f ms" % (result["latency_p50"] * 1000, result["latency_p95"] * 1000)
+        if result["queries_per_operation"] is not None:
+            line += "  %d queries" % result["queries_per_operation"]
+        if result["cache_hits"]:
+            line += "  %d cache hits" % result["cache_hits"]
+        if errors:
+            line += "  %d errors" % len(errors)
+        self.stdout.write(line + "\n")
+        if self.verbosity > 1:
+            for error in sorted(set(errors)):
+                self.stderr.write("    %s\n" % error)
+
+    def get_meta(self, backends, sizes, levels):
+        connection = connections[DEFAULT_DB_ALIAS]
+        return {
+            "date": datetime.datetime.utcnow().isoformat(),
+            "hostname": socket.gethostname(),
+            "python": sys.version.split()[0],
+            "django": django.get_version(),
+            "database": connection.vendor,
+            "backends": backends,
+            "sizes": sizes,
+            "concurrency": levels,
+            "iterations": self.options["iterations"],
+            "seed": self.options["seed"],
+            "max_rss_kb": max_rss(),
+            "blob_cache": {"enabled": blob_cache.enabled, "max_bytes": blob_cache.max_bytes,
+                           "max_item_size": blob_cache.max_item_size},
+            "settings": dict((name, getattr(settings, name, None)) for name in (
+                "ATTACHMENT_CACHE_MAX_BYTES", "ATTACHMENT_COMPRESSION",
+                "ATTACHMENT_DOWNLOAD_CHUNK_SIZE", "ATTACHMENT_DEFERRED_PROCESSING")),
+        }
+
+    def compare(self, baseline, results):
+        """
+        Print the change of throughput and median latency
+        relative to an earlier run.
+        """
+        key = lambda r: (r["backend"], r["operation"], r["size"], r["concurrency"])
+        baseline = dict((key(r), r) for r in baseline)
+        self.stdout.write("\nChange relative to baseline:\n")
+        for result in results:
+            base = baseline.get(key(result))
+            if base is None:
+                continue
+            changes = []
+            for name in ("ops_per_second", "latency_p50"):
+                if base.get(name) and result.get(name) is not None:
+                    changes.append("%s %+.1f%%" % (name, (result[name] / base[name] - 1) * 100))
+            self.stdout.write("%-24s %-8s %6s x%-3d %s\n" % (
+                result["backend"], result["operation"],
+                format_size(result["size"]) if result["operation"] != LIST else result["size"],
+                result["concurrency"], "  ".join(changes)))
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import datetime
+from optparse import make_option
+from django.conf import settings
+from django.db import connections, transaction
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from files.models import Attachment, AttachmentJob, UploadSession
+from files.pipeline import get_spool_dir, remove_spool
+from files.compression import is_sibling
+from files.storage import FileSystemStorage
+
+# File in the spool directory recording when each orphaned large
+# object was first seen, as large objects have no creation time.
+LARGE_OBJECT_STATE = "cleanup_large_objects.json"
+
+
+class Command(BaseCommand):
+    """
+    Remove binary data which is no longer referenced by any attachment:
+
+    * PostgreSQL large objects not referenced by files_attachment.blob,
+      i.e. left behind by rolled back transactions, or by rows deleted
+      without the pre_delete signal (QuerySet.delete(), cascades).
+    * Files under MEDIA_ROOT/FILE_STORAGE_PREFIX which are not referenced
+      by any attachment. Precompressed siblings (.gz, .br) are kept as
+      long as the file they were created from is referenced.
+    * Upload sessions and spool files which have not been touched
+      for --min-age seconds.
+
+    Note that the large object collector assumes the attachments are the
+    only users of large objects in the database.
+
+    Large objects have no creation time, so an orphaned large object is
+    only removed once it has been seen orphaned for --min-age seconds, by
+    an earlier run of the command. This keeps files being received by the
+    StreamingBlobUploadHandler, which are written to a large object before
+    the attachment referencing it is saved, from being removed.
+    """
+    help = "Remove orphaned large objects, files and upload sessions."
+    option_list = BaseCommand.option_list + (
+        make_option("--dry-run", action="store_true", dest="dry_run", default=False,
+                    help="Only report what would be removed."),
+        make_option("--batch-size", type="int", dest="batch_size", default=1000,
+                    help="Number of objects to check per batch. Default is 1000."),
+        make_option("--sleep", type="float", dest="sleep", default=0,
+                    help="Seconds to sleep between batches, to limit the load on the database "
+                         "and file system. Default is 0."),
+        make_option("--min-age", type="int", dest="min_age", default=24 * 60 * 60,
+                    help="Only remove files, spool files and upload sessions older than this "
+                         "many seconds, and large objects which have been orphaned for as long, "
+                         "to avoid racing with uploads in progress. Default is 86400."),
+        make_option("--removed", action="store_true", dest="removed", default=False,
+                    help="Also remove files renamed by FORCE_FILE_RENAME."),
+        make_option("--skip-blobs", action="store_false", dest="blobs", default=True,
+                    help="Don't collect large objects."),
+        make_option("--skip-files", action="store_false", dest="files", default=True,
+                    help="Don't collect files."),
+        make_option("--database", dest="database", default="default",
+                    help="Database to collect large objects from."),
+    )
+
+    def handle(self, *args, **options):
+        self.options = options
+        self.verbosity = int(options["verbosity"])
+        self.dry_run = options["dry_run"]
+        action = "Would remove" if self.dry_run else "Removed"
+
+        if options["blobs"]:
+            if connections[options["database"]].vendor == "postgresql":
+                count = self.collect_large_objects()
+                self.stdout.write("%s %d orphaned large object(s).\n" % (action, count))
+            elif self.verbosity > 1:
+                self.stdout.write("Skipping large objects, not a PostgreSQL database.\n")
+        if options["files"]:
+            count, size = self.collect_files()
+            self.stdout.write("%s %d orphaned file(s), %d bytes.\n" % (action, count, size))
+        count = self.collect_upload_sessions()
+        self.stdout.write("%s %d stale upload session(s) and spool file(s).\n" % (action, count))
+
+    def collect_large_objects(self):
+        using = self.options["database"]
+        batch_size = self.options["batch_size"]
+        cursor = connections[using].cursor()
+        first_seen = self.load_large_object_state()
+        now = time.time()
+        cutoff = now - self.options["min_age"]
+        orphans = {}
+        total, last_oid = 0, 0
+        while True:
+            cursor.execute("select m.oid from pg_largeobject_metadata m "
+                           "where m.oid > %s and not exists "
+                           "(select 1 from files_attachment a where a.blob = m.oid) "
+                           "order by m.oid limit %s", (last_oid, batch_size))
+            oids = [row[0] for row in cursor.fetchall()]
+            if not oids:
+                break
+            last_oid = oids[-1]
+            expired = []
+            for oid in oids:
+                orphans[oid] = first_seen.get(oid, now)
+                if orphans[oid] <= cutoff:
+                    expired.append(oid)
+            if expired and not self.dry_run:
+                # Check the references once more, as an attachment may
+                # have been linked to the large object since.
+                cursor.execute("select lo_unlink(o) from unnest(%s::oid[]) as o where not exists "
+                               "(select 1 from files_attachment a where a.blob = o)", (expired, ))
+                transaction.commit_unless_managed(using=using)
+                for oid in expired:
+                    del orphans[oid]
+            total += len(expired)
+            self.progress("large objects", total)
+            self.pause()
+        if not self.dry_run:
+            self.save_large_object_state(orphans)
+        return total
+
+    def load_large_object_state(self):
+        """
+        Return a dict of oid -> time the large object was first seen orphaned.
+        """
+        try:
+            with open(os.path.join(get_spool_dir(), LARGE_OBJECT_STATE), "rb") as f:
+                return dict((int(oid), seen) for oid, seen in json.load(f).items())
+        except (IOError, ValueError):
+            return {}
+
+    def save_large_object_state(self, orphans):
+        path = os.path.join(get_spool_dir(), LARGE_OBJECT_STATE)
+        with open(path + ".tmp", "wb") as f:
+            json.dump(orphans, f)
+        os.rename(path + ".tmp", path)
+
+    def collect_files(self):
+        storage = FileSystemStorage()
+        prefix = getattr(settings, "FILE_STORAGE_PREFIX", "attachments")
+        root = os.path.join(storage.location, prefix)
+        postfix = getattr(settings, "FORCE_FILE_RENAME_POSTFIX", "_removed")
+        cutoff = time.time() - self.options["min_age"]
+
+        total, size, batch = 0, 0, []
+        for dirpath, dirnames, filenames in os.walk(root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                if filename.endswith(postfix) and not self.options["removed"]:
+                    continue
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                if stat.st_mtime > cutoff:
+                    continue
+                name = os.path.relpath(path, storage.location).replace(os.sep, "/")
+                base = is_sibling(path)
+                if base is not None:
+                    base = os.path.relpath(base, storage.location).replace(os.sep, "/")
+                batch.append((name, base, path, stat.st_size))
+                if len(batch) >= self.options["batch_size"]:
+                    count, nbytes = self.collect_file_batch(storage, batch)
+                    total, size, batch = total + count, size + nbytes, []
+                    self.progress("files", total)
+                    self.pause()
+        if batch:
+            count, nbytes = self.collect_file_batch(storage, batch)
+            total, size = total + count, size + nbytes
+        return total, size
+
+    def collect_file_batch(self, storage, batch):
+        names = [name for name, base, path, nbytes in batch]
+        names.extend(base for name, base, path, nbytes in batch if base is not None)
+        referenced = set(Attachment.objects.using(self.options["database"])
+                         .filter(attachment__in=names, backend="FileSystemStorage")
+                         .values_list("attachment", flat=True))
+        count, size = 0, 0
+        for name, base, path, nbytes in batch:
+            if name in referenced or base in referenced:
+                continue
+            if self.verbosity > 2:
+                self.stdout.write("%s\n" % path)
+            if not self.dry_run:
+                storage.delete(name)
+            count += 1
+            size += nbytes
+        return count, size
+
+    def collect_upload_sessions(self):
+        using = self.options["database"]
+        cutoff = timezone.now() - datetime.timedelta(seconds=self.options["min_age"])
+        sessions = UploadSession.objects.using(using).filter(modified__lt=cutoff)
+        count = 0
+        for session in sessions.iterator():
+            if not self.dry_run:
+                remove_spool(session.spool)
+                session.delete()
+            count += 1
+
+        # Spool files are referenced either by an upload session
+        # or by a job which has not yet been processed.
+        spool_dir = get_spool_dir()
+        spool_cutoff = time.time() - self.options["min_age"]
+        spooled = set(UploadSession.objects.using(using).values_list("spool", flat=True))
+        spooled.update(AttachmentJob.objects.using(using)
+                       .exclude(status__in=(AttachmentJob.DONE, AttachmentJob.FAILED))
+                       .values_list("spool", flat=True))
+        for filename in os.listdir(spool_dir):
+            if filename == LARGE_OBJECT_STATE:
+                continue
+            path = os.path.join(spool_dir, filename)
+            try:
+                if path in spooled or os.stat(path).st_mtime > spool_cutoff:
+                    continue
+            except OSError:
+                continue
+            if not self.dry_run:
+                remove_spool(path)
+            count += 1
+        return count
+
+    def progress(self, what, count):
+        if self.verbosity > 1:
+            self.stdout.write("... %d %s\n" % (count, what))
+
+    def pause(self):
+        if self.options["sleep"]:
+            time.sleep(self.options["sleep"])
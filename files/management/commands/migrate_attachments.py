@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+
+import os
+import uuid
+import time
+import hashlib
+import multiprocessing
+from optparse import make_option
+from django.db import transaction
+from django.core.management.base import BaseCommand, CommandError
+
+from files import counters
+from files.utils import close_connections
+from files.models import Attachment, STATUS_READY
+from files.storage import BACKEND_STORAGES, DatabaseStorage, get_backend_storage, read_chunks
+from files.uploads import SpooledUploadedFile
+from files.pipeline import get_spool_dir, remove_spool
+
+MIGRATED = "migrated"
+SKIPPED = "skipped"
+FAILED = "failed"
+
+
+class MigrationError(Exception):
+    pass
+
+
+def copy_to_spool(storage, attachment):
+    """
+    Stream the file from the storage to the spool directory, and
+    return the path and md5 checksum of the copy. The file is read
+    as stored rather than with stream(), which verifies it (and may
+    copy it to a temporary file) itself; the caller compares the
+    checksum of the copy instead.
+    """
+    path = os.path.join(get_spool_dir(), uuid.uuid4().hex)
+    md5 = hashlib.md5()
+    with open(path, "wb") as f:
+        for chunk in read_chunks(storage, attachment):
+            md5.update(chunk)
+            f.write(chunk)
+    return path, md5.hexdigest()
+
+
+def migrate_attachment(args):
+    """
+    Copy the file of one attachment from the source to the target
+    backend, and switch the backend of the attachment. Returns (pk, result).
+    Runs in the worker processes, so it must be a module level function.
+    """
+    pk, source_name, target_name, using, delete_source = args
+    try:
+        attachment = Attachment.objects.using(using).defer("blob", "data").get(pk=pk, backend=source_name)
+    except Attachment.DoesNotExist:
+        return pk, SKIPPED
+    source = get_backend_storage(source_name, using)
+    target = get_backend_storage(target_name, using)
+
+    # Load the id of the large object (if any) before it is cleared below.
+    unlink = hasattr(source, "_unlink_binary") and attachment.blob is not None
+
+    path = None
+    try:
+        path, checksum = copy_to_spool(source, attachment)
+        if checksum != attachment.checksum:
+            raise MigrationError("Checksum mismatch in %s storage." % source_name)
+        content = SpooledUploadedFile(path, attachment.filename, attachment.mimetype,
+                                      attachment.size, checksum)
+
+        with transaction.commit_on_success(using=using):
+            name = attachment.attachment.name
+            if not isinstance(target, DatabaseStorage):
+                name = target.save(name, content)
+            # Only switch the attachment if it has not been changed
+            # while the file was copied.
+            updated = Attachment.objects.using(using) \
+                .filter(pk=pk, backend=source_name, checksum=checksum) \
+                .update(backend=target_name, attachment=name, blob=None, data=None, encoding="")
+            if not updated:
+                if not isinstance(target, DatabaseStorage):
+                    target.delete(name)
+                return pk, SKIPPED
+            if isinstance(target, DatabaseStorage):
+                attachment.backend = target_name
+                attachment._created = True
+                target._write_binary(attachment, content)
+            if unlink:
+                # Removing large objects is transactional, so this is safe.
+                source._unlink_binary(attachment)
+
+        content.close()
+        if delete_source and not isinstance(source, DatabaseStorage):
+            source.delete(attachment.attachment.name)
+    except Exception, e:
+        return pk, "%s: %s" % (FAILED, e)
+    finally:
+        remove_spool(path)
+    return pk, MIGRATED
+
+
+class Command(BaseCommand):
+    """
+    Move attachments from one storage backend to another, one row
+    at a time, so attachments stay available during the migration.
+    """
+    args = "<source backend> <target backend>"
+    help = "Move attachments between storage backends. Valid backends are %s." % \
+        ", ".join(sorted(BACKEND_STORAGES))
+    option_list = BaseCommand.option_list + (
+        make_option("--workers", type="int", dest="workers", default=4,
+                    help="Number of worker processes. Default is 4."),
+        make_option("--batch-size", type="int", dest="batch_size", default=100,
+                    help="Number of attachments per batch. Default is 100."),
+        make_option("--limit", type="int", dest="limit", default=None,
+                    help="Stop after this many attachments."),
+        make_option("--delete-source", action="store_true", dest="delete_source", default=False,
+                    help="Delete files from the FileSystemStorage after they are migrated. "
+                         "Otherwise they are left for cleanup_attachments."),
+        make_option("--database", dest="database", default="default",
+                    help="Database the attachments are stored in."),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 2 or args[0] not in BACKEND_STORAGES or args[1] not in BACKEND_STORAGES:
+            raise CommandError("Usage: migrate_attachments %s. %s" % (self.args, self.help))
+        source, target = args
+        if source == target:
+            raise CommandError("Source and target backends are the same.")
+        using = options["database"]
+        verbosity = int(options["verbosity"])
+        # Make sure both backends are usable before starting.
+        get_backend_storage(source, using), get_backend_storage(target, using)
+
+        queryset = Attachment.objects.using(using).filter(backend=source, status=STATUS_READY)
+        pool = None
+        if options["workers"] > 1:
+            close_connections()
+            pool = multiprocessing.Pool(options["workers"], initializer=close_connections)
+
+        started = time.time()
+        counts = {MIGRATED: 0, SKIPPED: 0, FAILED: 0}
+        last_pk = 0
+        try:
+            while options["limit"] is None or sum(counts.values()) < options["limit"]:
+                batch_size = options["batch_size"]
+                if options["limit"] is not None:
+                    batch_size = min(batch_size, options["limit"] - sum(counts.values()))
+                pks = list(queryset.filter(pk__gt=last_pk).order_by("pk")
+                           .values_list("pk", flat=True)[:batch_size])
+                if not pks:
+                    break
+                tasks = [(pk, source, target, using, options["delete_source"]) for pk in pks]
+                results = pool.map(migrate_attachment, tasks) if pool else map(migrate_attachment, tasks)
+                for pk, result in results:
+                    if result.startswith(FAILED):
+                        counts[FAILED] += 1
+                        self.stderr.write("%s: %s\n" % (pk, result))
+                    else:
+                        counts[result] += 1
+                migrated = [pk for pk, result in results if result == MIGRATED]
+                if migrated and counters.is_enabled():
+                    # The counters are keyed by backend, and the workers
+                    # switch the backend with QuerySet.update().
+                    counters.recount(counters.get_objects(queryset.model.objects.using(using)
+                                                          .filter(pk__in=migrated)), using)
+                last_pk = pks[-1]
+                if verbosity > 1:
+                    self.stdout.write(self.stats(counts, started))
+        finally:
+            if pool:
+                pool.terminate()
+        self.stdout.write(self.stats(counts, started))
+
+    def stats(self, counts, started):
+        elapsed = max(time.time() - started, 0.001)
+        return "%d migrated, %d skipped, %d failed, %.1f files/s\n" % (
+            counts[MIGRATED], counts[SKIPPED], counts[FAILED], counts[MIGRATED] / elapsed)
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand
+
+from files import pipeline
+
+
+class Command(BaseCommand):
+    """
+    Process queued attachment jobs (deferred uploads and other
+    background tasks) using a pool of worker threads.
+    """
+    help = "Process queued attachment jobs."
+    option_list = BaseCommand.option_list + (
+        make_option("--workers", type="int", dest="workers", default=2,
+                    help="Number of worker threads. Default is 2."),
+        make_option("--interval", type="float", dest="interval", default=1.0,
+                    help="Seconds to wait between polling the queue. Default is 1."),
+        make_option("--once", action="store_true", dest="once", default=False,
+                    help="Process pending jobs and exit."),
+        make_option("--database", dest="database", default="default",
+                    help="Database to read the job queue from."),
+    )
+
+    def handle(self, *args, **options):
+        pool = pipeline.WorkerPool(options["workers"])
+        verbosity = int(options["verbosity"])
+        while True:
+            count = pipeline.run_pending(limit=options["workers"] * 10,
+                                         using=options["database"], pool=pool)
+            pool.join()
+            if count and verbosity > 1:
+                self.stdout.write("Processed %d job(s).\n" % count)
+            if options["once"] and not count:
+                break
+            if not count:
+                time.sleep(options["interval"])
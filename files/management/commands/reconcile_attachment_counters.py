@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+
+from optparse import make_option
+from django.core.management.base import BaseCommand
+
+from files import counters, quotas
+
+
+class Command(BaseCommand):
+    """
+    Recount the attachments of every object, and correct the attachment
+    counters (see `files.counters`) which are missing or wrong, and the
+    usage ledger (see `files.quotas`) if quotas are enabled.
+    """
+    help = "Recount the attachments of every object and correct the attachment counters."
+    option_list = BaseCommand.option_list + (
+        make_option("--database", dest="database", default="default",
+                    help="The database to reconcile the counters of. Default is 'default'."),
+        make_option("--dry-run", action="store_true", dest="dry_run", default=False,
+                    help="Report the wrong counters without correcting them."),
+    )
+
+    def handle(self, *args, **options):
+        action = "Would correct" if options["dry_run"] else "Corrected"
+        fixed, created, removed = counters.reconcile(using=options["database"], dry_run=options["dry_run"])
+        if int(options["verbosity"]) > 0:
+            self.stdout.write("%s %d wrong, %d missing and %d stale counters.\n" %
+                              (action, fixed, created, removed))
+        if quotas.is_enabled():
+            fixed, created, removed = quotas.reconcile(using=options["database"], dry_run=options["dry_run"])
+            if int(options["verbosity"]) > 0:
+                self.stdout.write("%s %d wrong, %d missing and %d stale usage entries.\n" %
+                                  (action, fixed, created, removed))
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import hashlib
+import multiprocessing
+from optparse import make_option
+from django.db import IntegrityError
+from django.core.files.storage import get_storage_class
+from django.core.management.base import BaseCommand
+
+from files.utils import close_connections
+from files.models import Attachment, STATUS_READY
+from files.storage import get_attachment_storage, read_chunks
+
+OK = "ok"
+MISMATCH = "mismatch"
+MISSING = "missing"
+
+
+def verify_attachment(pk):
+    """
+    Compute the checksum of the stored file, and compare it with
+    the checksum on the attachment. Returns (pk, size, result).
+    Runs in the worker processes, so it must be a module level function.
+    """
+    try:
+        # The storage backend reads the binary data itself.
+        attachment = Attachment.objects.defer("blob", "data").get(pk=pk)
+    except Attachment.DoesNotExist:
+        # Deleted since the batch was read.
+        return pk, 0, OK
+    storage = get_attachment_storage(attachment)
+    md5 = hashlib.md5()
+    try:
+        # Read the data as stored, rather than with stream(), which
+        # verifies the checksum (and may copy the file) itself.
+        for chunk in read_chunks(storage, attachment):
+            md5.update(chunk)
+    except IntegrityError:
+        # Backends without a raw read path verify the checksum in open().
+        return pk, attachment.size, MISMATCH
+    except Exception:
+        # Missing files raise IOError/OSError, while missing large
+        # objects raise the errors of the database driver directly.
+        return pk, attachment.size, MISSING
+    if md5.hexdigest() != attachment.checksum:
+        return pk, attachment.size, MISMATCH
+    return pk, attachment.size, OK
+
+
+class Command(BaseCommand):
+    """
+    Verify the checksum of every attachment stored in the current
+    storage backend (or in any backend, if the RoutingStorage is used),
+    reporting mismatches and missing binary data.
+    """
+    help = "Verify the checksums of all attachments."
+    option_list = BaseCommand.option_list + (
+        make_option("--workers", type="int", dest="workers", default=multiprocessing.cpu_count(),
+                    help="Number of worker processes. Default is the number of CPUs. "
+                         "Use 1 to verify in the current process."),
+        make_option("--batch-size", type="int", dest="batch_size", default=500,
+                    help="Number of attachments per batch. Default is 500."),
+        make_option("--checkpoint", dest="checkpoint", default=None,
+                    help="File to store the progress in. If the file exists, "
+                         "verification resumes where it left off."),
+        make_option("--report", dest="report", default=None,
+                    help="Append mismatches and missing files to this file."),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options["verbosity"])
+        batch_size = options["batch_size"]
+        checkpoint = options["checkpoint"]
+        last_pk = self.read_checkpoint(checkpoint)
+
+        queryset = Attachment.objects.filter(status=STATUS_READY)
+        engine = get_storage_class()
+        if not getattr(engine, "is_routing", False):
+            queryset = queryset.filter(backend=engine.__name__)
+        pool = None
+        if options["workers"] > 1:
+            # Don't share the database connection with the worker processes.
+            close_connections()
+            pool = multiprocessing.Pool(options["workers"], initializer=close_connections)
+        report = open(options["report"], "a") if options["report"] else None
+
+        started = time.time()
+        counts = {OK: 0, MISMATCH: 0, MISSING: 0}
+        nbytes = 0
+        try:
+            while True:
+                pks = list(queryset.filter(pk__gt=last_pk).order_by("pk")
+                           .values_list("pk", flat=True)[:batch_size])
+                if not pks:
+                    break
+                results = pool.map(verify_attachment, pks) if pool else map(verify_attachment, pks)
+                for pk, size, result in results:
+                    counts[result] += 1
+                    nbytes += size
+                    if result != OK:
+                        line = "%s %s\n" % (result, pk)
+                        self.stderr.write(line)
+                        if report:
+                            report.write(line)
+                last_pk = pks[-1]
+                self.write_checkpoint(checkpoint, last_pk)
+                if verbosity > 1:
+                    self.stdout.write(self.stats(counts, nbytes, started))
+        finally:
+            if pool:
+                pool.terminate()
+            if report:
+                report.close()
+        self.stdout.write(self.stats(counts, nbytes, started))
+
+    def stats(self, counts, nbytes, started):
+        elapsed = max(time.time() - started, 0.001)
+        total = sum(counts.values())
+        return "%d verified, %d mismatch, %d missing, %.1f files/s, %.1f MB/s\n" % (
+            total, counts[MISMATCH], counts[MISSING], total / elapsed, nbytes / elapsed / 1048576)
+
+    def read_checkpoint(self, path):
+        if path and os.path.exists(path):
+            with open(path) as f:
+                return int(f.read().strip() or 0)
+        return 0
+
+    def write_checkpoint(self, path, pk):
+        if path:
+            with open(path + ".tmp", "w") as f:
+                f.write("%d\n" % pk)
+            os.rename(path + ".tmp", path)
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+#
+# Instrumentation of the attachment subsystem.
+#
+# Timings and counters are recorded around the storage backends, hashing,
+# downloads and template tags, and handed to the backends listed in
+# settings.ATTACHMENT_METRICS_BACKENDS:
+#
+#     ATTACHMENT_METRICS_BACKENDS = (
+#         "files.metrics.MemoryBackend",    # exported by AttachmentMetricsView
+#         "files.metrics.StatsdBackend",
+#     )
+#
+# Without any backends (the default), recording is a no-op.
+#
+
+import time
+import socket
+import threading
+from contextlib import contextmanager
+from django.conf import settings
+from django.utils.importlib import import_module
+
+TIMER = "timer"
+COUNTER = "counter"
+
+
+class MemoryBackend(object):
+    """
+    Aggregates the metrics in memory, per process, and exports them
+    in the Prometheus text format.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timers = {}
+        self.counters = {}
+
+    def record(self, kind, name, value, labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if kind == TIMER:
+                count, total, maximum = self.timers.get(key, (0, 0.0, 0.0))
+                self.timers[key] = (count + 1, total + value, max(maximum, value))
+            else:
+                self.counters[key] = self.counters.get(key, 0) + value
+
+    def reset(self):
+        with self.lock:
+            self.timers.clear()
+            self.counters.clear()
+
+    def export(self):
+        """
+        Return the metrics in the Prometheus text exposition format.
+        Counters are exported as counters, timers as a summary (count
+        and sum) and a separate gauge with the maximum.
+        """
+        with self.lock:
+            timers, counters = dict(self.timers), dict(self.counters)
+        lines = []
+        for name, samples in group_by_name(counters):
+            metric = "files_%s_total" % name.replace(".", "_")
+            lines.append("# TYPE %s counter" % metric)
+            for labels, value in samples:
+                lines.append("%s%s %s" % (metric, format_labels(labels), value))
+        for name, samples in group_by_name(timers):
+            metric = "files_%s_seconds" % name.replace(".", "_")
+            lines.append("# TYPE %s summary" % metric)
+            for labels, (count, total, maximum) in samples:
+                lines.append("%s_count%s %d" % (metric, format_labels(labels), count))
+                lines.append("%s_sum%s %.6f" % (metric, format_labels(labels), total))
+            metric = "files_%s_max_seconds" % name.replace(".", "_")
+            lines.append("# TYPE %s gauge" % metric)
+            for labels, (count, total, maximum) in samples:
+                lines.append("%s%s %.6f" % (metric, format_labels(labels), maximum))
+        return "\n".join(lines) + "\n"
+
+
+def group_by_name(metrics):
+    """
+    Return [(name, [(labels, value), ...]), ...] sorted by name and labels,
+    as the samples of a metric must follow its TYPE line.
+    """
+    groups = {}
+    for (name, labels), value in metrics.items():
+        groups.setdefault(name, []).append((labels, value))
+    return [(name, sorted(groups[name])) for name in sorted(groups)]
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+                             for k, v in labels)
+
+
+class StatsdBackend(object):
+    """
+    Sends the metrics to a statsd server over UDP. Configured with
+    ATTACHMENT_STATSD_HOST, ATTACHMENT_STATSD_PORT and ATTACHMENT_STATSD_PREFIX.
+    Label values are appended to the metric name.
+    """
+    def __init__(self):
+        self.address = (getattr(settings, "ATTACHMENT_STATSD_HOST", "localhost"),
+                        getattr(settings, "ATTACHMENT_STATSD_PORT", 8125))
+        self.prefix = getattr(settings, "ATTACHMENT_STATSD_PREFIX", "files")
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def record(self, kind, name, value, labels):
+        parts = [self.prefix, name] + [str(v) for k, v in sorted(labels.items())]
+        if kind == TIMER:
+            data = "%s:%d|ms" % (".".join(parts), value * 1000)
+        else:
+            data = "%s:%d|c" % (".".join(parts), value)
+        try:
+            self.socket.sendto(data, self.address)
+        except socket.error:
+            # Metrics must never break the request.
+            pass
+
+
+_backends = None
+_backends_setting = None
+_backends_lock = threading.Lock()
+
+
+def get_backends():
+    global _backends, _backends_setting
+    paths = tuple(getattr(settings, "ATTACHMENT_METRICS_BACKENDS", ()))
+    if paths != _backends_setting:
+        with _backends_lock:
+            backends = []
+            for path in paths:
+                module, name = path.rsplit(".", 1)
+                backends.append(getattr(import_module(module), name)())
+            _backends, _backends_setting = backends, paths
+    return _backends
+
+
+def get_backend(cls):
+    """
+    Return the configured backend of the given class, or None.
+    """
+    for backend in get_backends():
+        if isinstance(backend, cls):
+            return backend
+    return None
+
+
+def record(kind, name, value, **labels):
+    for backend in get_backends():
+        backend.record(kind, name, value, labels)
+
+
+def incr(name, value=1, **labels):
+    """
+    Increment the counter name by value.
+    """
+    if get_backends():
+        record(COUNTER, name, value, **labels)
+
+
+def timing(name, seconds, **labels):
+    if get_backends():
+        record(TIMER, name, seconds, **labels)
+
+
+@contextmanager
+def timer(name, **labels):
+    """
+    Time the block of the with statement.
+    """
+    if not get_backends():
+        yield
+        return
+    started = time.time()
+    try:
+        yield
+    finally:
+        record(TIMER, name, time.time() - started, **labels)
+
+
+def timed(name, **labels):
+    """
+    Decorator which times each call of the function.
+    """
+    def decorator(func):
+        def wrapper(*args, **kwargs):
+            with timer(name, **labels):
+                return func(*args, **kwargs)
+        wrapper.__name__, wrapper.__doc__ = func.__name__, func.__doc__
+        return wrapper
+    return decorator
+
+
+def count_chunks(chunks, name, **labels):
+    """
+    Pass through an iterator of chunks, counting the bytes in
+    the counter name, and the time until the iterator is exhausted.
+    """
+    if not get_backends():
+        for chunk in chunks:
+            yield chunk
+        return
+    started, nbytes = time.time(), 0
+    try:
+        for chunk in chunks:
+            nbytes += len(chunk)
+            yield chunk
+    finally:
+        record(TIMER, name, time.time() - started, **labels)
+        record(COUNTER, name + ".bytes", nbytes, **labels)
@@ -2,6 +2,7 @@
 
 import os
 import re
+import uuid
 import errno
 from django.db import models
 from django.db.models import signals
@@ -11,11 +12,13 @@ from django.contrib.auth.models import User
 from django.contrib.contenttypes import generic
 from django.contrib.sites.models import Site
 from django.contrib.contenttypes.models import ContentType
+from django.utils.encoding import smart_unicode
 from django.utils.translation import ugettext_lazy as _
 from django.template.defaultfilters import slugify
-from django.core.files.storage import get_storage_class
+from django.core.files.storage import get_storage_class, FileSystemStorage
 
-from files.utils import md5buffer
+from files.utils import md5buffer, checksum
+from files.compression import remove_precompressed
 from files.signals import write_binary, unlink_binary, post_write, post_unlink
 from django.core.exceptions import ValidationError
 
@@ -35,6 +38,28 @@ class UnsupportedBackend(Exception):
     pass
 
 
+# Processing states for attachments. Attachments are "ready" as soon as
+# they are saved, unless settings.ATTACHMENT_DEFERRED_PROCESSING is enabled,
+# in which case they are "processing" until a worker has written the binary
+# data and computed the checksum.
+STATUS_PROCESSING = "processing"
+STATUS_READY = "ready"
+STATUS_FAILED = "failed"
+STATUS_CHOICES = (
+    (STATUS_PROCESSING, _("Processing")),
+    (STATUS_READY, _("Ready")),
+    (STATUS_FAILED, _("Failed")),
+)
+
+# Prefix of the placeholder slug of attachments which are inserted, but not
+# yet saved with their real slug. Real slugs are made by slugify, which never
+# returns a "~".
+SLUG_PLACEHOLDER_PREFIX = "~"
+
+DATABASE_BACKENDS = ["PostgreSQLStorage", "PostgreSQLInlineStorage", "MySQLStorage",
+                     "SQLiteStorage", "OracleStorage"]
+
+
 class BlobField(models.Field):
     """
     Represents a Binary Large Object field in the database.
@@ -59,13 +84,48 @@ class BlobField(models.Field):
         return vendor_blob_name[connection.vendor]
 
 
+class InlineBlobField(models.Field):
+    """
+    Represents binary data stored inline in the row. Unlike the
+    BlobField, which refers to a large object on PostgreSQL, the
+    data is read along with the row.
+    """
+
+    description = _("Inline binary data field")
+    
+    def get_internal_type(self):
+        return "InlineBlobField"
+
+    def db_type(self, connection):
+        vendor_blob_name = {
+            "sqlite": "blob",
+            "mysql": "longblob",
+            "oracle": "blob",
+            "postgresql": "bytea"
+        }
+        return vendor_blob_name[connection.vendor]
+
+
 class AttachmentManager(models.Manager):
     """
     Manager for attachments
     """
+    def bulk_delete(self, queryset=None, batch_size=1000, workers=4, progress=None):
+        """
+        Delete the attachments of the queryset (default is all attachments)
+        in batches, unlinking the binary data of each batch at once rather
+        than in the delete signals of each attachment. See `files.bulk`.
+        Returns the number of deleted attachments.
+        """
+        from files import bulk
+        if queryset is None:
+            queryset = self.get_query_set()
+        return bulk.delete(queryset, batch_size, workers, progress)
+
     def attachments_for_object(self, obj):
-        object_type = ContentType.objects.get_for_models(obj)
-        return self.get_query_set().filter(content_type__pk=object_type.pk, object_id=obj.pk)
+        object_type = ContentType.objects.get_for_model(obj)
+        return self.get_query_set().filter(content_type__pk=object_type.pk,
+                                           object_id=smart_unicode(obj._get_pk_val()))
         
 
 class BaseAttachmentAbstractModel(models.Model):
@@ -77,7 +137,11 @@ class BaseAttachmentAbstractModel(models.Model):
     # Content object fields
     content_type = models.ForeignKey(ContentType, verbose_name=_("content type"),
                     related_name="content_type_set_for_%(class)s")
-    object_id = models.PositiveIntegerField()
+    # Stored as text, so objects with integer, UUID and string primary
+    # keys can all be attached to. Lookups should always pass the pk as
+    # unicode (see AttachmentManager.attachments_for_object), which keeps
+    # the comparison on the indexed column free of casts.
+    object_id = models.CharField(_("object ID"), max_length=255)
     content_object = generic.GenericForeignKey("content_type", "object_id")
 
     # Some metadata fields
@@ -101,6 +165,7 @@ class Attachment(BaseAttachmentAbstractModel):
     description = models.CharField(_("description"), max_length=100, blank=True, null=True)
     attachment = models.FileField(_("attachment"), upload_to=get_upload_to, db_index=True)
     blob = BlobField(_("binary data"), blank=True, null=True, editable=False)
+    data = InlineBlobField(_("inline binary data"), blank=True, null=True, editable=False)
     backend = models.CharField(max_length=100, editable=False,
                                default=lambda: str(get_storage_class().__name__))
     
@@ -109,12 +174,23 @@ class Attachment(BaseAttachmentAbstractModel):
     slug = models.SlugField(max_length=100, unique=True, blank=True, editable=False)
     size = models.PositiveIntegerField(_("file size"), blank=True, editable=False)
     checksum = models.CharField(_("md5 checksum"), max_length=32, blank=True, editable=False)
+    status = models.CharField(_("status"), max_length=20, choices=STATUS_CHOICES,
+                              default=STATUS_READY, editable=False, db_index=True)
+    # Compression of the stored binary data (see files.compression).
+    # The size and checksum are always those of the uncompressed file.
+    encoding = models.CharField(_("encoding"), max_length=20, blank=True, default="", editable=False)
     
     # Manager
     objects = AttachmentManager()
     
     class Meta:
-        ordering = ("created", "modified")
+        ordering = ("created", "id")
+        # Matches the lookup done by the template tags, and the default
+        # ordering. See the sql/ directory for the partial index used
+        # when listing public attachments.
+        index_together = [
+            ("content_type", "object_id", "site", "created", "id"),
+        ]
         permissions = (
             ("can_moderate", "Can moderate attachments"),
             ("delete_all_attachment", "Can delete all attachments"),
@@ -145,8 +221,30 @@ class Attachment(BaseAttachmentAbstractModel):
         If backend is any of the provided database backends,
         emit the `write_binary` signal to write the file to
         the blob field.
+        If settings.ATTACHMENT_DEFERRED_PROCESSING is True, new
+        uploads are handed over to the job queue instead.
         """
-        if self.backend in ["PostgreSQLStorage", "MySQLStorage", "SQLiteStorage", "OracleStorage"]:
+        storage = self.attachment.storage
+        if hasattr(storage, "get_backend_name") and not self.attachment._committed:
+            # The storage (i.e. the RoutingStorage) decides which
+            # backend new content is written to.
+            self.backend = storage.get_backend_name(self.attachment.file)
+        if self.backend not in DATABASE_BACKENDS and self.backend != "FileSystemStorage":
+            raise UnsupportedBackend("Unsupported storage backend.")
+        if not self.pk and not self.slug:
+            # The slug includes the primary key, so it is set after the
+            # row is inserted. Until then use a unique placeholder, as
+            # concurrent inserts with an empty slug violate the unique index.
+            self.slug = SLUG_PLACEHOLDER_PREFIX + uuid.uuid4().hex
+        
+        deferred = getattr(settings, "ATTACHMENT_DEFERRED_PROCESSING", False)
+        if deferred is True and not self.attachment._committed and \
+                not hasattr(self.attachment.file, "oid"):
+            # Files which are already written to a large object by the
+            # StreamingBlobUploadHandler are not worth deferring.
+            return self._save_deferred(*args, **kwargs)
+        
+        if self.backend in DATABASE_BACKENDS:
             # If using one of the included database backends,
             # save the instance and emit the `write_binary` signal
             # to write the binary data into the blob field.
@@ -156,21 +254,55 @@ class Attachment(BaseAttachmentAbstractModel):
                 write_binary.send(sender=Attachment, instance=self, content=content)
             except Exception, e:
                 raise e
-        elif self.backend == "FileSystemStorage":
+        else:
             # If using the default FileSystemStorage,
             # save some extra attributes as well.
+            content = self.attachment.file
             if not self.pk:
                 super(Attachment, self).save(*args, **kwargs)
             self.slug = slugify(self.pre_slug)
-            self.checksum = md5buffer(self.attachment.file)
+            self.checksum = checksum(content)
             super(Attachment, self).save(force_update=True)
-        else:
-            raise UnsupportedBackend("Unsupported storage backend.")
         # Send the post_write signal after save even if backend does not
         # use the write_binary method (such as the FileStorageBackend), to
         # keep consistancy between all backends.
         post_write.send(sender=Attachment, instance=self)
     
+    def _save_deferred(self, *args, **kwargs):
+        """
+        Save the attachment metadata only, and queue a job which
+        computes the checksum, writes the binary data and sends
+        the `post_write` signal off the request path.
+        """
+        from files import pipeline
+        
+        content = self.attachment.file
+        self.status = STATUS_PROCESSING
+        super(Attachment, self).save(*args, **kwargs)
+        spool = None
+        if self.backend in DATABASE_BACKENDS:
+            # The uploaded file is removed when the request finishes,
+            # so keep it around in the spool directory until the
+            # worker has written it to the database. This is done once
+            # the row is saved, so the file is left in place if saving
+            # fails (i.e. with QuotaExceeded).
+            spool = pipeline.spool(content)
+        self.slug = slugify(self.pre_slug)
+        Attachment.objects.using(self._state.db).filter(pk=self.pk).update(slug=self.slug)
+        pipeline.enqueue(self, pipeline.TASK_PROCESS_UPLOAD, spool=spool)
+    
+    @property
+    def is_ready(self):
+        return self.status == STATUS_READY
+    
+    @property
+    def has_slug(self):
+        """
+        False until the real slug is set, i.e. while the slug is empty
+        or the placeholder set by save().
+        """
+        return bool(self.slug) and not self.slug.startswith(SLUG_PLACEHOLDER_PREFIX)
+    
     @property
     def pre_slug(self):
         """
@@ -193,6 +325,174 @@ class Attachment(BaseAttachmentAbstractModel):
         return md5buffer(self.attachment.file) == self.checksum
 
 
+class AttachmentJob(models.Model):
+    """
+    A unit of work in the local job queue, processed by
+    the worker pool in `files.pipeline`.
+    """
+    
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    STATUS_CHOICES = (
+        (PENDING, _("Pending")),
+        (RUNNING, _("Running")),
+        (DONE, _("Done")),
+        (FAILED, _("Failed")),
+    )
+    
+    attachment = models.ForeignKey(Attachment, related_name="jobs", blank=True, null=True)
+    task = models.CharField(_("task"), max_length=50)
+    status = models.CharField(_("status"), max_length=20, choices=STATUS_CHOICES,
+                              default=PENDING, db_index=True)
+    spool = models.CharField(_("spool file"), max_length=255, blank=True)
+    attempts = models.PositiveIntegerField(_("attempts"), default=0)
+    progress = models.PositiveIntegerField(_("progress"), default=0)
+    total = models.PositiveIntegerField(_("total"), default=0)
+    error = models.TextField(_("error"), blank=True)
+    created = models.DateTimeField(_("date/time created"), auto_now_add=True)
+    modified = models.DateTimeField(_("date/time modified"), auto_now=True)
+    
+    class Meta:
+        ordering = ("created", )
+    
+    def __unicode__(self):
+        return u"%s (%s)" % (self.task, self.status)
+
+
+class AttachmentCounter(models.Model):
+    """
+    The number and total size of the attachments of an object, kept up to
+    date by `files.counters` if settings.ATTACHMENT_COUNTERS is True, so
+    counting the attachments of an object does not have to count the rows.
+    """
+    
+    content_type = models.ForeignKey(ContentType, related_name="attachment_counters")
+    object_id = models.CharField(max_length=255)
+    site = models.ForeignKey(Site)
+    backend = models.CharField(max_length=100)
+    count = models.IntegerField(default=0)
+    size = models.BigIntegerField(default=0)
+    public_count = models.IntegerField(default=0)
+    public_size = models.BigIntegerField(default=0)
+    
+    class Meta:
+        unique_together = (("content_type", "object_id", "site", "backend"), )
+    
+    def __unicode__(self):
+        return u"%d attachments of %s %s" % (self.count, self.content_type_id, self.object_id)
+
+
+class AttachmentUsage(models.Model):
+    """
+    The number and total size of the attachments created by a user
+    (scope "user", the object is the user) or attached to an object
+    (scope "object"), kept up to date by `files.quotas` if
+    settings.ATTACHMENT_QUOTAS is True.
+    """
+    
+    USER = "user"
+    OBJECT = "object"
+    
+    scope = models.CharField(max_length=10)
+    content_type = models.ForeignKey(ContentType, related_name="attachment_usage")
+    object_id = models.CharField(max_length=255)
+    count = models.IntegerField(default=0)
+    size = models.BigIntegerField(default=0)
+    
+    class Meta:
+        unique_together = (("scope", "content_type", "object_id"), )
+    
+    def __unicode__(self):
+        return u"%d attachments (%d bytes) of %s %s" % (self.count, self.size, self.scope, self.object_id)
+
+
+def get_derivative_upload_to(instance, filename):
+    """
+    Derivatives are stored outside FILE_STORAGE_PREFIX, so they
+    are not mistaken for orphaned attachments.
+    """
+    prefix = getattr(settings, "ATTACHMENT_DERIVATIVE_PREFIX", "derivatives")
+    return u"/".join(map(unicode, (prefix, instance.attachment_id, filename)))
+
+
+class AttachmentDerivative(models.Model):
+    """
+    A thumbnail or preview generated from an attachment (see
+    `files.derivatives`). Derivatives are keyed by the checksum of
+    the original, so a changed file gets new derivatives.
+    
+    Derivatives of attachments in the FileSystemStorage are stored
+    as files, while those of attachments stored in the database are
+    stored inline in the row.
+    """
+    
+    attachment = models.ForeignKey(Attachment, related_name="derivatives")
+    spec = models.CharField(_("specification"), max_length=50)
+    checksum = models.CharField(_("md5 checksum of the original"), max_length=32)
+    file = models.FileField(_("file"), upload_to=get_derivative_upload_to, storage=FileSystemStorage(),
+                            max_length=255, blank=True)
+    data = InlineBlobField(_("inline binary data"), blank=True, null=True, editable=False)
+    mimetype = models.CharField(_("mime type"), max_length=50)
+    size = models.PositiveIntegerField(_("file size"))
+    width = models.PositiveIntegerField(_("width"))
+    height = models.PositiveIntegerField(_("height"))
+    created = models.DateTimeField(_("date/time created"), auto_now_add=True)
+    
+    class Meta:
+        unique_together = (("attachment", "spec", "checksum"), )
+    
+    def __unicode__(self):
+        return u"%s of %s" % (self.spec, self.attachment_id)
+    
+    def read(self):
+        if self.data is not None:
+            return str(self.data)
+        self.file.open("rb")
+        try:
+            return self.file.read()
+        finally:
+            self.file.close()
+
+
+class UploadSession(models.Model):
+    """
+    A resumable upload in progress. The file is received in
+    chunks (see `files.uploads`), and turned into an Attachment
+    when all chunks have been received.
+    """
+    
+    token = models.CharField(max_length=32, unique=True, editable=False)
+    content_type = models.ForeignKey(ContentType, verbose_name=_("content type"),
+                    related_name="upload_sessions")
+    object_id = models.CharField(_("object ID"), max_length=255)
+    content_object = generic.GenericForeignKey("content_type", "object_id")
+    site = models.ForeignKey(Site, default=Site.objects.get_current)
+    creator = models.ForeignKey(User, related_name="upload_sessions", verbose_name=_("creator"))
+    ip_address = models.IPAddressField(_("IP address"), blank=True, null=True)
+    description = models.CharField(_("description"), max_length=100, blank=True, null=True)
+    is_public = models.BooleanField(_("is public"), default=True)
+    filename = models.CharField(_("file name"), max_length=100)
+    mimetype = models.CharField(_("mime type"), max_length=50, blank=True, null=True)
+    length = models.BigIntegerField(_("upload length"))
+    offset = models.BigIntegerField(_("upload offset"), default=0, editable=False)
+    spool = models.CharField(_("spool file"), max_length=255, editable=False)
+    created = models.DateTimeField(_("date/time created"), auto_now_add=True)
+    modified = models.DateTimeField(_("date/time modified"), auto_now=True)
+    
+    def __unicode__(self):
+        return u"%s (%d of %d bytes)" % (self.filename, self.offset, self.length)
+    
+    @models.permalink
+    def get_absolute_url(self):
+        return ("upload-session", (), {"token": self.token})
+    
+    @property
+    def is_complete(self):
+        return self.offset == self.length
+
+
 #
 # Signals
 #
@@ -206,6 +506,32 @@ def pre_save_callback(sender, instance, **kwargs):
     instance.clean()
 
 
+@receiver(signals.post_init, sender=Attachment)
+def post_init_callback(sender, instance, **kwargs):
+    """
+    Remember what the attachment is counted as, so the counters
+    and the usage ledger can be adjusted when it is changed.
+    """
+    if getattr(settings, "ATTACHMENT_COUNTERS", False) is True:
+        from files import counters
+        counters.remember(instance)
+    if getattr(settings, "ATTACHMENT_QUOTAS", False) is True:
+        from files import quotas
+        quotas.remember(instance)
+
+
+@receiver(signals.pre_save, sender=Attachment)
+def pre_save_quotas_callback(sender, instance, **kwargs):
+    """
+    Add the attachment to the usage of its creator and object,
+    or raise QuotaExceeded if it does not fit in their quotas.
+    Connected after pre_save_callback, which sets the size.
+    """
+    if getattr(settings, "ATTACHMENT_QUOTAS", False) is True:
+        from files import quotas
+        quotas.reserve(instance, kwargs["using"])
+
+
 @receiver(signals.post_save, sender=Attachment)
 def post_save_callback(sender, instance, created, **kwargs):
     """
@@ -216,6 +542,38 @@ def post_save_callback(sender, instance, created, **kwargs):
         instance._created = True
 
 
+@receiver(signals.post_save, sender=Attachment)
+def post_save_counters_callback(sender, instance, created, **kwargs):
+    """
+    Adjust the counters of the object(s) the attachment
+    was and is attached to.
+    """
+    if getattr(settings, "ATTACHMENT_COUNTERS", False) is True:
+        from files import counters
+        counters.saved(instance, created)
+
+
+@receiver(signals.post_delete, sender=AttachmentDerivative)
+def derivative_post_delete_callback(sender, instance, **kwargs):
+    """
+    Derivatives can always be generated again,
+    so their files are removed with the row.
+    """
+    if instance.file:
+        instance.file.storage.delete(instance.file.name)
+
+
+@receiver(post_write, sender=Attachment)
+def post_write_derivatives_callback(sender, instance, **kwargs):
+    """
+    Queue generation of the derivatives of new and changed
+    attachments, if settings.ATTACHMENT_DERIVATIVES_BACKGROUND is True.
+    """
+    if getattr(settings, "ATTACHMENT_DERIVATIVES_BACKGROUND", False) is True:
+        from files import derivatives
+        derivatives.schedule(instance)
+
+
 @receiver(signals.pre_delete, sender=Attachment)
 def pre_delete_callback(sender, instance, **kwargs):
     """
@@ -226,6 +584,19 @@ def pre_delete_callback(sender, instance, **kwargs):
     post_unlink.send(sender=Attachment, instance=instance)
 
 
+@receiver(signals.post_delete, sender=Attachment)
+def post_delete_usage_callback(sender, instance, **kwargs):
+    """
+    Subtract the attachment from the counters and the usage ledger.
+    """
+    if getattr(settings, "ATTACHMENT_COUNTERS", False) is True:
+        from files import counters
+        counters.deleted(instance)
+    if getattr(settings, "ATTACHMENT_QUOTAS", False) is True:
+        from files import quotas
+        quotas.release(instance)
+
+
 @receiver(signals.post_delete, sender=Attachment)
 def post_delete_callback(sender, instance, **kwargs):
     """
@@ -236,18 +607,30 @@ def post_delete_callback(sender, instance, **kwargs):
     removed from the database.
     """
     if instance.backend == "FileSystemStorage":
-        rename = getattr(settings, "FORCE_FILE_RENAME", False)
-        if rename is True:
-            # Rename the file to indicate removal of database reference.
-            # There is a race condition between os.path.exists and os.rename:
-            # If os.rename fails with ENOENT, the file does not exist anymore,
-            # and we continue as usual.
-            name = os.path.join(instance.attachment.storage.location, instance.attachment.name)
-            if os.path.exists(name):
-                try:
-                    new_name = "".join((name,
-                         getattr(settings, "FORCE_FILE_RENAME_POSTFIX", "_removed")))
-                    os.rename(name, new_name)
-                except OSError, e:
-                    if e.errno != errno.ENOENT:
-                        raise e
+        storage = instance.attachment.storage
+        if not hasattr(storage, "location"):
+            # The RoutingStorage serves files from several backends.
+            storage = FileSystemStorage()
+        release_file(os.path.join(storage.location, instance.attachment.name))
+
+
+def release_file(name):
+    """
+    Remove the precompressed siblings of the file of a deleted attachment,
+    and rename the file if settings.FORCE_FILE_RENAME is True.
+    """
+    # Precompressed siblings can always be created again.
+    remove_precompressed(name)
+    if getattr(settings, "FORCE_FILE_RENAME", False) is True:
+        # Rename the file to indicate removal of database reference.
+        # There is a race condition between os.path.exists and os.rename:
+        # If os.rename fails with ENOENT, the file does not exist anymore,
+        # and we continue as usual.
+        if os.path.exists(name):
+            try:
+                new_name = "".join((name,
+                     getattr(settings, "FORCE_FILE_RENAME_POSTFIX", "_removed")))
+                os.rename(name, new_name)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise e
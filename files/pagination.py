@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+#
+# Keyset pagination of attachment listings.
+#
+# Pages are ordered by (created, id), and each page starts after the last
+# attachment of the previous page (the "cursor"), instead of skipping the
+# rows of the previous pages with OFFSET. Every page is then a range scan
+# of the (content_type, object_id, site, created, id) index, starting at the
+# cursor. The is_public and backend conditions are checked on the rows of
+# the scan, so a page costs about the page size plus the hidden rows in its
+# range, whichever page it is, rather than growing with the number of rows
+# before it. A cursor stays valid while attachments are added or removed.
+#
+
+import base64
+from django.conf import settings
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(attachment):
+    """
+    Return the cursor of the page starting after the attachment.
+    """
+    value = "%s|%d" % (attachment.created.isoformat(), attachment.pk)
+    return base64.urlsafe_b64encode(value).rstrip("=")
+
+
+def decode_cursor(cursor):
+    """
+    Return the (created, pk) of the attachment the cursor points at.
+    """
+    try:
+        value = base64.urlsafe_b64decode(str(cursor) + "=" * (-len(cursor) % 4))
+        created, pk = value.split("|")
+        created, pk = parse_datetime(created), int(pk)
+    except (TypeError, ValueError, UnicodeError):
+        raise InvalidCursor("Invalid cursor %r." % cursor)
+    if created is None:
+        raise InvalidCursor("Invalid cursor %r." % cursor)
+    return created, pk
+
+
+def get_page_size(size=None):
+    """
+    Return the page size, limited to settings.ATTACHMENT_MAX_PAGE_SIZE.
+    """
+    if not size:
+        size = getattr(settings, "ATTACHMENT_PAGE_SIZE", PAGE_SIZE)
+    return max(1, min(int(size), getattr(settings, "ATTACHMENT_MAX_PAGE_SIZE", MAX_PAGE_SIZE)))
+
+
+class Page(object):
+    """
+    A page of attachments. Iterating over the page yields the attachments,
+    and next_cursor is the cursor of the next page (None on the last page).
+    """
+    def __init__(self, object_list, next_cursor):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+def paginate(qs, cursor=None, size=None):
+    """
+    Return the Page of the queryset qs starting after cursor,
+    or the first page if cursor is empty. Raises InvalidCursor.
+    """
+    size = get_page_size(size)
+    qs = qs.order_by("created", "pk")
+    if cursor:
+        created, pk = decode_cursor(cursor)
+        qs = qs.filter(Q(created__gt=created) | Q(created=created, pk__gt=pk))
+    # Fetch one more row than required, to know if there is a next page.
+    rows = list(qs[:size + 1])
+    if len(rows) > size:
+        return Page(rows[:size], encode_cursor(rows[size - 1]))
+    return Page(rows, None)
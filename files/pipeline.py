@@ -0,0 +1,422 @@
+# -*- coding: utf-8 -*-
+#
+# Deferred processing of attachments.
+#
+# Jobs are stored in the AttachmentJob table, which acts as a local job queue,
+# and are processed by a pool of worker threads. Workers run either in the web
+# process (settings.ATTACHMENT_WORKER_THREADS) or in one or more separate
+# processes started with the `process_attachments` management command. Jobs
+# are claimed with an atomic UPDATE, so any number of workers can share the
+# same queue. Running jobs which have not been updated for
+# settings.ATTACHMENT_JOB_TIMEOUT seconds, i.e. jobs of a worker which crashed
+# or was killed, are requeued by `run_pending`.
+#
+
+import os
+import json
+import uuid
+import errno
+import logging
+import datetime
+import itertools
+import tempfile
+import threading
+import traceback
+from Queue import Queue
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import F
+from django.core.files.base import File
+from django.core.signals import request_finished
+from django.utils import timezone
+
+from files import metrics
+from files.compression import get_stale_siblings, get_sibling
+from files.utils import md5buffer
+from files.models import Attachment, AttachmentJob, DATABASE_BACKENDS, \
+    STATUS_READY, STATUS_FAILED
+from files.signals import write_binary, post_write
+
+logger = logging.getLogger("files.pipeline")
+
+TASK_PROCESS_UPLOAD = "process_upload"
+TASK_GENERATE_DERIVATIVES = "generate_derivatives"
+TASK_BULK_UPDATE = "bulk_update"
+TASK_BULK_DELETE = "bulk_delete"
+TASK_PRECOMPRESS = "precompress"
+
+# Number of attachments a bulk job changes between progress updates.
+BULK_BATCH_SIZE = 500
+
+# Registry of task name -> callable(job)
+TASKS = {}
+
+
+def register_task(name):
+    """
+    Decorator which registers a callable as the handler
+    for jobs with the given task name.
+    """
+    def decorator(func):
+        TASKS[name] = func
+        return func
+    return decorator
+
+
+def get_spool_dir():
+    spool_dir = getattr(settings, "ATTACHMENT_SPOOL_DIR", None) or \
+        os.path.join(tempfile.gettempdir(), "django-files")
+    if not os.path.isdir(spool_dir):
+        try:
+            os.makedirs(spool_dir)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise e
+    return spool_dir
+
+
+def spool(content):
+    """
+    Store the uploaded content in the spool directory and
+    return the path. Files which are already on disk (such as
+    the TemporaryUploadedFile) are moved rather than copied.
+    """
+    path = os.path.join(get_spool_dir(), uuid.uuid4().hex)
+    if hasattr(content, "temporary_file_path"):
+        try:
+            os.rename(content.temporary_file_path(), path)
+            return path
+        except OSError:
+            # Probably on another file system, fall back to copying.
+            pass
+    content.seek(0)
+    with open(path, "wb") as f:
+        for chunk in content.chunks():
+            f.write(chunk)
+    content.seek(0)
+    return path
+
+
+def remove_spool(path):
+    if not path:
+        return
+    try:
+        os.remove(path)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise e
+
+
+def enqueue(attachment=None, task=TASK_PROCESS_UPLOAD, spool=None, using=None, total=0):
+    """
+    Add a job to the queue. If the in-process worker pool is enabled,
+    the job is handed to it as soon as the current transaction is committed.
+    """
+    using = using or (attachment._state.db if attachment is not None else None) or "default"
+    job = AttachmentJob.objects.using(using).create(attachment=attachment, task=task,
+                                                    spool=spool or "", total=total)
+    if get_worker_pool() is not None:
+        if transaction.is_managed(using=using):
+            # The job is not visible to the workers before the
+            # transaction is committed. Submit when the request is done.
+            _pending_jobs().append((job.pk, using))
+        else:
+            get_worker_pool().submit(job.pk, using)
+    return job
+
+
+def enqueue_once(attachment, task, using=None):
+    """
+    Add a job for the attachment to the queue, unless a job with the
+    same task is already queued or running for it. Returns the new
+    job, or None.
+    """
+    using = using or attachment._state.db or "default"
+    queued = AttachmentJob.objects.using(using) \
+        .filter(attachment=attachment, task=task,
+                status__in=(AttachmentJob.PENDING, AttachmentJob.RUNNING)).exists()
+    if queued:
+        return None
+    return enqueue(attachment, task, using=using)
+
+
+def enqueue_bulk(queryset, task, values=None):
+    """
+    Add a job changing (TASK_BULK_UPDATE, with the field values) or
+    deleting (TASK_BULK_DELETE) the attachments of the queryset. The
+    primary keys of the attachments are written to a spool file, so the
+    job works on the selection as it is now. The file holds the field
+    values as JSON on the first line, and then one primary key per line,
+    so neither writing nor reading it needs all keys in memory.
+    """
+    path = os.path.join(get_spool_dir(), uuid.uuid4().hex)
+    total = 0
+    with open(path, "wb") as f:
+        f.write(json.dumps(values or {}) + "\n")
+        for pk in queryset.order_by("pk").values_list("pk", flat=True).iterator():
+            f.write("%d\n" % pk)
+            total += 1
+    return enqueue(task=task, spool=path, using=queryset.db, total=total)
+
+
+def claim(job_id, using="default"):
+    """
+    Atomically mark a pending job as running. Returns
+    True if this worker got the job.
+    """
+    claimed = AttachmentJob.objects.using(using) \
+        .filter(pk=job_id, status=AttachmentJob.PENDING) \
+        .update(status=AttachmentJob.RUNNING, attempts=F("attempts") + 1, modified=timezone.now())
+    transaction.commit_unless_managed(using=using)
+    return claimed == 1
+
+
+def run_job(job_id, using="default"):
+    """
+    Claim and run a single job. Failed jobs are retried until
+    settings.ATTACHMENT_JOB_MAX_ATTEMPTS is reached.
+    """
+    if not claim(job_id, using):
+        return False
+    job = AttachmentJob.objects.using(using).get(pk=job_id)
+    try:
+        with metrics.timer("job", task=job.task):
+            TASKS[job.task](job)
+    except Exception:
+        transaction.rollback_unless_managed(using=using)
+        metrics.incr("job.errors", task=job.task)
+        logger.exception("Attachment job %s (%s) failed.", job.pk, job.task)
+        retry_or_fail(job, traceback.format_exc(), using)
+    else:
+        AttachmentJob.objects.using(using).filter(pk=job.pk) \
+            .update(status=AttachmentJob.DONE, modified=timezone.now())
+    transaction.commit_unless_managed(using=using)
+    return True
+
+
+def retry_or_fail(job, error, using="default", **conditions):
+    """
+    Put a job back in the queue, or mark it as failed once it has been
+    attempted settings.ATTACHMENT_JOB_MAX_ATTEMPTS times. The attachment
+    of a failed upload job is marked as failed as well, as it has no
+    binary data. Extra conditions restrict the update of the job row.
+    """
+    max_attempts = getattr(settings, "ATTACHMENT_JOB_MAX_ATTEMPTS", 3)
+    failed = job.attempts >= max_attempts
+    updated = AttachmentJob.objects.using(using).filter(pk=job.pk, **conditions) \
+        .update(status=AttachmentJob.FAILED if failed else AttachmentJob.PENDING,
+                error=error, modified=timezone.now())
+    if updated and failed:
+        if job.task == TASK_PROCESS_UPLOAD and job.attachment_id:
+            Attachment.objects.using(using).filter(pk=job.attachment_id).update(status=STATUS_FAILED)
+        remove_spool(job.spool)
+    return updated == 1
+
+
+def requeue_stale(using="default"):
+    """
+    Requeue (or fail) running jobs which have not been updated for
+    settings.ATTACHMENT_JOB_TIMEOUT seconds. Workers update the job
+    when it is claimed and as a bulk job makes progress, so a stale
+    job belongs to a worker which crashed or was killed.
+    Returns the number of jobs requeued or failed.
+    """
+    timeout = getattr(settings, "ATTACHMENT_JOB_TIMEOUT", 3600)
+    cutoff = timezone.now() - datetime.timedelta(seconds=timeout)
+    count = 0
+    for job in AttachmentJob.objects.using(using).filter(status=AttachmentJob.RUNNING, modified__lt=cutoff):
+        # Only touch the job if the worker has not updated it since.
+        if retry_or_fail(job, "Timed out after %d seconds." % timeout, using,
+                         status=AttachmentJob.RUNNING, modified=job.modified):
+            logger.warning("Attachment job %s (%s) timed out.", job.pk, job.task)
+            metrics.incr("job.timeouts", task=job.task)
+            count += 1
+    transaction.commit_unless_managed(using=using)
+    return count
+
+
+def run_pending(limit=None, using="default", pool=None):
+    """
+    Run (or submit to the given pool) pending jobs in queue order,
+    after requeueing stale jobs. Returns the number of jobs found.
+    """
+    requeue_stale(using)
+    job_ids = AttachmentJob.objects.using(using) \
+        .filter(status=AttachmentJob.PENDING).values_list("pk", flat=True)
+    if limit:
+        job_ids = job_ids[:limit]
+    job_ids = list(job_ids)
+    for job_id in job_ids:
+        if pool is not None:
+            pool.submit(job_id, using)
+        else:
+            run_job(job_id, using)
+    return len(job_ids)
+
+
+@register_task(TASK_PROCESS_UPLOAD)
+def process_upload(job):
+    """
+    Do the work which Attachment.save() does for non-deferred
+    uploads; compute the checksum, write the binary data and
+    emit the `post_write` signal.
+    """
+    using = job._state.db
+    attachment = job.attachment
+    if attachment.backend in DATABASE_BACKENDS:
+        with open(job.spool, "rb") as f:
+            content = File(f, attachment.filename)
+            # Make sure the storage backend writes the binary data
+            # regardless of the current checksum.
+            attachment._created = True
+            write_binary.send(sender=Attachment, instance=attachment, content=content)
+    else:
+        attachment.checksum = md5buffer(attachment.attachment.file)
+        attachment.attachment.close()
+        Attachment.objects.using(using).filter(pk=attachment.pk).update(checksum=attachment.checksum)
+    attachment.status = STATUS_READY
+    Attachment.objects.using(using).filter(pk=attachment.pk).update(status=STATUS_READY)
+    post_write.send(sender=Attachment, instance=attachment)
+    remove_spool(job.spool)
+
+
+@register_task(TASK_GENERATE_DERIVATIVES)
+def generate_derivatives(job):
+    """
+    Generate the thumbnails and previews of an attachment.
+    """
+    from files import derivatives
+    
+    derivatives.generate_all(job.attachment)
+
+
+@register_task(TASK_PRECOMPRESS)
+def precompress(job):
+    """
+    Create the missing or outdated precompressed siblings
+    of a file in the FileSystemStorage.
+    """
+    from files.storage import get_backend_storage
+    
+    path = get_backend_storage("FileSystemStorage").path(job.attachment.attachment.name)
+    for encoding, suffix in get_stale_siblings(path):
+        get_sibling(path, encoding, suffix)
+
+
+def run_bulk(job, func):
+    """
+    Call func(queryset, values) for each batch of the attachments of a
+    bulk job, and record the progress of the job after each batch.
+    """
+    using = job._state.db
+    with open(job.spool, "rb") as f:
+        values = dict((str(name), value) for name, value in json.loads(f.readline()).items())
+        done = 0
+        while True:
+            batch = [int(line) for line in itertools.islice(f, BULK_BATCH_SIZE)]
+            if not batch:
+                break
+            func(Attachment.objects.using(using).filter(pk__in=batch), values)
+            done += len(batch)
+            AttachmentJob.objects.using(using).filter(pk=job.pk) \
+                .update(progress=done, modified=timezone.now())
+            transaction.commit_unless_managed(using=using)
+    remove_spool(job.spool)
+
+
+@register_task(TASK_BULK_UPDATE)
+def bulk_update(job):
+    """
+    Update the attachments selected in the admin.
+    """
+    from files import bulk
+    
+    run_bulk(job, lambda queryset, values: bulk.update(queryset, values, batch_size=BULK_BATCH_SIZE))
+
+
+@register_task(TASK_BULK_DELETE)
+def bulk_delete(job):
+    """
+    Delete the attachments selected in the admin.
+    """
+    from files import bulk
+    
+    run_bulk(job, lambda queryset, values: bulk.delete(queryset, batch_size=BULK_BATCH_SIZE))
+
+
+class WorkerPool(object):
+    """
+    A pool of worker threads processing jobs from an in-memory
+    queue of job ids.
+    """
+    def __init__(self, workers=2):
+        self.queue = Queue()
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._work, name="files-worker-%d" % i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, job_id, using="default"):
+        self.queue.put((job_id, using))
+
+    def join(self):
+        """
+        Block until all submitted jobs are processed.
+        """
+        self.queue.join()
+
+    def _work(self):
+        while True:
+            job_id, using = self.queue.get()
+            try:
+                run_job(job_id, using)
+            except Exception:
+                logger.exception("Unhandled error in attachment worker.")
+            finally:
+                # Database connections are thread local, make sure
+                # we don't leave any idle connections behind.
+                connections[using].close()
+                self.queue.task_done()
+
+
+_worker_pool = None
+_worker_pool_lock = threading.Lock()
+_local = threading.local()
+
+
+def get_worker_pool():
+    """
+    Return the in-process worker pool, or None if
+    settings.ATTACHMENT_WORKER_THREADS is not set.
+    """
+    global _worker_pool
+    workers = getattr(settings, "ATTACHMENT_WORKER_THREADS", 0)
+    if not workers:
+        return None
+    with _worker_pool_lock:
+        if _worker_pool is None:
+            _worker_pool = WorkerPool(workers)
+    return _worker_pool
+
+
+def _pending_jobs():
+    if not hasattr(_local, "jobs"):
+        _local.jobs = []
+    return _local.jobs
+
+
+def submit_pending_jobs(sender, **kwargs):
+    """
+    Hand jobs created during the request to the worker pool
+    when the request is finished (and the transaction committed).
+    """
+    jobs = getattr(_local, "jobs", None)
+    if jobs and get_worker_pool() is not None:
+        for job_id, using in jobs:
+            get_worker_pool().submit(job_id, using)
+    _local.jobs = []
+
+request_finished.connect(submit_pending_jobs)
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+#
+# Per-request profiling of attachment requests.
+#
+# The ProfilingMiddleware starts a Profile for each request, which the
+# download view and the storage backends add the time of each phase to
+# (metadata lookup, opening the blob, reading, verifying the checksum and
+# sending the response). The phases are sent in a Server-Timing header and
+# written to the "files.profiling" logger. Enable it in settings.py:
+#
+#     ATTACHMENT_PROFILING = True
+#     MIDDLEWARE_CLASSES += ("files.profiling.ProfilingMiddleware", )
+#
+# Streamed responses send their headers before the file is read, so the
+# Server-Timing header of a download only holds the phases until then; the
+# log line, written when the response is closed, holds all of them.
+#
+
+import time
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from django.conf import settings
+
+logger = logging.getLogger("files.profiling")
+
+_local = threading.local()
+
+
+class Profile(object):
+    """
+    The accumulated time of each phase of one request.
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.phases = OrderedDict()
+
+    def add(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def server_timing(self):
+        return ", ".join("%s;dur=%.1f" % (name, seconds * 1000) for name, seconds in self.phases.items())
+
+    def summary(self):
+        phases = " ".join("%s=%.1fms" % (name, seconds * 1000) for name, seconds in self.phases.items())
+        return "%s total=%.1fms" % (phases, (time.time() - self.started) * 1000)
+
+
+def activate(profile):
+    _local.profile = profile
+
+
+def deactivate():
+    _local.profile = None
+
+
+def current():
+    return getattr(_local, "profile", None)
+
+
+@contextmanager
+def phase(name):
+    """
+    Add the time of the block of the with statement
+    to the phase name of the current profile, if any.
+    """
+    profile = current()
+    if profile is None:
+        yield
+        return
+    started = time.time()
+    try:
+        yield
+    finally:
+        profile.add(name, time.time() - started)
+
+
+def timed_chunks(chunks, name):
+    """
+    Pass through an iterator of chunks, adding the time
+    spent producing them to the phase name.
+    """
+    profile = current()
+    if profile is None:
+        for chunk in chunks:
+            yield chunk
+        return
+    chunks = iter(chunks)
+    while True:
+        started = time.time()
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            break
+        finally:
+            profile.add(name, time.time() - started)
+        yield chunk
+
+
+class ProfilingMiddleware(object):
+    """
+    Profiles requests if settings.ATTACHMENT_PROFILING is True. Only
+    requests which touch the attachment code get a Server-Timing header.
+    """
+
+    def process_request(self, request):
+        if getattr(settings, "ATTACHMENT_PROFILING", False):
+            request._files_profile = Profile()
+            activate(request._files_profile)
+
+    def process_response(self, request, response):
+        profile = getattr(request, "_files_profile", None)
+        if profile is None:
+            return response
+        deactivate()
+        if not profile.phases:
+            return response
+        response["Server-Timing"] = profile.server_timing()
+        if getattr(response, "streaming", False):
+            response.streaming_content = self._stream(profile, request, response, response.streaming_content)
+        else:
+            self._log(profile, request, response)
+        return response
+
+    def _stream(self, profile, request, response, chunks):
+        chunks = iter(chunks)
+        try:
+            while True:
+                # The file is read while the response is sent, so
+                # the storage backends need the profile once more.
+                activate(profile)
+                try:
+                    chunk = next(chunks)
+                except StopIteration:
+                    break
+                finally:
+                    deactivate()
+                started = time.time()
+                yield chunk
+                profile.add("send", time.time() - started)
+        finally:
+            self._log(profile, request, response)
+
+    def _log(self, profile, request, response):
+        logger.debug("%s %s %s %s", request.method, request.path, response.status_code, profile.summary())
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+#
+# Storage quotas per user and per object.
+#
+# With settings.ATTACHMENT_QUOTAS = True, the number and total size of the
+# attachments created by each user, and attached to each object, are kept
+# in the AttachmentUsage ledger. The usage is added when an attachment is
+# saved, with an UPDATE which only matches if the result stays within the
+# quota, so concurrent uploads can't exceed it, and subtracted when it is
+# deleted. The quotas are set with
+#
+#     ATTACHMENT_USER_QUOTA = {"count": 1000, "size": 1024 ** 3}
+#     ATTACHMENT_OBJECT_QUOTA = {"size": 100 * 1024 ** 2}
+#
+# Either limit may be left out (or the setting, for no quota at all).
+#
+
+from django.conf import settings
+from django.db import transaction, IntegrityError
+from django.db.models import F, Q, Sum, Count
+from django.core.exceptions import ValidationError
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.utils.encoding import smart_unicode
+from django.utils.translation import ugettext as _
+
+from files.models import Attachment, AttachmentUsage
+
+USER = AttachmentUsage.USER
+OBJECT = AttachmentUsage.OBJECT
+
+
+class QuotaExceeded(ValidationError):
+    pass
+
+
+def is_enabled():
+    return getattr(settings, "ATTACHMENT_QUOTAS", False) is True
+
+
+def get_quota(scope):
+    """
+    Return the (count, size) limits of the scope, None meaning no limit.
+    """
+    quota = getattr(settings, "ATTACHMENT_USER_QUOTA" if scope == USER else "ATTACHMENT_OBJECT_QUOTA", None) or {}
+    return quota.get("count"), quota.get("size")
+
+
+def get_keys(creator_id, content_type_id, object_id):
+    """
+    Return the keys (scope, content_type_id, object_id) of the ledger
+    entries of an attachment.
+    """
+    keys = [(OBJECT, content_type_id, smart_unicode(object_id))]
+    if creator_id is not None:
+        keys.append((USER, ContentType.objects.get_for_model(User).pk, smart_unicode(creator_id)))
+    return keys
+
+
+def get_state(instance):
+    return instance.creator_id, instance.content_type_id, instance.object_id, instance.size or 0
+
+
+def remember(instance):
+    if instance.pk is not None:
+        instance._usage_state = get_state(instance)
+
+
+def add_delta(deltas, state, sign):
+    creator_id, content_type_id, object_id, size = state
+    for key in get_keys(creator_id, content_type_id, object_id):
+        delta = deltas.setdefault(key, [0, 0])
+        delta[0] += sign
+        delta[1] += sign * size
+
+
+def reserve(instance, using):
+    """
+    Add the change of the attachment since it was loaded to the ledger.
+    Raises QuotaExceeded, leaving the ledger unchanged, if the usage
+    of the creator or the object would exceed the quota.
+    """
+    old = getattr(instance, "_usage_state", None)
+    if old is None and instance.pk is not None:
+        # Loaded before the ledger was enabled; the old values are unknown.
+        remember(instance)
+        return
+    new = get_state(instance)
+    deltas = {}
+    if old is not None:
+        add_delta(deltas, old, -1)
+    add_delta(deltas, new, 1)
+    applied = []
+    try:
+        for key, (count, size) in deltas.items():
+            if count or size:
+                apply_delta(key, count, size, using)
+                applied.append((key, count, size))
+    except QuotaExceeded:
+        # Undo the entries which were already updated.
+        for key, count, size in applied:
+            apply_delta(key, -count, -size, using)
+        raise
+    instance._usage_state = new
+
+
+def release(instance):
+    """
+    Subtract the attachment from the ledger.
+    """
+    deltas = {}
+    add_delta(deltas, getattr(instance, "_usage_state", None) or get_state(instance), -1)
+    for key, (count, size) in deltas.items():
+        apply_delta(key, count, size, instance._state.db)
+
+
+def apply_delta(key, count, size, using):
+    scope, content_type_id, object_id = key
+    max_count, max_size = get_quota(scope)
+    if count <= 0:
+        max_count = None
+    if size <= 0:
+        max_size = None
+    if (max_count is not None and count > max_count) or (max_size is not None and size > max_size):
+        raise quota_exceeded(scope)
+
+    qs = AttachmentUsage.objects.using(using).filter(scope=scope, content_type__pk=content_type_id,
+                                                     object_id=object_id)
+    # The conditions make the UPDATE only match if the
+    # new usage is within the quota.
+    limited = qs
+    if max_count is not None:
+        limited = limited.filter(count__lte=max_count - count)
+    if max_size is not None:
+        limited = limited.filter(size__lte=max_size - size)
+    if limited.update(count=F("count") + count, size=F("size") + size):
+        return
+    if qs.exists():
+        raise quota_exceeded(scope)
+    if count < 0 or size < 0:
+        # Never added to the ledger (i.e. created before it was
+        # enabled); the entry is created by reconcile().
+        return
+    try:
+        sid = transaction.savepoint(using)
+        AttachmentUsage.objects.using(using).create(scope=scope, content_type_id=content_type_id,
+                                                    object_id=object_id, count=count, size=size)
+        transaction.savepoint_commit(sid, using=using)
+    except IntegrityError:
+        # Created by a concurrent upload in the meantime.
+        transaction.savepoint_rollback(sid, using=using)
+        apply_delta(key, count, size, using)
+
+
+def quota_exceeded(scope):
+    if scope == USER:
+        return QuotaExceeded(_("You have used up your storage quota for attachments."))
+    return QuotaExceeded(_("The storage quota for the attachments of this object is used up."))
+
+
+def check(instance, creator_id, content_type_id, object_id, size):
+    """
+    Raise QuotaExceeded if saving the attachment instance (or a new
+    attachment, if instance is None) with the given creator, object and
+    size would exceed the quota of the creator or the object. Used by the
+    forms, so the ledger is only read; the quota is enforced on save.
+    """
+    deltas = {}
+    old = getattr(instance, "_usage_state", None) if instance is not None else None
+    if old is not None:
+        add_delta(deltas, old, -1)
+    add_delta(deltas, (creator_id, content_type_id, object_id, size), 1)
+    q = Q()
+    for scope, ctype_id, oid in deltas:
+        q |= Q(scope=scope, content_type__pk=ctype_id, object_id=oid)
+    usage = dict(((u.scope, u.content_type_id, u.object_id), (u.count, u.size))
+                 for u in AttachmentUsage.objects.filter(q))
+    for key, (count, size) in deltas.items():
+        max_count, max_size = get_quota(key[0])
+        used_count, used_size = usage.get(key, (0, 0))
+        if (max_count is not None and count > 0 and used_count + count > max_count) or \
+                (max_size is not None and size > 0 and used_size + size > max_size):
+            raise quota_exceeded(key[0])
+
+
+def get_usage(scope, obj):
+    """
+    Return the (count, size) of the attachments of the user (scope USER)
+    or the object (scope OBJECT).
+    """
+    try:
+        usage = AttachmentUsage.objects.get(scope=scope, content_type=ContentType.objects.get_for_model(obj),
+                                            object_id=smart_unicode(obj.pk))
+    except AttachmentUsage.DoesNotExist:
+        return 0, 0
+    return usage.count, usage.size
+
+
+def count_usage(using=None):
+    """
+    Count the attachments of every user and object. Returns
+    a dict of the key of each ledger entry to [count, size].
+    """
+    usage = {}
+    user_type_id = ContentType.objects.get_for_model(User).pk
+    attachments = Attachment.objects.using(using).order_by()
+    for row in attachments.values("creator").annotate(count=Count("pk"), size=Sum("size")).iterator():
+        usage[(USER, user_type_id, smart_unicode(row["creator"]))] = [row["count"], row["size"] or 0]
+    rows = attachments.values("content_type", "object_id").annotate(count=Count("pk"), size=Sum("size"))
+    for row in rows.iterator():
+        usage[(OBJECT, row["content_type"], smart_unicode(row["object_id"]))] = [row["count"], row["size"] or 0]
+    return usage
+
+
+def reconcile(using=None, dry_run=False, batch_size=500):
+    """
+    Recount the usage of every user and object, and correct the ledger
+    entries which are wrong. Returns (fixed, created, removed).
+    """
+    fixed = removed = 0
+    actual = count_usage(using)
+    existing = set()
+    for usage in AttachmentUsage.objects.using(using).iterator():
+        key = (usage.scope, usage.content_type_id, usage.object_id)
+        existing.add(key)
+        values = actual.get(key)
+        if values is None:
+            removed += 1
+            if not dry_run:
+                AttachmentUsage.objects.using(using).filter(pk=usage.pk).delete()
+        elif values != [usage.count, usage.size]:
+            fixed += 1
+            if not dry_run:
+                AttachmentUsage.objects.using(using).filter(pk=usage.pk).update(count=values[0], size=values[1])
+
+    missing = [AttachmentUsage(scope=scope, content_type_id=content_type_id, object_id=object_id,
+                               count=count, size=size)
+               for (scope, content_type_id, object_id), (count, size) in actual.items()
+               if (scope, content_type_id, object_id) not in existing]
+    if not dry_run:
+        for i in range(0, len(missing), batch_size):
+            AttachmentUsage.objects.using(using).bulk_create(missing[i:i + batch_size])
+        transaction.commit_unless_managed(using=using)
+    return fixed, len(missing), removed
@@ -24,3 +24,9 @@ unlink_binary = Signal(providing_args=["instance", "kwargs"])
 # Sent after the unlinking is done. Note that this signal is sent
 # even if the storage backend does not requires any unlinking.
 post_unlink = Signal(providing_args=["instance", "kwargs"])
+
+# Sent after a batch of attachments has been deleted by
+# AttachmentManager.bulk_delete(), instead of the delete signals of
+# each attachment. pks and names are the primary keys and file names
+# of the deleted attachments.
+post_bulk_unlink = Signal(providing_args=["pks", "names", "using"])
@@ -0,0 +1,7 @@
+-- Partial index for listing the public attachments of an object.
+-- Requires SQLite 3.8.0 or later. Created by syncdb along with the
+-- files_attachment table. For existing databases, apply the output
+-- of `python manage.py sqlcustom files`.
+CREATE INDEX "files_attachment_public_lookup" ON "files_attachment"
+    ("content_type_id", "object_id", "site_id", "created", "id")
+    WHERE "is_public";
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 import os
+import hashlib
 import urlparse
 import itertools
 from StringIO import StringIO
@@ -8,13 +9,104 @@ from django.conf import settings
 from django.db import connections, transaction, IntegrityError
 from django.core import urlresolvers
 from django.core.files.base import File
-from django.core.files.storage import Storage, get_storage_class
+from django.core.files.storage import Storage, get_storage_class, \
+    FileSystemStorage as BaseFileSystemStorage
 from django.dispatch.dispatcher import receiver
 from django.template.defaultfilters import slugify
 
-from files.utils import md5buffer
+from files.utils import md5buffer, checksum
+from files import metrics, profiling
+from files.cache import blob_cache
+from files.compression import get_encoding, compress, decompress, compress_chunks, decompress_chunks, \
+    is_compressible
 from files.models import Attachment
-from files.signals import write_binary, unlink_binary
+from files.signals import write_binary, unlink_binary, post_write, post_unlink, post_bulk_unlink
+
+
+# Storage classes for the values of Attachment.backend
+BACKEND_STORAGES = {
+    "FileSystemStorage": "files.storage.FileSystemStorage",
+    "SQLiteStorage": "files.storage.SQLiteStorage",
+    "PostgreSQLStorage": "files.storage.PostgreSQLStorage",
+    "PostgreSQLInlineStorage": "files.storage.PostgreSQLInlineStorage",
+    "MySQLStorage": "files.storage.MySQLStorage",
+    "OracleStorage": "files.storage.OracleStorage",
+}
+
+# Backends storing the binary data inline in the row, by database vendor.
+# Used by the HybridStorage for small files.
+INLINE_BACKENDS = {
+    "postgresql": "PostgreSQLInlineStorage",
+    "sqlite": "SQLiteStorage",
+}
+
+
+def get_backend_storage(backend, using=None):
+    """
+    Return a storage instance for the backend name as
+    stored in Attachment.backend.
+    """
+    storage_class = get_storage_class(BACKEND_STORAGES[backend])
+    if issubclass(storage_class, DatabaseStorage):
+        return storage_class(using)
+    return storage_class()
+
+
+def get_attachment_storage(attachment):
+    """
+    Return the storage the file of the attachment is stored in. With a
+    routing storage, this is the backend recorded on the attachment,
+    which saves looking up the backend by the name of the file.
+    """
+    storage = attachment.attachment.storage
+    if getattr(storage, "is_routing", False):
+        return storage.get_storage_for(attachment)
+    return storage
+
+
+def file_chunks(f, chunk_size=None):
+    """
+    Return an iterator over the chunks of the open file f,
+    which closes the file when the iteration ends or is abandoned.
+    """
+    try:
+        for chunk in f.chunks(chunk_size):
+            yield chunk
+    finally:
+        f.close()
+
+
+def read_chunks(storage, attachment, chunk_size=None):
+    """
+    Return an iterator over the contents of the file of the attachment,
+    read from the storage backend as stored (and decompressed), without
+    the blob cache and the checksum verification of stream(). For callers
+    which compute the checksum themselves.
+    """
+    if hasattr(storage, "stream_encoded"):
+        return decompress_chunks(storage.stream_encoded(attachment.attachment.name, chunk_size),
+                                 attachment.encoding)
+    return file_chunks(storage.open(attachment.attachment.name), chunk_size)
+
+
+class FileSystemStorage(BaseFileSystemStorage):
+    """
+    The FileSystemStorage of Django, which records the time to open,
+    write and delete files with the metrics backends (see `files.metrics`).
+    """
+    @metrics.timed("storage.open", backend="FileSystemStorage")
+    def _open(self, name, mode="rb"):
+        return super(FileSystemStorage, self)._open(name, mode)
+    
+    def _save(self, name, content):
+        with metrics.timer("storage.write", backend="FileSystemStorage"):
+            name = super(FileSystemStorage, self)._save(name, content)
+        metrics.incr("storage.write.bytes", content.size, backend="FileSystemStorage")
+        return name
+    
+    @metrics.timed("storage.delete", backend="FileSystemStorage")
+    def delete(self, name):
+        super(FileSystemStorage, self).delete(name)
 
 
 class DatabaseStorage(Storage):
@@ -70,6 +162,39 @@ class DatabaseStorage(Storage):
     def exists(self, name):
         return Attachment.objects.using(self.using).filter(attachment__exact=name).exists()
     
+    def _get_attachment(self, name, binary_field=None):
+        """
+        Return the attachment stored as name. If the blob cache is
+        enabled, binary_field is deferred, so the binary data is only
+        read from the database if the file is not in the cache.
+        """
+        queryset = Attachment.objects.using(self.using)
+        if binary_field is not None and blob_cache.enabled:
+            queryset = queryset.defer(binary_field)
+        return queryset.get(attachment__exact=name)
+    
+    def _open_cached(self, name, checksum, mode="rb"):
+        """
+        Return a File object for name from the blob cache, or None if
+        the file is not cached with the checksum of the current row.
+        """
+        cached = blob_cache.get(name, checksum)
+        if cached is None:
+            return None
+        checksum, data = cached
+        fname = File(StringIO(data), os.path.basename(name))
+        fname.size = len(data)
+        fname.mode = mode
+        return fname
+    
+    def stream(self, name, chunk_size=None):
+        """
+        Return an iterator over the contents of the file in chunks
+        of chunk_size bytes. Subclasses which are able to read the
+        binary data in chunks should override this.
+        """
+        return file_chunks(self.open(name), chunk_size)
+    
     def get_available_name(self, name):
         """
         Return a filename based on the name parameter that's
@@ -116,33 +241,109 @@ class PostgreSQLStorage(DatabaseStorage):
         
     def url(self, name):
         attachment = Attachment.objects.using(self.using).get(attachment__exact=name)
-        if not attachment.slug:
-            # If the slug field is empty, this attachment has just been
-            # saved, but has not yet executed the `write_binary` signal.
-            # Fall back to the super url.
+        if not attachment.has_slug:
+            # If the slug field is empty or the placeholder, this attachment
+            # has just been saved, but has not yet executed the `write_binary`
+            # signal. Fall back to the super url.
             return super(PostgreSQLStorage, self).url(name)
         return urlresolvers.reverse("download-attachment", kwargs={"slug": attachment.slug})
     
+    @metrics.timed("storage.open", backend="PostgreSQLStorage")
     def _open(self, name, mode="rb"):
         """
         Read the file from the database, and return
         as a File instance.
         """
-        attachment = Attachment.objects.using(self.using).get(attachment__exact=name)
+        with profiling.phase("meta"):
+            attachment = Attachment.objects.using(self.using).get(attachment__exact=name)
+        fname = self._open_cached(name, attachment.checksum, mode)
+        if fname is not None:
+            return fname
+        
         cursor = connections[self.using].cursor()
-        lobject = cursor.db.connection.lobject(attachment.blob, "r")
-        fname = File(StringIO(lobject.read()), attachment.filename)
+        with profiling.phase("open"):
+            lobject = cursor.db.connection.lobject(attachment.blob, "r")
+        with profiling.phase("read"):
+            data = decompress(lobject.read(), attachment.encoding)
+        fname = File(StringIO(data), attachment.filename)
         lobject.close()
         
         # Make sure the checksum match before returning the file
-        if not md5buffer(fname) == attachment.checksum:
-            raise IntegrityError("Checksum mismatch")
+        with profiling.phase("verify"):
+            if not md5buffer(fname) == attachment.checksum:
+                raise IntegrityError("Checksum mismatch")
+        blob_cache.set(name, attachment.checksum, data)
         
         fname.size = attachment.size
         fname.mode = mode
         
         return fname
     
+    def stream(self, name, chunk_size=None):
+        """
+        Read the large object in chunks, without loading the whole file
+        into memory. Files up to ATTACHMENT_STREAM_VERIFY_MAX_SIZE are read and
+        verified before the first chunk is returned. Larger files are
+        verified while they are read, and the last chunk is held back
+        until the checksum matches, so a corrupt file raises IntegrityError
+        and truncates the response instead of completing it.
+        """
+        with profiling.phase("meta"):
+            attachment = Attachment.objects.using(self.using).get(attachment__exact=name)
+        cached = blob_cache.get(name, attachment.checksum)
+        if cached is not None:
+            for chunk in File(StringIO(cached[1])).chunks(chunk_size):
+                yield chunk
+            return
+        
+        chunks = decompress_chunks(self._read_lobject(attachment, chunk_size), attachment.encoding)
+        if attachment.size <= getattr(settings, "ATTACHMENT_STREAM_VERIFY_MAX_SIZE", 1024 * 1024):
+            data = "".join(chunks)
+            with profiling.phase("verify"):
+                if not hashlib.md5(data).hexdigest() == attachment.checksum:
+                    raise IntegrityError("Checksum mismatch")
+            blob_cache.set(name, attachment.checksum, data)
+            for chunk in File(StringIO(data)).chunks(chunk_size):
+                yield chunk
+            return
+        
+        md5 = hashlib.md5()
+        previous = None
+        for chunk in chunks:
+            with profiling.phase("verify"):
+                md5.update(chunk)
+            if previous is not None:
+                yield previous
+            previous = chunk
+        if not md5.hexdigest() == attachment.checksum:
+            raise IntegrityError("Checksum mismatch")
+        if previous is not None:
+            yield previous
+    
+    def stream_encoded(self, name, chunk_size=None):
+        """
+        Return an iterator over the binary data as stored, i.e. compressed
+        with Attachment.encoding, without decompressing it. Optional; the
+        download view checks whether the backend has this method.
+        """
+        attachment = Attachment.objects.using(self.using).get(attachment__exact=name)
+        return self._read_lobject(attachment, chunk_size)
+    
+    def _read_lobject(self, attachment, chunk_size=None):
+        chunk_size = chunk_size or File.DEFAULT_CHUNK_SIZE
+        cursor = connections[self.using].cursor()
+        with profiling.phase("open"), metrics.timer("storage.open", backend="PostgreSQLStorage"):
+            lobject = cursor.db.connection.lobject(attachment.blob, "r")
+        try:
+            while True:
+                with profiling.phase("read"):
+                    chunk = lobject.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            lobject.close()
+    
     def _save(self, name, content):
         """
         Do nothing.
@@ -161,27 +362,40 @@ class PostgreSQLStorage(DatabaseStorage):
         on the model.
         """
         cursor = connections[self.using].cursor()
+        # Files received by the StreamingBlobUploadHandler
+        # are already stored in a large object.
+        oid = getattr(content, "oid", None)
         if not (hasattr(instance, "_created") and instance._created is True):
             cursor.execute("select checksum from files_attachment where id = %s", (instance.pk, ))
-            new, orig = md5buffer(content), cursor.fetchone()[0]
+            new, orig = checksum(content), cursor.fetchone()[0]
             if new == orig:
+                if oid is not None:
+                    cursor.db.connection.lobject(oid, "n").unlink()
                 return
 
         # If still here, either the file is a new upload,
         # or it has changed. In either case, write the
         # file to the database
-        content.seek(0)
-        blob_data = content.read()
         instance.slug = slugify(instance.pre_slug)
-        instance.checksum = md5buffer(content)
+        instance.checksum = checksum(content)
         
         try:
             sid = transaction.savepoint(self.using)
-            lobject = cursor.db.connection.lobject(0, "n", 0, None)
-            lobject.write(blob_data)
+            if oid is not None:
+                # Stored as received, compressing would mean
+                # reading and writing the data once more.
+                lobject = content.file
+                instance.encoding = ""
+            else:
+                # Write in chunks to avoid holding the whole file in memory.
+                lobject = cursor.db.connection.lobject(0, "wb")
+                instance.encoding = get_encoding(instance.mimetype, content.size)
+                for chunk in compress_chunks(content.chunks(), instance.encoding):
+                    lobject.write(chunk)
             cursor.execute("update files_attachment set blob = %s, slug = %s, \
-                            checksum = %s where id = %s", (lobject.oid, instance.slug,
-                                                           instance.checksum, instance.pk))
+                            checksum = %s, encoding = %s where id = %s", (lobject.oid, instance.slug,
+                                                                          instance.checksum, instance.encoding,
+                                                                          instance.pk))
             lobject.close()
             transaction.savepoint_commit(sid, using=self.using)
         except IntegrityError, e:
@@ -202,6 +416,96 @@ class PostgreSQLStorage(DatabaseStorage):
         except IntegrityError, e:
             transaction.savepoint_rollback(sid, using=self.using)
             raise e
+    
+    def _unlink_binaries(self, pks):
+        """
+        Unlink the large objects of many attachments with a single
+        query (see AttachmentManager.bulk_delete). Large objects
+        which are already gone are skipped.
+        """
+        cursor = connections[self.using].cursor()
+        cursor.execute("select lo_unlink(a.blob) from files_attachment a "
+                       "join pg_largeobject_metadata m on m.oid = a.blob "
+                       "where a.id = any(%s)", (list(pks), ))
+
+
+class PostgreSQLInlineStorage(DatabaseStorage):
+    """
+    This is the database storage for small files in PostgreSQL
+    databases. The binary data is stored in the bytea column
+    files_attachment.data, so it is read along with the row rather
+    than through a separate large object.
+    """
+    def __init__(self, using=None, base_url=None):
+        super(PostgreSQLInlineStorage, self).__init__(using, base_url)
+    
+    def url(self, name):
+        attachment = Attachment.objects.using(self.using).get(attachment__exact=name)
+        if not attachment.has_slug:
+            # If the slug field is empty or the placeholder, this attachment
+            # has just been saved, but has not yet executed the `write_binary`
+            # signal. Fall back to the super url.
+            return super(PostgreSQLInlineStorage, self).url(name)
+        return urlresolvers.reverse("download-attachment", kwargs={"slug": attachment.slug})
+    
+    @metrics.timed("storage.open", backend="PostgreSQLInlineStorage")
+    def _open(self, name, mode="rb"):
+        """
+        Return a File object.
+        """
+        with profiling.phase("meta"):
+            attachment = self._get_attachment(name, "data")
+        fname = self._open_cached(name, attachment.checksum, mode)
+        if fname is not None:
+            return fname
+        
+        with profiling.phase("read"):
+            data = decompress(str(attachment.data), attachment.encoding)
+        fname = File(StringIO(data), attachment.filename)
+        
+        # Make sure the checksum match before returning the file
+        with profiling.phase("verify"):
+            if not md5buffer(fname) == attachment.checksum:
+                raise IntegrityError("Checksum mismatch")
+        blob_cache.set(name, attachment.checksum, data)
+        
+        fname.size = attachment.size
+        fname.mode = mode
+        return fname
+    
+    def stream_encoded(self, name, chunk_size=None):
+        attachment = Attachment.objects.using(self.using).get(attachment__exact=name)
+        return File(StringIO(str(attachment.data))).chunks(chunk_size)
+    
+    def _save(self, name, content):
+        """
+        Do nothing.
+        We are calling a special `write_binary` signal
+        in the Attachment save() method, which will call the `_write_binary()`
+        method below, and write the binary file into the Attachment row.
+        """
+        return name
+    
+    def _write_binary(self, instance, content):
+        """
+        Write the binary data to the data column of the row.
+        """
+        cursor = connections[self.using].cursor()
+        if not (hasattr(instance, "_created") and instance._created is True):
+            cursor.execute("select checksum from files_attachment where id = %s", (instance.pk, ))
+            new, orig = checksum(content), cursor.fetchone()[0]
+            if new == orig:
+                return
+        
+        content.seek(0)
+        instance.encoding = get_encoding(instance.mimetype, content.size)
+        data = buffer(compress(content.read(), instance.encoding))
+        instance.slug = slugify(instance.pre_slug)
+        instance.checksum = checksum(content)
+        cursor.execute("update files_attachment set data = %s, slug = %s, checksum = %s, \
+                        encoding = %s where id = %s", (data, instance.slug, instance.checksum,
+                                                       instance.encoding, instance.pk))
+        transaction.commit_unless_managed(using=self.using)
 
 
 class MySQLStorage(DatabaseStorage):
@@ -223,28 +527,42 @@ class SQLiteStorage(DatabaseStorage):
     
     def url(self, name):
         attachment = Attachment.objects.using(self.using).get(attachment__exact=name)
-        if not attachment.slug:
-            # If the slug field is empty, this attachment has just been
-            # saved, but has not yet executed the `write_binary` signal.
-            # Fall back to the super url.
+        if not attachment.has_slug:
+            # If the slug field is empty or the placeholder, this attachment
+            # has just been saved, but has not yet executed the `write_binary`
+            # signal. Fall back to the super url.
             return super(SQLiteStorage, self).url(name)
         return urlresolvers.reverse("download-attachment", kwargs={"slug": attachment.slug})
        
+    @metrics.timed("storage.open", backend="SQLiteStorage")
     def _open(self, name, mode="rb"):
         """
         Return a File object.
         """
-        attachment = Attachment.objects.using(self.using).get(attachment__exact=name)
-        fname = File(StringIO(attachment.blob), attachment.filename)
+        with profiling.phase("meta"):
+            attachment = self._get_attachment(name, "blob")
+        fname = self._open_cached(name, attachment.checksum, mode)
+        if fname is not None:
+            return fname
+        
+        with profiling.phase("read"):
+            data = decompress(str(attachment.blob), attachment.encoding)
+        fname = File(StringIO(data), attachment.filename)
         
         # Make sure the checksum match before returning the file
-        if not md5buffer(fname) == attachment.checksum:
-            raise IntegrityError("Checksum mismatch")
+        with profiling.phase("verify"):
+            if not md5buffer(fname) == attachment.checksum:
+                raise IntegrityError("Checksum mismatch")
+        blob_cache.set(name, attachment.checksum, data)
         
         fname.size = attachment.size
         fname.mode = mode
         return fname
     
+    def stream_encoded(self, name, chunk_size=None):
+        attachment = Attachment.objects.using(self.using).get(attachment__exact=name)
+        return File(StringIO(str(attachment.blob))).chunks(chunk_size)
+    
     def _save(self, name, content):
         """
         Do nothing.
@@ -265,7 +583,7 @@ class SQLiteStorage(DatabaseStorage):
         cursor = connections[self.using].cursor()
         if not (hasattr(instance, "_created") and instance._created is True):
             cursor.execute("select checksum from files_attachment where id = %s", (instance.pk, ))
-            new, orig = md5buffer(content), cursor.fetchone()[0]
+            new, orig = checksum(content), cursor.fetchone()[0]
             if new == orig:
                 return
         
@@ -273,11 +591,13 @@ class SQLiteStorage(DatabaseStorage):
         # or it has changed. In either case, write the
         # file to the database.
         content.seek(0)
-        blob_data = buffer(content.read())
+        instance.encoding = get_encoding(instance.mimetype, content.size)
+        blob_data = buffer(compress(content.read(), instance.encoding))
         instance.slug = slugify(instance.pre_slug)
-        instance.checksum = md5buffer(content)
-        cursor.execute("update files_attachment set blob = %s, slug = %s, \
-                        checksum = %s where id = %s", (blob_data, instance.slug, instance.checksum, instance.pk))
+        instance.checksum = checksum(content)
+        cursor.execute("update files_attachment set blob = %s, slug = %s, checksum = %s, \
+                        encoding = %s where id = %s", (blob_data, instance.slug, instance.checksum,
+                                                       instance.encoding, instance.pk))
         transaction.commit_unless_managed(using=self.using)
 
 
@@ -291,21 +611,169 @@ class OracleStorage(DatabaseStorage):
         raise NotImplementedError("Support for Oracle databases is not yet implemented.")
 
 
+class RoutingStorage(Storage):
+    """
+    Storage which reads each attachment from the backend recorded
+    on its row (Attachment.backend), so attachments stored in different
+    backends can be served side by side. New files are written to the
+    backend named by settings.ATTACHMENT_WRITE_BACKEND.
+    
+    Code which has the attachment should get the backend storage with
+    `get_storage_for` (or `get_attachment_storage`). The Storage API only
+    passes the name of the file, so its methods first look up the backend
+    of the attachment, which costs one extra (indexed) query.
+    """
+    is_routing = True
+    
+    def __init__(self, using=None, base_url=None):
+        self.using = using or "default"
+        self.base_url = base_url
+        self._storages = {}
+    
+    def get_backend_name(self, content):
+        """
+        Return the name of the backend new content should be written to.
+        """
+        return getattr(settings, "ATTACHMENT_WRITE_BACKEND", "FileSystemStorage")
+    
+    def get_storage(self, backend):
+        if backend not in self._storages:
+            self._storages[backend] = get_backend_storage(backend, self.using)
+        return self._storages[backend]
+    
+    def get_storage_for(self, instance):
+        """
+        Return the storage of the backend the attachment is stored in.
+        """
+        return self.get_storage(instance.backend or self.get_backend_name(None))
+    
+    def get_storage_for_name(self, name):
+        # Names are unique across the backends, see exists()
+        backend = Attachment.objects.using(self.using).filter(attachment__exact=name) \
+            .values_list("backend", flat=True)[:1]
+        if not backend:
+            return self.get_storage(self.get_backend_name(None))
+        return self.get_storage(backend[0])
+    
+    def _open(self, name, mode="rb"):
+        return self.get_storage_for_name(name)._open(name, mode)
+    
+    def _save(self, name, content):
+        return self.get_storage(self.get_backend_name(content))._save(name, content)
+    
+    def stream(self, name, chunk_size=None):
+        storage = self.get_storage_for_name(name)
+        if hasattr(storage, "stream"):
+            return storage.stream(name, chunk_size)
+        return file_chunks(storage.open(name), chunk_size)
+    
+    def delete(self, name):
+        return self.get_storage_for_name(name).delete(name)
+    
+    def exists(self, name):
+        # Reads are routed by name, so names must be unique across
+        # all backends. Storage.get_available_name() relies on this.
+        return self.get_storage_for_name(name).exists(name)
+    
+    def listdir(self, path):
+        return self.get_storage(self.get_backend_name(None)).listdir(path)
+    
+    def path(self, name):
+        return self.get_storage_for_name(name).path(name)
+    
+    def size(self, name):
+        return self.get_storage_for_name(name).size(name)
+    
+    def url(self, name):
+        return self.get_storage_for_name(name).url(name)
+    
+    def accessed_time(self, name):
+        return self.get_storage_for_name(name).accessed_time(name)
+    
+    def created_time(self, name):
+        return self.get_storage_for_name(name).created_time(name)
+    
+    def modified_time(self, name):
+        return self.get_storage_for_name(name).modified_time(name)
+    
+    def _write_binary(self, instance, content):
+        self.get_storage_for(instance)._write_binary(instance, content)
+    
+    def _unlink_binary(self, instance):
+        storage = self.get_storage_for(instance)
+        if hasattr(storage, "_unlink_binary"):
+            storage._unlink_binary(instance)
+
+
+class HybridStorage(RoutingStorage):
+    """
+    Routing storage which chooses the backend of each new file by
+    its size. Files up to settings.ATTACHMENT_INLINE_MAX_SIZE bytes
+    are stored inline in the database row (ATTACHMENT_INLINE_BACKEND,
+    by default the inline backend for the database vendor), so they
+    are read with a single query. Larger files are written to
+    ATTACHMENT_WRITE_BACKEND, i.e. large objects or the file system.
+    """
+    
+    def get_backend_name(self, content):
+        max_size = getattr(settings, "ATTACHMENT_INLINE_MAX_SIZE", 65536)
+        # Files received by the StreamingBlobUploadHandler are
+        # already stored in a large object, so leave them there.
+        if content is None or getattr(content, "oid", None) is not None or content.size > max_size:
+            return super(HybridStorage, self).get_backend_name(content)
+        backend = getattr(settings, "ATTACHMENT_INLINE_BACKEND", None)
+        return backend or INLINE_BACKENDS[connections[self.using].vendor]
+
+
 # Signals
 # The write_binary signal is called from the Attachment's
 # save() method, and is used to write the file into the blob
 # field.
 # The unlink_binary signal is called on Attachment pre_delete
 # to handle unlinking of the blob field if required.
+# The post_write and post_unlink signals are used to invalidate
+# the blob cache.
 
 @receiver(write_binary, sender=Attachment)
 def write_binary_callback(sender, instance, content, **kwargs):
     storage = get_storage_class()(instance._state.db, instance.attachment.url)
-    storage._write_binary(instance, content)
+    with metrics.timer("storage.write", backend=instance.backend):
+        storage._write_binary(instance, content)
+    metrics.incr("storage.write.bytes", content.size, backend=instance.backend)
 
 
 @receiver(unlink_binary, sender=Attachment)
 def unlink_binary_callback(sender, instance, **kwargs):
     storage = get_storage_class()(instance._state.db, instance.attachment.url)
     if hasattr(storage, "_unlink_binary"):
-        storage._unlink_binary(instance)
+        with metrics.timer("storage.delete", backend=instance.backend):
+            storage._unlink_binary(instance)
+
+
+@receiver(post_write, sender=Attachment)
+@receiver(post_unlink, sender=Attachment)
+def invalidate_blob_cache_callback(sender, instance, **kwargs):
+    blob_cache.invalidate(instance.attachment.name)
+
+
+@receiver(post_bulk_unlink, sender=Attachment)
+def invalidate_blob_cache_bulk_callback(sender, names, **kwargs):
+    for name in names:
+        blob_cache.invalidate(name)
+
+
+@receiver(post_write, sender=Attachment)
+def precompress_callback(sender, instance, **kwargs):
+    """
+    Queue a job creating the precompressed siblings of new files in the
+    FileSystemStorage, if settings.ATTACHMENT_PRECOMPRESS = "upload".
+    Otherwise the job is queued by the first request which accepts them.
+    """
+    from files import pipeline
+    
+    if getattr(settings, "ATTACHMENT_PRECOMPRESS", False) != "upload":
+        return
+    if instance.backend != "FileSystemStorage" or not instance.is_ready or \
+            not is_compressible(instance.mimetype, instance.size):
+        return
+    pipeline.enqueue_once(instance, pipeline.TASK_PRECOMPRESS)
@@ -9,12 +9,11 @@ from __future__ import absolute_import
 import files
 
 from django import template
-from django.conf import settings
-from django.db.models import Q
-from django.utils.encoding import smart_unicode
 from django.template.loader import render_to_string
 from django.contrib.contenttypes.models import ContentType
-from django.core.files.storage import get_storage_class
+
+from files import metrics, pagination, counters
+from files.models import Attachment
 
 register = template.Library()
 
@@ -73,8 +72,9 @@ class BaseAttachmentNode(template.Node):
         self.attachment = attachment
         
     def render(self, context):
-        qs = self.get_queryset(context)
-        context[self.as_varname] = self.get_context_value_from_queryset(context, qs)
+        with metrics.timer("templatetag", tag=self.__class__.__name__):
+            qs = self.get_queryset(context)
+            context[self.as_varname] = self.get_context_value_from_queryset(context, qs)
         return ""
     
     def get_queryset(self, context):
@@ -82,27 +82,7 @@ class BaseAttachmentNode(template.Node):
         if not object_pk:
             return self.attachment_model.objects.none()
         
-        qs = self.attachment_model.objects.filter(
-                content_type=ctype,
-                object_id=smart_unicode(object_pk),
-                site__pk=settings.SITE_ID)
-        
-        # The 'is_public' field and the 'backend' fields are implementation
-        # details of the 'django-files' app. If present on the attachment
-        # model, filter on them.
-        field_names = [f.name for f in self.attachment_model._meta.fields]
-        if "is_public" in field_names:
-            # Filter public attachments only, but include users private.
-            q = Q(is_public=True)
-            user = context["user"]
-            if user.is_authenticated():
-                q = q | Q(creator=user)
-            qs = qs.filter(q)
-        if "backend" in field_names:
-            engine = str(get_storage_class().__name__)
-            qs = qs.filter(backend=engine)
-        
-        return qs
+        return files.get_object_attachments(self.attachment_model, ctype, object_pk, context.get("user"))
     
     def get_target_ctype_pk(self, context):
         if self.object_expr:
@@ -126,13 +106,53 @@ class AttachmentListNode(BaseAttachmentNode):
     Insert a list of attachments into the context
     """
     def get_context_value_from_queryset(self, context, qs):
-        return list(qs)
+        return list(files.select_listing_related(qs))
+
+
+class AttachmentPageNode(BaseAttachmentNode):
+    """
+    Insert a page of attachments into the context
+    """
+    
+    @classmethod
+    def handle_token(cls, parser, token):
+        """
+        Class method to parse get_attachment_page and return a Node.
+        Accepts the syntax of get_attachment_list, with an optional
+        "after [cursor]" clause before "as".
+        """
+        tokens = token.contents.split()
+        cursor_expr = None
+        if "after" in tokens[:-2]:
+            i = tokens.index("after")
+            cursor_expr = parser.compile_filter(tokens[i + 1])
+            del tokens[i:i + 2]
+        node = super(AttachmentPageNode, cls).handle_token(
+            parser, template.Token(token.token_type, " ".join(tokens)))
+        node.cursor_expr = cursor_expr
+        return node
+    
+    def get_context_value_from_queryset(self, context, qs):
+        cursor = self.cursor_expr.resolve(context, ignore_failures=True) if self.cursor_expr else None
+        qs = files.select_listing_related(qs)
+        try:
+            return pagination.paginate(qs, cursor)
+        except pagination.InvalidCursor:
+            return pagination.paginate(qs)
 
 
 class AttachmentCountNode(BaseAttachmentNode):
     """
     Insert a count of attachments into the context
     """
+    def render(self, context):
+        if not counters.is_enabled() or self.attachment_model is not Attachment:
+            return super(AttachmentCountNode, self).render(context)
+        with metrics.timer("templatetag", tag=self.__class__.__name__):
+            ctype, object_pk = self.get_target_ctype_pk(context)
+            context[self.as_varname] = counters.get_count(ctype, object_pk, context.get("user")) if object_pk else 0
+        return ""
+    
     def get_context_value_from_queryset(self, context, qs):
         return qs.count()
 
@@ -283,12 +303,13 @@ class RenderAttachmentListNode(AttachmentListNode):
                 "attachments/%s/list.html" % ctype.model,
                 "attachments/list.html"
             ]
-            qs = self.get_queryset(context)
-            context.push()
-            liststr = render_to_string(template_search_list, {
-                "attachment_list": self.get_context_value_from_queryset(context, qs)
-            }, context)
-            context.pop()
+            with metrics.timer("templatetag", tag=self.__class__.__name__):
+                qs = self.get_queryset(context)
+                context.push()
+                liststr = render_to_string(template_search_list, {
+                    "attachment_list": self.get_context_value_from_queryset(context, qs)
+                }, context)
+                context.pop()
             return liststr
         else:
             return ""
@@ -412,6 +433,34 @@ def get_attachment_list(parser, token):
     return AttachmentListNode.handle_token(parser, token)
 
 
+@register.tag
+def get_attachment_page(parser, token):
+    """
+    Gets a page of the attachments for the given params, ordered by the
+    creation date. The page is iterable, and has the attributes
+    ``object_list``, ``has_next`` and ``next_cursor``. Pass the cursor of a
+    page in the 'after' clause to get the next page. The page size is
+    ATTACHMENT_PAGE_SIZE.
+
+    Syntax::
+
+        {% get_attachment_page for [object] [after [cursor]] as [varname]  %}
+        {% get_attachment_page for [app].[model] [object_id] [after [cursor]] as [varname]  %}
+
+    Example usage::
+
+        {% get_attachment_page for event after request.GET.cursor as page %}
+        {% for attachment in page %}
+            ...
+        {% endfor %}
+        {% if page.has_next %}
+            <a href="?cursor={{ page.next_cursor }}">Next</a>
+        {% endif %}
+
+    """
+    return AttachmentPageNode.handle_token(parser, token)
+
+
 @register.simple_tag
 def get_create_target():
     """
@@ -484,3 +533,16 @@ def get_download_url(attachment):
         <a href="{% get_download_url attachment %}">download</a>
     """
     return files.get_download_url(attachment)
+
+
+@register.simple_tag
+def get_derivative_url(attachment, spec):
+    """
+    Get the URL of a derivative of an attachment, such as a
+    thumbnail or preview. See ATTACHMENT_DERIVATIVE_SPECS.
+
+    Example::
+        
+        <img src="{% get_derivative_url attachment "thumbnail" %}" alt="">
+    """
+    return files.get_derivative_url(attachment, spec)
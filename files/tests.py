@@ -1,16 +1,1117 @@
-"""
-This file demonstrates writing tests using the unittest module. These will pass
-when you run "manage.py test".
+# -*- coding: utf-8 -*-
+#
+# Tests for the attachments app. Run with "manage.py test files".
+#
 
-Replace this with more appropriate tests for your application.
-"""
+import os
+import json
+import logging
+import shutil
+import zlib
+import hashlib
+import time
+import uuid
+import datetime
+import tempfile
+from StringIO import StringIO
+from django.db import connection, transaction, IntegrityError
+from django.contrib.auth.models import User, AnonymousUser
+from django.contrib.contenttypes.models import ContentType
+from django.contrib.sessions.models import Session
+from django.core.files.storage import get_storage_class
+from django.core.files.base import File
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.conf import settings
+from django.contrib.admin import helpers, site
+from django.core.urlresolvers import reverse
+from django.test import TestCase, TransactionTestCase
+from django.test.client import Client, RequestFactory
+from django.template import Template, Context
+from django.utils.datastructures import MultiValueDict
+from django.test.utils import override_settings
+from django.utils import timezone
 
-from django.test import TestCase
+from demosite.models import Shape
+import files
+from files import counters, derivatives, metrics, pagination, pipeline, profiling, quotas, uploads
+from files.compression import accepts_encoding
+from files.admin import AttachmentAdmin
+from files.cache import BlobCache, blob_cache
+from files.forms import AttachmentForm
+from files.management.commands import cleanup_attachments
+from files.storage import DatabaseStorage, get_backend_storage, get_attachment_storage, file_chunks, read_chunks
+from files.signals import post_bulk_unlink
+from files.uploadhandler import LargeObjectUploadedFile, discard_uploads
+from files.models import Attachment, AttachmentCounter, AttachmentDerivative, AttachmentJob, AttachmentUsage, UploadSession, STATUS_READY, STATUS_PROCESSING, \
+    STATUS_FAILED, SLUG_PLACEHOLDER_PREFIX
 
 
-class SimpleTest(TestCase):
-    def test_basic_addition(self):
+class AttachmentTestMixin(object):
+    """
+    Provides a user and an object to attach files to. Files
+    are stored with the storage backend named by `storage`.
+    """
+    storage = "files.storage.SQLiteStorage"
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(DEFAULT_FILE_STORAGE=self.storage,
+                                                   MEDIA_ROOT=self.media_root,
+                                                   ATTACHMENT_SPOOL_DIR=os.path.join(self.media_root, "spool"))
+        self.settings_override.enable()
+        # The storage of the field is created when the model is loaded,
+        # so swap it for an instance created with the settings above.
+        self.field = Attachment._meta.get_field("attachment")
+        self.original_storage = self.field.storage
+        self.field.storage = get_storage_class(self.storage)()
+
+        self.user = User.objects.create_user("alice", "alice@example.com", "secret")
+        self.shape = Shape.objects.create(shape="square", color="red")
+
+    def tearDown(self):
+        self.field.storage = self.original_storage
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def create_attachment(self, data="hello world", name="hello.txt", mimetype="text/plain", **kwargs):
+        kwargs.setdefault("content_object", self.shape)
+        kwargs.setdefault("creator", self.user)
+        attachment = Attachment(attachment=SimpleUploadedFile(name, data, mimetype), **kwargs)
+        attachment.save()
+        return attachment
+
+    def login(self):
+        self.user.is_superuser = True
+        self.user.save()
+        self.client.login(username="alice", password="secret")
+
+    def form_data(self, **data):
         """
-        Tests that 1 + 1 always equals 2.
+        Return the POST data of the attachment form for self.shape,
+        including the security fields.
         """
-        self.assertEqual(1 + 1, 2)
+        security = AttachmentForm(self.shape).generate_security_data()
+        security["content_type"] = security["content_type"].pk
+        security.update(data)
+        return security
+
+    def call_command(self, name, *args, **options):
+        """
+        Call the management command, and return its output.
+        """
+        stdout = StringIO()
+        call_command(name, *args, stdout=stdout, stderr=StringIO(), **options)
+        return stdout.getvalue()
+
+    def download(self, attachment, **extra):
+        return self.client.get(reverse("download-attachment", kwargs={"slug": attachment.slug}), **extra)
+
+
+class AttachmentTestCase(AttachmentTestMixin, TestCase):
+    """
+    Base class for the attachment tests.
+    """
+
+
+class BlobCacheTestMixin(object):
+    """
+    Enable the blob cache during the test.
+    """
+    def setUp(self):
+        super(BlobCacheTestMixin, self).setUp()
+        self.cache_limits = blob_cache.max_bytes, blob_cache.max_item_size
+        blob_cache.max_bytes, blob_cache.max_item_size = 1024 * 1024, 64 * 1024
+        blob_cache.clear()
+
+    def tearDown(self):
+        blob_cache.clear()
+        blob_cache.max_bytes, blob_cache.max_item_size = self.cache_limits
+        super(BlobCacheTestMixin, self).tearDown()
+
+
+class BlobCacheTest(TestCase):
+    def test_get_checksum(self):
+        cache = BlobCache(max_bytes=100, max_item_size=100)
+        cache.set("a.txt", "abc", "data")
+        self.assertEqual(cache.get("a.txt"), ("abc", "data"))
+        self.assertEqual(cache.get("a.txt", "abc"), ("abc", "data"))
+        self.assertEqual(cache.get("a.txt", "def"), None)
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+    def test_eviction(self):
+        cache = BlobCache(max_bytes=10, max_item_size=5)
+        cache.set("a.txt", "a", "aaaaa")
+        cache.set("b.txt", "b", "bbbbb")
+        cache.get("a.txt")
+        cache.set("c.txt", "c", "ccccc")
+        self.assertEqual(cache.get("b.txt"), None)
+        self.assertEqual(cache.get("a.txt"), ("a", "aaaaa"))
+        self.assertEqual(cache.current_bytes, 10)
+        cache.set("d.txt", "d", "dddddd")
+        self.assertEqual(cache.get("d.txt"), None)
+
+    def test_disabled(self):
+        cache = BlobCache()
+        cache.set("a.txt", "a", "aaaaa")
+        self.assertEqual(cache.get("a.txt"), None)
+        cache = BlobCache(max_bytes=100, max_item_size=0)
+        cache.set("a.txt", "a", "aaaaa")
+        self.assertEqual(cache.get("a.txt"), None)
+
+
+class StorageBlobCacheTest(BlobCacheTestMixin, AttachmentTestCase):
+    def test_open_cached(self):
+        attachment = self.create_attachment()
+        name = attachment.attachment.name
+        self.assertEqual(self.field.storage.open(name).read(), "hello world")
+        self.assertEqual(blob_cache.get(name), (attachment.checksum, "hello world"))
+        # The row is still read, but not the binary data
+        with self.assertNumQueries(1):
+            self.assertEqual(self.field.storage.open(name).read(), "hello world")
+
+    def test_changed_by_other_process(self):
+        attachment = self.create_attachment()
+        name = attachment.attachment.name
+        self.field.storage.open(name).read()
+        # Change the row without sending any signals, like
+        # another process serving the same database would.
+        Attachment.objects.filter(pk=attachment.pk).update(blob=buffer("hello again"),
+                                                           checksum=hashlib.md5("hello again").hexdigest())
+        self.assertEqual(self.field.storage.open(name).read(), "hello again")
+
+
+class DownloadTest(AttachmentTestCase):
+    def test_download(self):
+        attachment = self.create_attachment("x" * 1000)
+        response = self.download(attachment)
+        self.assertEqual(response["Content-Length"], "1000")
+        self.assertEqual("".join(response.streaming_content), "x" * 1000)
+
+    def test_chunks(self):
+        attachment = self.create_attachment("0123456789")
+        self.assertEqual(list(self.field.storage.stream(attachment.attachment.name, 4)),
+                         ["0123", "4567", "89"])
+
+    def test_corrupt_file(self):
+        attachment = self.create_attachment()
+        Attachment.objects.filter(pk=attachment.pk).update(blob=buffer("hello wOrld"))
+        # The view fails before returning a response, rather than
+        # sending the corrupt data.
+        self.assertRaises(IntegrityError, self.download, attachment)
+
+
+class PostgreSQLStreamTest(AttachmentTestCase):
+    """
+    Runs PostgreSQLStorage.stream on the rows of the SQLite backend,
+    reading the blob column in place of the large object.
+    """
+    def setUp(self):
+        super(PostgreSQLStreamTest, self).setUp()
+        blob_cache.clear()
+        self.pg_storage = get_storage_class("files.storage.PostgreSQLStorage")()
+        self.pg_storage._read_lobject = self.read_blob
+
+    def read_blob(self, attachment, chunk_size=None):
+        self.read = []
+        data = str(Attachment.objects.get(pk=attachment.pk).blob)
+        for chunk in File(StringIO(data)).chunks(chunk_size):
+            self.read.append(chunk)
+            yield chunk
+
+    def test_verified_before_sending(self):
+        attachment = self.create_attachment("0123456789")
+        Attachment.objects.filter(pk=attachment.pk).update(blob=buffer("0123456789"[::-1]))
+        chunks = self.pg_storage.stream(attachment.attachment.name, 4)
+        self.assertRaises(IntegrityError, chunks.next)
+
+    @override_settings(ATTACHMENT_STREAM_VERIFY_MAX_SIZE=4)
+    def test_verified_while_sending(self):
+        attachment = self.create_attachment("0123456789")
+        chunks = self.pg_storage.stream(attachment.attachment.name, 4)
+        # Large files are not read ahead
+        self.assertEqual(chunks.next(), "0123")
+        self.assertEqual(self.read, ["0123", "4567"])
+        self.assertEqual(list(chunks), ["4567", "89"])
+
+    @override_settings(ATTACHMENT_STREAM_VERIFY_MAX_SIZE=4)
+    def test_corrupt_last_chunk_held_back(self):
+        attachment = self.create_attachment("0123456789")
+        Attachment.objects.filter(pk=attachment.pk).update(blob=buffer("01234567XY"))
+        chunks = self.pg_storage.stream(attachment.attachment.name, 4)
+        self.assertEqual(chunks.next(), "0123")
+        self.assertEqual(chunks.next(), "4567")
+        self.assertRaises(IntegrityError, chunks.next)
+
+
+@override_settings(ATTACHMENT_DEFERRED_PROCESSING=True)
+class PipelineTest(AttachmentTestCase):
+    def test_deferred_upload(self):
+        attachment = self.create_attachment()
+        self.assertEqual(attachment.status, STATUS_PROCESSING)
+        self.assertEqual(self.download(attachment).status_code, 503)
+        self.assertEqual(pipeline.run_pending(), 1)
+        attachment = Attachment.objects.get(pk=attachment.pk)
+        self.assertEqual(attachment.status, STATUS_READY)
+        self.assertEqual(attachment.checksum, hashlib.md5("hello world").hexdigest())
+        self.assertEqual("".join(self.download(attachment).streaming_content), "hello world")
+        self.assertEqual(AttachmentJob.objects.get().status, AttachmentJob.DONE)
+
+    @override_settings(ATTACHMENT_JOB_MAX_ATTEMPTS=2)
+    def test_failed_upload(self):
+        attachment = self.create_attachment()
+        job = AttachmentJob.objects.get()
+        os.remove(job.spool)
+        pipeline.run_pending()
+        self.assertEqual(AttachmentJob.objects.get().status, AttachmentJob.PENDING)
+        pipeline.run_pending()
+        job = AttachmentJob.objects.get()
+        self.assertEqual((job.status, job.attempts), (AttachmentJob.FAILED, 2))
+        attachment = Attachment.objects.get(pk=attachment.pk)
+        self.assertEqual(attachment.status, STATUS_FAILED)
+        self.assertEqual(self.download(attachment).status_code, 410)
+
+    @override_settings(ATTACHMENT_JOB_MAX_ATTEMPTS=1)
+    def test_failed_job_keeps_attachment(self):
+        pipeline.register_task("test_failure")(lambda job: 1 / 0)
+        try:
+            with self.settings(ATTACHMENT_DEFERRED_PROCESSING=False):
+                attachment = self.create_attachment()
+            pipeline.enqueue(attachment, "test_failure")
+            pipeline.run_pending()
+        finally:
+            del pipeline.TASKS["test_failure"]
+        self.assertEqual(AttachmentJob.objects.get().status, AttachmentJob.FAILED)
+        self.assertEqual(Attachment.objects.get(pk=attachment.pk).status, STATUS_READY)
+
+    def test_requeue_stale(self):
+        attachment = self.create_attachment()
+        job = AttachmentJob.objects.get()
+        self.assertTrue(pipeline.claim(job.pk))
+        # A job claimed by a worker which is still alive is left alone
+        self.assertEqual(pipeline.requeue_stale(), 0)
+        # ... but not once it has been running for longer than the timeout
+        AttachmentJob.objects.filter(pk=job.pk).update(modified=timezone.now() - datetime.timedelta(hours=2))
+        self.assertEqual(pipeline.run_pending(), 1)
+        job = AttachmentJob.objects.get()
+        self.assertEqual((job.status, job.attempts), (AttachmentJob.DONE, 2))
+        self.assertEqual(Attachment.objects.get(pk=attachment.pk).status, STATUS_READY)
+
+
+class ResumableUploadTest(AttachmentTestCase):
+    def setUp(self):
+        super(ResumableUploadTest, self).setUp()
+        self.login()
+
+    def start(self, length):
+        response = self.client.post(reverse("upload-attachment"), self.form_data(filename="hello.txt", length=length))
+        self.assertEqual(response.status_code, 201)
+        return response["Location"]
+
+    def patch(self, url, data, offset):
+        return self.client.generic("PATCH", url, data, HTTP_UPLOAD_OFFSET=str(offset))
+
+    def test_upload(self):
+        url = self.start(11)
+        self.assertEqual(self.patch(url, "hello", 0)["Upload-Offset"], "5")
+        self.assertEqual(self.patch(url, "hello", 0).status_code, 409)
+        self.assertEqual(self.patch(url, " world", 5)["Upload-Offset"], "11")
+        response = self.client.post(url)
+        self.assertEqual(response.status_code, 201)
+        attachment = Attachment.objects.get()
+        self.assertEqual(attachment.checksum, hashlib.md5("hello world").hexdigest())
+        self.assertEqual(attachment.attachment.read(), "hello world")
+        self.assertFalse(UploadSession.objects.exists())
+
+    def test_incomplete(self):
+        url = self.start(11)
+        self.patch(url, "hello", 0)
+        self.assertEqual(self.client.post(url).status_code, 409)
+        self.assertFalse(Attachment.objects.exists())
+
+    def test_finalize_twice(self):
+        url = self.start(11)
+        self.patch(url, "hello world", 0)
+        session = UploadSession.objects.get()
+        uploads.finalize(session)
+        # A second request which loaded the session before
+        # it was removed finds it gone once it gets the lock.
+        self.assertRaises(uploads.UploadConflict, uploads.finalize, session)
+        self.assertEqual(Attachment.objects.count(), 1)
+
+    @override_settings(ATTACHMENT_DEFERRED_PROCESSING=True,
+                       ATTACHMENT_METRICS_BACKENDS=("files.metrics.MemoryBackend", ))
+    def test_finalize_deferred(self):
+        url = self.start(11)
+        self.patch(url, "hello world", 0)
+        session = UploadSession.objects.get()
+        backend = metrics.get_backend(metrics.MemoryBackend)
+        backend.reset()
+        # The spool file is handed to the job queue, which computes
+        # the checksum, rather than hashed by the request.
+        self.assertEqual(self.client.post(url).status_code, 201)
+        self.assertNotIn(("hash", ()), backend.timers)
+        attachment = Attachment.objects.get()
+        self.assertEqual(attachment.status, STATUS_PROCESSING)
+        self.assertFalse(os.path.exists(session.spool))
+        self.assertEqual(pipeline.run_pending(), 1)
+        attachment = Attachment.objects.get()
+        self.assertTrue(attachment.is_ready)
+        self.assertEqual(attachment.checksum, hashlib.md5("hello world").hexdigest())
+        self.assertEqual(attachment.attachment.read(), "hello world")
+
+
+class FakeLargeObject(StringIO):
+    oid = 1234
+    unlinked = False
+
+    def unlink(self):
+        self.unlinked = True
+
+
+@override_settings(ATTACHMENT_STREAMING_UPLOADS=True)
+class StreamingUploadTest(AttachmentTestCase):
+    def post(self, client=None, **data):
+        data = self.form_data(attachment=SimpleUploadedFile("hello.txt", "hello world", "text/plain"), **data)
+        return (client or self.client).post(reverse("add-attachment"), data)
+
+    def test_upload(self):
+        self.login()
+        self.assertEqual(self.post().status_code, 302)
+        attachment = Attachment.objects.get()
+        self.assertEqual(attachment.checksum, hashlib.md5("hello world").hexdigest())
+        self.assertEqual(attachment.attachment.read(), "hello world")
+
+    def test_csrf(self):
+        self.login()
+        client = Client(enforce_csrf_checks=True)
+        client.cookies = self.client.cookies
+        self.assertEqual(self.post(client).status_code, 403)
+        self.assertFalse(Attachment.objects.exists())
+
+    def test_discard_uploads(self):
+        lobject = FakeLargeObject("hello world")
+        f = LargeObjectUploadedFile(lobject, "hello.txt", "text/plain", 11, None, "")
+        discard_uploads(MultiValueDict({"attachment": [f], "other": [SimpleUploadedFile("a.txt", "")]}))
+        self.assertTrue(lobject.unlinked)
+
+
+class IndexTest(AttachmentTestCase):
+    def get_indexes(self):
+        cursor = connection.cursor()
+        cursor.execute("SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = 'files_attachment'")
+        return dict(cursor.fetchall())
+
+    def test_listing_indexes(self):
+        columns = '("content_type_id", "object_id", "site_id", "created", "id")'
+        indexes = self.get_indexes()
+        self.assertIn(columns, indexes["files_attachment_public_lookup"])
+        self.assertEqual(len([sql for sql in indexes.values() if sql and columns in sql]), 2)
+
+    def test_ordering(self):
+        attachments = [self.create_attachment(name="%d.txt" % i) for i in range(3)]
+        # Attachments created at the same time are ordered by id
+        Attachment.objects.update(created=timezone.now())
+        self.assertEqual(list(Attachment.objects.all()), attachments)
+        self.assertEqual(list(Attachment.objects.all().reverse()), attachments[::-1])
+
+
+class ObjectIdTest(AttachmentTestCase):
+    def test_string_pk(self):
+        # Sessions have a string primary key
+        session = Session.objects.create(session_key="abc123", session_data="",
+                                         expire_date=timezone.now())
+        attachment = self.create_attachment(content_object=session)
+        self.create_attachment(name="other.txt")
+        self.assertEqual(list(Attachment.objects.attachments_for_object(session)), [attachment])
+        self.assertEqual(Attachment.objects.get(pk=attachment.pk).content_object, session)
+
+    def test_integer_pk(self):
+        attachment = self.create_attachment()
+        self.assertEqual(Attachment.objects.get(pk=attachment.pk).object_id, unicode(self.shape.pk))
+        ctype = ContentType.objects.get_for_model(self.shape)
+        for object_pk in (self.shape.pk, [self.shape.pk, 42]):
+            qs = files.get_object_attachments(Attachment, ctype, object_pk, AnonymousUser())
+            self.assertEqual([a.pk for a in qs], [attachment.pk])
+
+
+class CleanupTest(AttachmentTestCase):
+    storage = "django.core.files.storage.FileSystemStorage"
+
+    def create_file(self, name, age=0):
+        path = os.path.join(self.media_root, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "wb") as f:
+            f.write("orphan")
+        os.utime(path, (time.time() - age, time.time() - age))
+        return path
+
+    def test_files(self):
+        attachment = self.create_attachment()
+        old = self.create_file("attachments/demosite_shape/1/old.txt", age=7200)
+        new = self.create_file("attachments/demosite_shape/1/new.txt")
+        self.call_command("cleanup_attachments", min_age=3600)
+        self.assertFalse(os.path.exists(old))
+        self.assertTrue(os.path.exists(new))
+        self.assertTrue(os.path.exists(attachment.attachment.path))
+
+    def test_dry_run(self):
+        old = self.create_file("attachments/demosite_shape/1/old.txt", age=7200)
+        output = self.call_command("cleanup_attachments", min_age=3600, dry_run=True)
+        self.assertIn("Would remove 1 orphaned file(s), 6 bytes.", output)
+        self.assertTrue(os.path.exists(old))
+
+    def test_spool(self):
+        spool_dir = pipeline.get_spool_dir()
+        state = self.create_file(os.path.join(spool_dir, cleanup_attachments.LARGE_OBJECT_STATE), age=7200)
+        old = self.create_file(os.path.join(spool_dir, "old"), age=7200)
+        self.call_command("cleanup_attachments", min_age=3600)
+        self.assertFalse(os.path.exists(old))
+        self.assertTrue(os.path.exists(state))
+
+    def test_large_object_state(self):
+        command = cleanup_attachments.Command()
+        self.assertEqual(command.load_large_object_state(), {})
+        command.save_large_object_state({1234: 1.5})
+        self.assertEqual(command.load_large_object_state(), {1234: 1.5})
+
+
+class VerifyTest(AttachmentTestCase):
+    def test_verify(self):
+        self.create_attachment(name="good.txt")
+        bad = self.create_attachment(name="bad.txt")
+        Attachment.objects.filter(pk=bad.pk).update(blob=buffer("hello wOrld"))
+        report = os.path.join(self.media_root, "report.txt")
+        output = self.call_command("verify_attachments", workers=1, report=report)
+        self.assertIn("2 verified, 1 mismatch, 0 missing", output)
+        with open(report) as f:
+            self.assertEqual(f.read(), "mismatch %d\n" % bad.pk)
+
+    def test_checkpoint(self):
+        first = self.create_attachment(name="first.txt")
+        self.create_attachment(name="second.txt")
+        checkpoint = os.path.join(self.media_root, "checkpoint")
+        with open(checkpoint, "w") as f:
+            f.write("%d\n" % first.pk)
+        output = self.call_command("verify_attachments", workers=1, checkpoint=checkpoint)
+        self.assertIn("1 verified, 0 mismatch, 0 missing", output)
+        self.assertIn("0 verified", self.call_command("verify_attachments", workers=1, checkpoint=checkpoint))
+
+    @override_settings(ATTACHMENT_COMPRESSION="gzip")
+    def test_compressed(self):
+        attachment = self.create_attachment("hello world\n" * 1000)
+        self.assertEqual(Attachment.objects.get(pk=attachment.pk).encoding, "gzip")
+        self.assertEqual("".join(read_chunks(self.field.storage, attachment)), "hello world\n" * 1000)
+        self.assertIn("1 verified, 0 mismatch, 0 missing", self.call_command("verify_attachments", workers=1))
+        Attachment.objects.filter(pk=attachment.pk).update(checksum=hashlib.md5("hello world").hexdigest())
+        self.assertIn("1 verified, 1 mismatch, 0 missing", self.call_command("verify_attachments", workers=1))
+
+
+class MigrateTest(AttachmentTestCase):
+    def test_migrate(self):
+        attachment = self.create_attachment()
+        output = self.call_command("migrate_attachments", "SQLiteStorage", "FileSystemStorage", workers=1)
+        self.assertIn("1 migrated, 0 skipped, 0 failed", output)
+        migrated = Attachment.objects.get(pk=attachment.pk)
+        self.assertEqual((migrated.backend, migrated.checksum), ("FileSystemStorage", attachment.checksum))
+        self.assertEqual(str(migrated.blob or ""), "")
+        path = get_backend_storage("FileSystemStorage").path(migrated.attachment.name)
+        self.assertEqual(open(path).read(), "hello world")
+
+        output = self.call_command("migrate_attachments", "FileSystemStorage", "SQLiteStorage", workers=1,
+                                   delete_source=True)
+        self.assertIn("1 migrated", output)
+        migrated = Attachment.objects.get(pk=attachment.pk)
+        self.assertEqual(migrated.backend, "SQLiteStorage")
+        self.assertEqual(get_backend_storage("SQLiteStorage").open(migrated.attachment.name).read(), "hello world")
+        self.assertFalse(os.path.exists(path))
+
+    def test_corrupt_source(self):
+        attachment = self.create_attachment()
+        Attachment.objects.filter(pk=attachment.pk).update(blob=buffer("hello wOrld"))
+        output = self.call_command("migrate_attachments", "SQLiteStorage", "FileSystemStorage", workers=1)
+        self.assertIn("0 migrated, 0 skipped, 1 failed", output)
+        self.assertEqual(Attachment.objects.get(pk=attachment.pk).backend, "SQLiteStorage")
+
+    @override_settings(ATTACHMENT_COMPRESSION="gzip")
+    def test_compressed_source(self):
+        attachment = self.create_attachment("hello world\n" * 1000)
+        self.assertEqual(Attachment.objects.get(pk=attachment.pk).encoding, "gzip")
+        output = self.call_command("migrate_attachments", "SQLiteStorage", "FileSystemStorage", workers=1)
+        self.assertIn("1 migrated", output)
+        migrated = Attachment.objects.get(pk=attachment.pk)
+        self.assertEqual(migrated.encoding, "")
+        path = get_backend_storage("FileSystemStorage").path(migrated.attachment.name)
+        self.assertEqual(open(path).read(), "hello world\n" * 1000)
+
+
+class RoutingStorageTest(AttachmentTestCase):
+    storage = "files.storage.RoutingStorage"
+
+    def test_routing(self):
+        on_disk = self.create_attachment(name="disk.txt")
+        with self.settings(ATTACHMENT_WRITE_BACKEND="SQLiteStorage"):
+            in_db = self.create_attachment("hello database", name="db.txt")
+        self.assertEqual((on_disk.backend, in_db.backend), ("FileSystemStorage", "SQLiteStorage"))
+        self.assertTrue(os.path.exists(os.path.join(self.media_root, on_disk.attachment.name)))
+        self.assertEqual("".join(self.download(on_disk).streaming_content), "hello world")
+        self.assertEqual("".join(self.download(in_db).streaming_content), "hello database")
+
+    def test_route_by_instance(self):
+        attachment = Attachment.objects.get(pk=self.create_attachment().pk)
+        # The backend is taken from the attachment, not looked up by name
+        with self.assertNumQueries(0):
+            storage = get_attachment_storage(attachment)
+        self.assertEqual(storage.__class__.__name__, "FileSystemStorage")
+
+    def test_file_chunks_close(self):
+        f = File(StringIO("hello world"))
+        chunks = file_chunks(f, 5)
+        self.assertEqual(chunks.next(), "hello")
+        chunks.close()
+        self.assertTrue(f.closed)
+
+
+@override_settings(ATTACHMENT_INLINE_MAX_SIZE=100)
+class HybridStorageTest(AttachmentTestCase):
+    storage = "files.storage.HybridStorage"
+
+    def test_backend_by_size(self):
+        small = self.create_attachment("x" * 100, name="small.txt")
+        large = self.create_attachment("x" * 101, name="large.txt")
+        self.assertEqual(small.backend, "SQLiteStorage")
+        self.assertEqual(large.backend, "FileSystemStorage")
+        self.assertEqual("".join(self.download(small).streaming_content), "x" * 100)
+        self.assertEqual("".join(self.download(large).streaming_content), "x" * 101)
+
+    def test_available_name(self):
+        # Names are unique across the backends, as reads by name are routed
+        small = self.create_attachment("x", name="hello.txt")
+        large = self.create_attachment("x" * 101, name="hello.txt")
+        self.assertNotEqual(small.attachment.name, large.attachment.name)
+
+
+@override_settings(ATTACHMENT_COMPRESSION="gzip")
+class CompressionTest(AttachmentTestCase):
+    data = "hello world\n" * 1000
+
+    def test_accepts_encoding(self):
+        self.assertTrue(accepts_encoding("gzip, deflate", "gzip"))
+        self.assertTrue(accepts_encoding("deflate, GZIP;q=0.5", "gzip"))
+        self.assertTrue(accepts_encoding("*", "gzip"))
+        self.assertFalse(accepts_encoding("gzip;q=0", "gzip"))
+        self.assertFalse(accepts_encoding("gzip; q=0.0, *", "gzip"))
+        self.assertFalse(accepts_encoding("deflate, x-gzip2", "gzip"))
+        self.assertFalse(accepts_encoding("", "gzip"))
+
+    def test_stored_compressed(self):
+        attachment = self.create_attachment(self.data)
+        row = Attachment.objects.get(pk=attachment.pk)
+        self.assertEqual(row.encoding, "gzip")
+        self.assertTrue(len(row.blob) < len(self.data))
+        self.assertEqual(self.field.storage.open(row.attachment.name).read(), self.data)
+
+    def test_download_encoded(self):
+        attachment = self.create_attachment(self.data)
+        response = self.download(attachment, HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertEqual(zlib.decompress("".join(response.streaming_content), 31), self.data)
+
+    def test_download_refused(self):
+        attachment = self.create_attachment(self.data)
+        response = self.download(attachment, HTTP_ACCEPT_ENCODING="gzip;q=0")
+        self.assertFalse(response.has_header("Content-Encoding"))
+        self.assertEqual("".join(response.streaming_content), self.data)
+
+    def test_backend_without_stream_encoded(self):
+        self.assertFalse(hasattr(DatabaseStorage(), "stream_encoded"))
+
+
+@override_settings(ATTACHMENT_PRECOMPRESS=True)
+class PrecompressTest(AttachmentTestCase):
+    storage = "django.core.files.storage.FileSystemStorage"
+    data = "hello world\n" * 1000
+
+    def test_sent_uncompressed_until_created(self):
+        attachment = self.create_attachment(self.data)
+        response = self.download(attachment, HTTP_ACCEPT_ENCODING="gzip")
+        self.assertFalse(response.has_header("Content-Encoding"))
+        self.assertEqual("".join(response.streaming_content), self.data)
+        self.assertEqual(AttachmentJob.objects.filter(task=pipeline.TASK_PRECOMPRESS).count(), 1)
+        self.download(attachment, HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(AttachmentJob.objects.filter(task=pipeline.TASK_PRECOMPRESS).count(), 1)
+
+        self.assertEqual(pipeline.run_pending(), 1)
+        response = self.download(attachment, HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertEqual(zlib.decompress("".join(response.streaming_content), 31), self.data)
+
+    def test_refused(self):
+        attachment = self.create_attachment(self.data)
+        pipeline.enqueue(attachment, pipeline.TASK_PRECOMPRESS)
+        pipeline.run_pending()
+        response = self.download(attachment, HTTP_ACCEPT_ENCODING="gzip;q=0, identity")
+        self.assertFalse(response.has_header("Content-Encoding"))
+        self.assertEqual("".join(response.streaming_content), self.data)
+
+    @override_settings(ATTACHMENT_PRECOMPRESS="upload")
+    def test_upload(self):
+        attachment = self.create_attachment(self.data)
+        self.assertTrue(AttachmentJob.objects.filter(attachment=attachment, task=pipeline.TASK_PRECOMPRESS).exists())
+
+
+class DerivativeTest(AttachmentTestCase):
+    def create_image(self, size=(200, 100)):
+        out = StringIO()
+        derivatives.Image.new("RGB", size, "red").save(out, "PNG")
+        return self.create_attachment(out.getvalue(), name="red.png", mimetype="image/png")
+
+    def get_derivative(self, attachment, spec="thumbnail"):
+        return self.client.get(reverse("derivative-attachment", kwargs={"slug": attachment.slug, "spec": spec}))
+
+    def test_generated_by_workers(self):
+        attachment = self.create_image()
+        response = self.get_derivative(attachment)
+        self.assertEqual(response.status_code, 503)
+        self.assertFalse(AttachmentDerivative.objects.exists())
+        self.get_derivative(attachment, "preview")
+        self.assertEqual(AttachmentJob.objects.filter(task=pipeline.TASK_GENERATE_DERIVATIVES).count(), 1)
+
+        self.assertEqual(pipeline.run_pending(), 1)
+        response = self.get_derivative(attachment)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "image/jpeg")
+        derivative = AttachmentDerivative.objects.get(attachment=attachment, spec="thumbnail")
+        self.assertEqual((derivative.width, derivative.height), (128, 64))
+
+    @override_settings(ATTACHMENT_DERIVATIVE_MAX_PIXELS=100 * 100)
+    def test_too_large(self):
+        attachment = self.create_image()
+        self.get_derivative(attachment)
+        pipeline.run_pending()
+        self.assertEqual(self.get_derivative(attachment).status_code, 404)
+        derivative = AttachmentDerivative.objects.get(attachment=attachment, spec="thumbnail")
+        self.assertEqual(derivative.size, 0)
+        # Refused for good, rather than queued again
+        self.assertEqual(self.get_derivative(attachment).status_code, 404)
+        self.assertEqual(AttachmentJob.objects.count(), 1)
+
+    @override_settings(ATTACHMENT_DERIVATIVE_MAX_PIXELS=100 * 100)
+    def test_not_decoded(self):
+        out = StringIO()
+        derivatives.Image.new("RGB", (200, 100), "red").save(out, "PNG")
+        # A truncated image fails only once it is decoded
+        image = StringIO(out.getvalue()[:100])
+        self.assertRaises(derivatives.ImageTooLarge, derivatives.render, image, {"size": (128, 128)})
+
+
+class SlugTest(AttachmentTestCase):
+    def test_placeholder(self):
+        attachment = self.create_attachment()
+        self.assertTrue(attachment.has_slug)
+        url = reverse("download-attachment", kwargs={"slug": attachment.slug})
+        self.assertEqual(self.field.storage.url(attachment.attachment.name), url)
+
+        # Inserted, but the binary data is not written yet
+        Attachment.objects.filter(pk=attachment.pk).update(slug=SLUG_PLACEHOLDER_PREFIX + uuid.uuid4().hex)
+        attachment = Attachment.objects.get(pk=attachment.pk)
+        self.assertFalse(attachment.has_slug)
+        self.assertNotEqual(self.field.storage.url(attachment.attachment.name), url)
+        self.assertFalse(Attachment(slug="").has_slug)
+
+    def test_hex_slug(self):
+        # Real slugs may look like a uuid, i.e. for a file named by its hash
+        attachment = self.create_attachment(name="%s.txt" % ("a" * 32))
+        Attachment.objects.filter(pk=attachment.pk).update(slug="a" * 32)
+        self.assertTrue(Attachment.objects.get(pk=attachment.pk).has_slug)
+
+
+class BenchmarkTest(AttachmentTestCase):
+    def test_run(self):
+        output = os.path.join(self.media_root, "benchmark.json")
+        stdout = self.call_command("benchmark_attachments", backends="FileSystemStorage", sizes="1K",
+                                   concurrency="1", iterations=2, output=output)
+        self.assertEqual(stdout.count("Peak RSS"), 1)
+        with open(output) as f:
+            result = json.load(f)
+        self.assertTrue(result["meta"]["max_rss_kb"] > 0)
+        self.assertEqual([r["operation"] for r in result["results"]], ["upload", "download", "list"])
+        self.assertFalse(any("max_rss_kb" in r for r in result["results"]))
+        self.assertFalse(result["meta"]["blob_cache"]["enabled"])
+        self.assertEqual(result["results"][1]["cache_hits"], None)
+        self.assertFalse(Attachment.objects.exists())
+
+
+class BenchmarkCacheTest(BlobCacheTestMixin, AttachmentTestCase):
+    def test_download_cache(self):
+        output = os.path.join(self.media_root, "benchmark.json")
+        self.call_command("benchmark_attachments", backends="SQLiteStorage", sizes="1K",
+                          concurrency="1", iterations=2, output=output)
+        with open(output) as f:
+            result = json.load(f)
+        self.assertTrue(result["meta"]["blob_cache"]["enabled"])
+        self.assertEqual(result["meta"]["blob_cache"]["max_bytes"], blob_cache.max_bytes)
+        # The uploaded files are not in the cache when the downloads start
+        download = [r for r in result["results"] if r["operation"] == "download"][0]
+        self.assertEqual(download["cache_hits"], 0)
+
+
+@override_settings(ATTACHMENT_METRICS_BACKENDS=("files.metrics.MemoryBackend", ))
+class MetricsTest(AttachmentTestCase):
+    storage = "files.storage.FileSystemStorage"
+
+    def setUp(self):
+        super(MetricsTest, self).setUp()
+        self.backend = metrics.get_backend(metrics.MemoryBackend)
+        self.backend.reset()
+
+    def test_file_system(self):
+        attachment = self.create_attachment()
+        self.backend.reset()
+        self.field.storage.open(attachment.attachment.name).close()
+        self.field.storage.delete(attachment.attachment.name)
+        self.field.storage.save("hello.txt", SimpleUploadedFile("hello.txt", "hello world"))
+        labels = (("backend", "FileSystemStorage"), )
+        for name in ("storage.open", "storage.write", "storage.delete"):
+            self.assertEqual(self.backend.timers[(name, labels)][0], 1)
+        self.assertEqual(self.backend.counters[("storage.write.bytes", labels)], len("hello world"))
+
+    def test_export(self):
+        metrics.incr("cache.hit")
+        metrics.timing("storage.open", 0.5, backend="SQLiteStorage")
+        metrics.timing("storage.open", 0.25, backend="SQLiteStorage")
+        self.assertEqual(self.backend.export().splitlines(), [
+            "# TYPE files_cache_hit_total counter",
+            "files_cache_hit_total 1",
+            "# TYPE files_storage_open_seconds summary",
+            'files_storage_open_seconds_count{backend="SQLiteStorage"} 2',
+            'files_storage_open_seconds_sum{backend="SQLiteStorage"} 0.750000',
+            "# TYPE files_storage_open_max_seconds gauge",
+            'files_storage_open_max_seconds{backend="SQLiteStorage"} 0.500000',
+        ])
+
+
+class LogRecorder(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+@override_settings(ATTACHMENT_PROFILING=True,
+                   MIDDLEWARE_CLASSES=settings.MIDDLEWARE_CLASSES + ("files.profiling.ProfilingMiddleware", ))
+class ProfilingTest(AttachmentTestCase):
+    def setUp(self):
+        super(ProfilingTest, self).setUp()
+        self.handler = LogRecorder()
+        profiling.logger.addHandler(self.handler)
+        profiling.logger.setLevel(logging.DEBUG)
+
+    def tearDown(self):
+        profiling.logger.removeHandler(self.handler)
+        profiling.logger.setLevel(logging.NOTSET)
+        super(ProfilingTest, self).tearDown()
+
+    def test_download(self):
+        attachment = self.create_attachment()
+        response = self.download(attachment)
+        self.assertTrue(response["Server-Timing"].startswith("meta;dur="))
+        self.assertEqual(self.handler.messages, [])
+        self.assertEqual("".join(response.streaming_content), "hello world")
+        self.assertEqual(len(self.handler.messages), 1)
+        message = self.handler.messages[0]
+        self.assertTrue(message.startswith("GET /attachments/download/%s/ 200 meta=" % attachment.slug), message)
+        self.assertTrue("send=" in message and "total=" in message)
+
+    def test_other_requests(self):
+        response = self.client.get(reverse("attachment-metrics"))
+        self.assertFalse(response.has_header("Server-Timing"))
+        self.assertEqual(self.handler.messages, [])
+        self.assertEqual(profiling.current(), None)
+
+    def test_no_profile(self):
+        profiling.deactivate()
+        with profiling.phase("read"):
+            pass
+        self.assertEqual(list(profiling.timed_chunks(iter(["a", "b"]), "read")), ["a", "b"])
+
+
+class SelectRelatedTest(AttachmentTestCase):
+    template = Template("{% load attachments %}"
+                        "{% get_attachment_list for shape as attachments %}"
+                        "{% for attachment in attachments %}"
+                        "{{ attachment.creator.username }} {{ attachment.content_type }} {{ attachment.site }}"
+                        "{% endfor %}")
+
+    def render(self):
+        return self.template.render(Context({"shape": self.shape, "user": self.user}))
+
+    def test_listing(self):
+        for i in range(3):
+            self.create_attachment()
+        self.render()
+        with self.assertNumQueries(1):
+            self.assertEqual(self.render().count("alice"), 3)
+        with override_settings(ATTACHMENT_SELECT_RELATED=()):
+            with self.assertNumQueries(1 + 3 * 3):
+                self.render()
+
+    def test_manager(self):
+        self.assertFalse(Attachment.objects.all().query.select_related)
+
+
+class PaginationTest(AttachmentTestCase):
+    def setUp(self):
+        super(PaginationTest, self).setUp()
+        self.pks = [self.create_attachment().pk for i in range(5)]
+        # Rows created at the same time are ordered by pk
+        Attachment.objects.filter(pk__in=self.pks[1:3]).update(created=Attachment.objects.get(pk=self.pks[1]).created)
+
+    def test_paginate(self):
+        pks, cursor = [], None
+        while True:
+            page = pagination.paginate(Attachment.objects.all(), cursor, 2)
+            pks.extend(attachment.pk for attachment in page)
+            if not page.has_next:
+                break
+            cursor = page.next_cursor
+        self.assertEqual(pks, self.pks)
+
+    def test_invalid_cursor(self):
+        self.assertRaises(pagination.InvalidCursor, pagination.paginate, Attachment.objects.all(), "bogus")
+
+    def test_list_view(self):
+        url = reverse("list-attachments", kwargs={"content_type": ContentType.objects.get_for_model(Shape).pk,
+                                                  "object_id": self.shape.pk})
+        data = json.loads(self.client.get(url, {"limit": 3, "fields": "slug"}).content)
+        self.assertEqual(len(data["results"]), 3)
+        data = json.loads(self.client.get(data["next"]).content)
+        self.assertEqual(len(data["results"]), 2)
+        self.assertEqual(data["next"], None)
+        self.assertEqual(self.client.get(url, {"cursor": "bogus"}).status_code, 400)
+
+
+class JSONFieldsTest(AttachmentTestCase):
+    def setUp(self):
+        super(JSONFieldsTest, self).setUp()
+        self.attachment = self.create_attachment(description="greeting")
+        self.other = Shape.objects.create(shape="circle", color="blue")
+        self.create_attachment(content_object=self.other)
+        self.ctype = ContentType.objects.get_for_model(Shape)
+
+    def batch(self, fields):
+        url = reverse("batch-attachments")
+        return self.client.get(url, {"content_type": self.ctype.pk, "object_id": "%d,%d" % (self.shape.pk, self.other.pk),
+                                     "fields": fields})
+
+    def test_only_selected_columns(self):
+        # The content type, and the attachments
+        with self.assertNumQueries(2):
+            response = self.batch("slug,size")
+        data = json.loads(response.content)
+        self.assertEqual(data[str(self.shape.pk)], [{"slug": self.attachment.slug, "size": 11}])
+        sql = connection.queries[-1]["sql"]
+        self.assertFalse("description" in sql or "auth_user" in sql, sql)
+
+    def test_creator(self):
+        # The content type, and the attachments
+        with self.assertNumQueries(2):
+            data = json.loads(self.batch("creator,download_url").content)
+        self.assertEqual(data[str(self.other.pk)][0]["creator"], "alice")
+        self.assertTrue("auth_user" in connection.queries[-1]["sql"])
+
+    def test_list(self):
+        url = reverse("list-attachments", kwargs={"content_type": self.ctype.pk, "object_id": self.shape.pk})
+        # The content type, and the attachments
+        with self.assertNumQueries(2):
+            data = json.loads(self.client.get(url, {"fields": "filename", "limit": 1}).content)
+        self.assertEqual(data["results"], [{"filename": "hello.txt"}])
+
+
+@override_settings(ATTACHMENT_COUNTERS=True)
+class CounterTest(AttachmentTestCase):
+    def setUp(self):
+        super(CounterTest, self).setUp()
+        self.ctype = ContentType.objects.get_for_model(Shape)
+
+    def test_count(self):
+        self.create_attachment()
+        self.create_attachment(is_public=False)
+        with self.assertNumQueries(1):
+            self.assertEqual(counters.get_count(self.ctype, self.shape.pk, AnonymousUser()), 1)
+        # The private attachments of the user are counted with a query
+        with self.assertNumQueries(2):
+            self.assertEqual(counters.get_count(self.ctype, self.shape.pk, self.user), 2)
+
+    def test_delete(self):
+        attachment = self.create_attachment()
+        attachment.delete()
+        self.assertEqual(counters.get_count(self.ctype, self.shape.pk), 0)
+
+    def test_migrate(self):
+        self.create_attachment()
+        self.call_command("migrate_attachments", "SQLiteStorage", "FileSystemStorage", workers=1)
+        counter = AttachmentCounter.objects.get()
+        self.assertEqual((counter.backend, counter.count, counter.size), ("FileSystemStorage", 1, 11))
+
+
+@override_settings(ATTACHMENT_QUOTAS=True, ATTACHMENT_USER_QUOTA={"count": 1})
+class QuotaTest(AttachmentTestCase):
+    def post(self):
+        data = self.form_data(attachment=SimpleUploadedFile("hello.txt", "hello world", "text/plain"))
+        return self.client.post(reverse("add-attachment"), data)
+
+    def test_form(self):
+        self.login()
+        self.assertEqual(self.post().status_code, 302)
+        response = self.post()
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context["form"].errors["attachment"])
+        self.assertEqual(Attachment.objects.count(), 1)
+        self.assertEqual(quotas.get_usage(quotas.USER, self.user), (1, 11))
+
+    def test_exceeded_on_save(self):
+        # Another upload used up the quota after the form was validated
+        self.login()
+        self.create_attachment()
+        check, quotas.check = quotas.check, lambda *args: None
+        try:
+            response = self.post()
+        finally:
+            quotas.check = check
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context["form"].errors["attachment"])
+        self.assertEqual(Attachment.objects.count(), 1)
+        self.assertEqual(quotas.get_usage(quotas.USER, self.user), (1, 11))
+        self.assertEqual(quotas.get_usage(quotas.OBJECT, self.shape), (1, 11))
+
+    def test_reconcile(self):
+        self.create_attachment()
+        AttachmentUsage.objects.all().delete()
+        self.assertEqual(quotas.reconcile(), (0, 2, 0))
+        self.assertEqual(quotas.get_usage(quotas.OBJECT, self.shape), (1, 11))
+
+
+@override_settings(ATTACHMENT_COUNTERS=True, ATTACHMENT_QUOTAS=True)
+class BulkDeleteTest(AttachmentTestCase):
+    def setUp(self):
+        super(BulkDeleteTest, self).setUp()
+        self.attachments = [self.create_attachment() for i in range(5)]
+        self.other = Shape.objects.create(shape="circle", color="blue")
+        self.kept = self.create_attachment(content_object=self.other)
+        pipeline.enqueue(self.attachments[0], pipeline.TASK_PRECOMPRESS)
+        self.ctype = ContentType.objects.get_for_model(Shape)
+
+    def test_bulk_delete(self):
+        unlinked = []
+        receiver = lambda sender, pks, names, **kwargs: unlinked.extend(pks)
+        post_bulk_unlink.connect(receiver)
+        try:
+            deleted = Attachment.objects.bulk_delete(Attachment.objects.filter(object_id=self.shape.pk),
+                                                     batch_size=2, workers=1)
+        finally:
+            post_bulk_unlink.disconnect(receiver)
+        self.assertEqual(deleted, 5)
+        self.assertEqual(sorted(unlinked), sorted(a.pk for a in self.attachments))
+        self.assertEqual(list(Attachment.objects.values_list("pk", flat=True)), [self.kept.pk])
+        self.assertFalse(AttachmentJob.objects.exists())
+        self.assertEqual(counters.get_count(self.ctype, self.shape.pk), 0)
+        self.assertEqual(counters.get_count(self.ctype, self.other.pk), 1)
+        self.assertEqual(quotas.get_usage(quotas.OBJECT, self.shape), (0, 0))
+        self.assertEqual(quotas.get_usage(quotas.USER, self.user), (1, 11))
+
+    def test_admin_action(self):
+        self.user.is_staff = True
+        self.login()
+        url = reverse("admin:files_attachment_changelist")
+        data = {"action": "bulk_delete_selected",
+                helpers.ACTION_CHECKBOX_NAME: [a.pk for a in self.attachments]}
+        response = self.client.post(url, data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context["count"], 5)
+        self.assertEqual(Attachment.objects.count(), 6)
+
+        data["post"] = "yes"
+        self.assertEqual(self.client.post(url, data).status_code, 302)
+        self.assertEqual(list(Attachment.objects.values_list("pk", flat=True)), [self.kept.pk])
+
+
+class BulkDeleteTransactionTest(AttachmentTestMixin, TransactionTestCase):
+    """
+    Runs outside the transaction of TestCase, so the batches are
+    actually committed.
+    """
+    def test_commit_batches(self):
+        self.create_attachment()
+        self.assertEqual(Attachment.objects.bulk_delete(batch_size=1, workers=1), 1)
+        transaction.rollback()
+        self.assertFalse(Attachment.objects.exists())
+
+    def test_join_transaction(self):
+        attachments = [self.create_attachment() for i in range(2)]
+        transaction.enter_transaction_management()
+        transaction.managed(True)
+        try:
+            self.assertEqual(Attachment.objects.bulk_delete(batch_size=1, workers=1), 2)
+            # The batches are part of this transaction, and are
+            # rolled back with it.
+            transaction.rollback()
+        finally:
+            transaction.leave_transaction_management()
+        self.assertEqual(Attachment.objects.count(), len(attachments))
+
+
+@override_settings(ATTACHMENT_ADMIN_BACKGROUND_THRESHOLD=2)
+class BulkJobTest(AttachmentTestCase):
+    def setUp(self):
+        super(BulkJobTest, self).setUp()
+        self.attachments = [self.create_attachment() for i in range(5)]
+        self.batch_size, pipeline.BULK_BATCH_SIZE = pipeline.BULK_BATCH_SIZE, 2
+
+    def tearDown(self):
+        pipeline.BULK_BATCH_SIZE = self.batch_size
+        super(BulkJobTest, self).tearDown()
+
+    def get_actions(self, user):
+        request = RequestFactory().get("/")
+        request.user = user
+        return AttachmentAdmin(Attachment, site).get_actions(request)
+
+    def test_actions(self):
+        self.user.is_superuser = True
+        actions = self.get_actions(self.user)
+        self.assertFalse("delete_selected" in actions)
+        self.assertEqual(actions["bulk_delete_selected"][2], "Delete selected attachments")
+        self.user.is_superuser = False
+        self.assertFalse("bulk_delete_selected" in self.get_actions(self.user))
+
+    def test_spool(self):
+        job = pipeline.enqueue_bulk(Attachment.objects.all(), pipeline.TASK_BULK_UPDATE, {"is_public": False})
+        self.assertEqual(job.total, 5)
+        with open(job.spool) as f:
+            self.assertEqual(f.read().splitlines(),
+                             ['{"is_public": false}'] + [str(a.pk) for a in self.attachments])
+
+    def test_background_update(self):
+        self.user.is_staff = True
+        self.login()
+        url = reverse("admin:files_attachment_changelist")
+        self.client.post(url, {"action": "set_is_private",
+                               helpers.ACTION_CHECKBOX_NAME: [a.pk for a in self.attachments]})
+        job = AttachmentJob.objects.get(task=pipeline.TASK_BULK_UPDATE)
+        self.assertEqual(Attachment.objects.filter(is_public=False).count(), 0)
+
+        self.assertEqual(pipeline.run_pending(), 1)
+        job = AttachmentJob.objects.get(pk=job.pk)
+        self.assertEqual((job.status, job.progress, job.total), (AttachmentJob.DONE, 5, 5))
+        self.assertEqual(Attachment.objects.filter(is_public=False).count(), 5)
+        self.assertFalse(os.path.exists(job.spool))
+
+    def test_background_delete(self):
+        pks = [a.pk for a in self.attachments[:3]]
+        pipeline.enqueue_bulk(Attachment.objects.filter(pk__in=pks), pipeline.TASK_BULK_DELETE)
+        pipeline.run_pending()
+        self.assertEqual(list(Attachment.objects.values_list("pk", flat=True)), [a.pk for a in self.attachments[3:]])
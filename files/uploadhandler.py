@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+#
+# Upload handler which writes uploaded files straight
+# to the storage backend while they are received.
+#
+
+import hashlib
+from django.conf import settings
+from django.db import connections, router
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import TemporaryFileUploadHandler, StopUpload
+from django.core.files.storage import get_storage_class
+
+from files.models import Attachment
+
+
+class LargeObjectUploadedFile(UploadedFile):
+    """
+    A file uploaded directly into a PostgreSQL large object.
+    The `oid` and `checksum` attributes are used by the
+    PostgreSQLStorage to link the large object to the attachment
+    without reading or writing the data once more.
+    """
+    def __init__(self, lobject, name, content_type, size, charset, checksum):
+        super(LargeObjectUploadedFile, self).__init__(lobject, name, content_type, size, charset)
+        self.oid = lobject.oid
+        self.checksum = checksum
+
+    def close(self):
+        # The large object is closed, but not unlinked, as
+        # it is linked to the attachment by the storage.
+        if not self.file.closed:
+            self.file.close()
+
+    def unlink(self):
+        self.file.unlink()
+
+
+class StreamingBlobUploadHandler(TemporaryFileUploadHandler):
+    """
+    Upload handler which computes the md5 checksum of uploaded files
+    while they are received.
+
+    If the PostgreSQLStorage is used, the file is written directly
+    into a new large object. Other backends get a TemporaryUploadedFile,
+    as with Django's default handler, which carries the precomputed checksum.
+
+    The attachment upload views install the handler for their own
+    requests if settings.ATTACHMENT_STREAMING_UPLOADS is True (see
+    `files.views.StreamingUploadMixin`). Large objects of files which
+    end up not being saved must be removed with `discard_uploads`.
+
+    Uploads larger than ATTACHMENT_MAX_SIZE are aborted while they are
+    received.
+    """
+
+    def new_file(self, file_name, *args, **kwargs):
+        self.md5 = hashlib.md5()
+        self.lobject = None
+        storage_class = get_storage_class()
+        backend = storage_class.__name__
+        if getattr(storage_class, "is_routing", False):
+            backend = storage_class().get_backend_name(None)
+        if backend == "PostgreSQLStorage":
+            # Only the file name, content type and charset are needed.
+            super(TemporaryFileUploadHandler, self).new_file(file_name, *args, **kwargs)
+            using = router.db_for_write(Attachment)
+            cursor = connections[using].cursor()
+            self.lobject = cursor.db.connection.lobject(0, "rwb")
+        else:
+            super(StreamingBlobUploadHandler, self).new_file(file_name, *args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        max_size = getattr(settings, "ATTACHMENT_MAX_SIZE", None)
+        if max_size and start + len(raw_data) > max_size:
+            # No point in receiving the rest of the file.
+            self.abort()
+            raise StopUpload(connection_reset=True)
+        self.md5.update(raw_data)
+        if self.lobject is not None:
+            self.lobject.write(raw_data)
+        else:
+            self.file.write(raw_data)
+
+    def file_complete(self, file_size):
+        checksum = u"%s" % self.md5.hexdigest()
+        if self.lobject is not None:
+            self.lobject.seek(0)
+            return LargeObjectUploadedFile(self.lobject, self.file_name, self.content_type,
+                                           file_size, self.charset, checksum)
+        f = super(StreamingBlobUploadHandler, self).file_complete(file_size)
+        f.checksum = checksum
+        return f
+
+    def abort(self):
+        if self.lobject is not None:
+            self.lobject.unlink()
+            self.lobject = None
+
+
+def discard_uploads(files):
+    """
+    Unlink the large objects of uploaded files which are not saved,
+    i.e. files received for an invalid form. Takes the request.FILES
+    of the request.
+    """
+    for name, uploaded_files in files.lists():
+        for f in uploaded_files:
+            if isinstance(f, LargeObjectUploadedFile):
+                f.unlink()
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+#
+# Resumable uploads.
+#
+# A client creates an UploadSession, sends the file in one or more chunks
+# (each starting at the offset the server has acknowledged so far), and
+# finalizes the session, which turns the received file into an Attachment.
+# Chunks are appended to a spool file, which may be written by any of the
+# processes serving the site, so the checksum is computed from the spool
+# file when the session is finalized: by the job queue if
+# settings.ATTACHMENT_DEFERRED_PROCESSING is set, and otherwise before the
+# session row is locked. Chunks can not be appended to a complete upload,
+# so the spool file does not change in between.
+#
+
+import os
+import uuid
+import fcntl
+import errno
+import mimetypes
+
+from django.conf import settings
+from django.db import transaction
+from django.core.files.uploadedfile import UploadedFile
+
+from files import quotas
+from files.utils import md5buffer
+from files.models import Attachment, UploadSession
+from files.pipeline import get_spool_dir, remove_spool
+
+
+class UploadError(Exception):
+    """
+    Raised when a chunk or session can not be accepted.
+    The status attribute is the HTTP status to respond with.
+    """
+    status = 400
+
+
+class UploadConflict(UploadError):
+    status = 409
+
+
+class UploadTooLarge(UploadError):
+    status = 413
+
+
+class SpooledUploadedFile(UploadedFile):
+    """
+    An uploaded file which has been received in chunks to a spool file.
+    Behaves like a TemporaryUploadedFile, so the spool file can be moved
+    into place rather than copied by storage backends which support it.
+    """
+    def __init__(self, path, name, content_type, size, checksum=None):
+        super(SpooledUploadedFile, self).__init__(open(path, "rb"), name, content_type, size, None)
+        self.checksum = checksum
+
+    def temporary_file_path(self):
+        return self.file.name
+
+
+def create_session(form, creator, ip_address=None):
+    """
+    Create an UploadSession from a valid UploadSessionForm.
+    """
+    session = form.save(commit=False)
+    session.token = uuid.uuid4().hex
+    session.creator = creator
+    session.ip_address = ip_address
+    if not session.mimetype:
+        session.mimetype = mimetypes.guess_type(session.filename)[0]
+    session.spool = os.path.join(get_spool_dir(), session.token)
+    open(session.spool, "wb").close()
+    session.save()
+    return session
+
+
+def append_chunk(session, stream, offset, length, chunk_size=65536):
+    """
+    Append length bytes read from stream to the session, starting
+    at offset. Returns the new offset of the session.
+    """
+    if offset + length > session.length:
+        raise UploadTooLarge("Chunk exceeds the upload length.")
+
+    with open(session.spool, "r+b") as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, e:
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                raise UploadConflict("Another chunk is being written to this upload.")
+            raise e
+
+        # Another process may have received chunks since the
+        # session was loaded, so check the offset once more.
+        current = UploadSession.objects.using(session._state.db) \
+            .values_list("offset", flat=True).get(pk=session.pk)
+        if offset != current:
+            raise UploadConflict("Upload offset is %d, not %d." % (current, offset))
+
+        f.seek(offset)
+        f.truncate()
+        received = 0
+        while received < length:
+            chunk = stream.read(min(chunk_size, length - received))
+            if not chunk:
+                break
+            f.write(chunk)
+            received += len(chunk)
+        f.flush()
+
+        # A client which disconnects before the whole chunk is
+        # received can resume from whatever was written.
+        session.offset = offset + received
+        UploadSession.objects.using(session._state.db).filter(pk=session.pk) \
+            .update(offset=session.offset)
+    return session.offset
+
+
+def finalize(session):
+    """
+    Create an Attachment from a complete upload session,
+    and remove the session.
+    """
+    using = session._state.db
+    checksum = None
+    if session.is_complete and getattr(settings, "ATTACHMENT_DEFERRED_PROCESSING", False) is not True:
+        try:
+            with open(session.spool, "rb") as f:
+                checksum = md5buffer(f)
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                # Removed by a concurrent request finalizing the upload
+                raise UploadConflict("Upload has already been finalized.")
+            raise e
+    with transaction.commit_on_success(using=using):
+        # Lock the session row, so a concurrent request finalizing
+        # the same upload waits here, and finds the session removed.
+        try:
+            session = UploadSession.objects.using(using).select_for_update().get(pk=session.pk)
+        except UploadSession.DoesNotExist:
+            raise UploadConflict("Upload has already been finalized.")
+        if not session.is_complete:
+            raise UploadConflict("Upload is not complete (%d of %d bytes)." % (session.offset, session.length))
+
+        content = SpooledUploadedFile(session.spool, session.filename, session.mimetype, session.length,
+                                      checksum)
+        attachment = Attachment(content_type=session.content_type, object_id=session.object_id,
+                                site=session.site, creator=session.creator, ip_address=session.ip_address,
+                                description=session.description, is_public=session.is_public,
+                                mimetype=session.mimetype, attachment=content)
+        try:
+            attachment.save()
+        except quotas.QuotaExceeded, e:
+            # The session is kept, so the upload can be finalized
+            # once attachments are removed.
+            raise UploadTooLarge(e.messages[0])
+        finally:
+            content.close()
+        session.delete()
+    remove_spool(session.spool)
+    return attachment
+
+
+def abort(session):
+    """
+    Remove the session and the spool file.
+    """
+    remove_spool(session.spool)
+    session.delete()
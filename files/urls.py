@@ -1,7 +1,9 @@
 from django.conf.urls import patterns, url
 
 from files.views import AttachmentCreateView, AttachmentDeleteView, \
-    AttachmentDetailView, AttachmentDownloadView, AttachmentEditView
+    AttachmentDetailView, AttachmentDownloadView, AttachmentEditView, \
+    AttachmentUploadView, AttachmentUploadSessionView, AttachmentDerivativeView, \
+    AttachmentMetricsView, AttachmentListView, AttachmentBatchView
 
 urlpatterns = patterns("files.views",
     url(r"^add/$", view=AttachmentCreateView.as_view(), name="add-attachment"),
@@ -9,4 +11,12 @@ urlpatterns = patterns("files.views",
     url(r"^edit/(?P<slug>[-\w]+)/$", view=AttachmentEditView.as_view(), name="edit-attachment"),
     url(r"^delete/(?P<slug>[-\w]+)/$", view=AttachmentDeleteView.as_view(), name="delete-attachment"),
     url(r"^download/(?P<slug>[-\w]+)/$", view=AttachmentDownloadView.as_view(), name="download-attachment"),
+    url(r"^derivative/(?P<slug>[-\w]+)/(?P<spec>[-\w]+)/$", view=AttachmentDerivativeView.as_view(),
+        name="derivative-attachment"),
+    url(r"^list/(?P<content_type>\d+)/(?P<object_id>[^/]+)/$", view=AttachmentListView.as_view(),
+        name="list-attachments"),
+    url(r"^batch/$", view=AttachmentBatchView.as_view(), name="batch-attachments"),
+    url(r"^metrics/$", view=AttachmentMetricsView.as_view(), name="attachment-metrics"),
+    url(r"^upload/$", view=AttachmentUploadView.as_view(), name="upload-attachment"),
+    url(r"^upload/(?P<token>[0-9a-f]{32})/$", view=AttachmentUploadSessionView.as_view(), name="upload-session"),
 )
@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 
 import hashlib
+from django.db import connections
+
+from files import metrics
 
 
 def md5buffer(f, chunksize=65536):
@@ -10,11 +13,37 @@ def md5buffer(f, chunksize=65536):
     specified size. Defaults to 64 KB.
     """
     md5 = hashlib.md5()
-    f.seek(0)
-    while True:
-        c = f.read(chunksize)
-        if not c:
-            break
-        md5.update(c)
-    f.seek(0)
+    nbytes = 0
+    with metrics.timer("hash"):
+        f.seek(0)
+        while True:
+            c = f.read(chunksize)
+            if not c:
+                break
+            md5.update(c)
+            nbytes += len(c)
+        f.seek(0)
+    metrics.incr("hash.bytes", nbytes)
     return u"%s" % md5.hexdigest()
+
+
+def checksum(content):
+    """
+    Return the md5 checksum of the file. Files which have been
+    hashed while they were received (see `files.uploads`) carry
+    a precomputed `checksum` attribute, which is used instead
+    of reading the file once more.
+    """
+    precomputed = getattr(content, "checksum", None)
+    if precomputed:
+        return precomputed
+    return md5buffer(content)
+
+
+def close_connections():
+    """
+    Close all database connections, i.e. before forking worker
+    processes which should not share the connection of the parent.
+    """
+    for connection in connections.all():
+        connection.close()
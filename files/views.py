@@ -2,13 +2,25 @@
 
 from __future__ import absolute_import
 
+import os
+import json
+import itertools
+from collections import OrderedDict
 from django.conf import settings
+from django.db import router, transaction
 from django.shortcuts import render_to_response
 from django.template.context import RequestContext
 from django.template.loader import select_template
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseRedirect, StreamingHttpResponse, \
+    HttpResponseBadRequest, HttpResponseForbidden, HttpResponseGone, Http404
+from django.shortcuts import get_object_or_404
+from django.utils.cache import patch_vary_headers
+from django.utils.decorators import method_decorator
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
+from django.core.files.base import File
 from django.contrib.contenttypes.models import ContentType
-from django.core.exceptions import ValidationError, ImproperlyConfigured
+from django.core.exceptions import ValidationError, ImproperlyConfigured, ObjectDoesNotExist
+from django.views.generic.base import View
 from django.views.generic.edit import DeleteView, CreateView, UpdateView
 from django.views.generic.detail import DetailView, SingleObjectMixin,\
     BaseDetailView
@@ -16,8 +28,14 @@ from django.views.generic.detail import DetailView, SingleObjectMixin,\
 from braces.views import LoginRequiredMixin, PermissionRequiredMixin,\
     MultiplePermissionsRequiredMixin
 
-from files import get_form
-from files.models import Attachment
+import files
+from files import get_form, uploads, derivatives, metrics, pagination, pipeline, profiling, quotas
+from files.compression import GZIP, is_compressible, accepts_encoding, get_precompressed, \
+    get_stale_siblings
+from files.forms import UploadSessionForm
+from files.models import Attachment, UploadSession, STATUS_FAILED
+from files.storage import get_attachment_storage, file_chunks
+from files.uploadhandler import StreamingBlobUploadHandler, discard_uploads
 
 
 class NextMixin(object):
@@ -37,7 +55,33 @@ class NextMixin(object):
         return url
 
 
-class AttachmentCreateView(LoginRequiredMixin, PermissionRequiredMixin, NextMixin, CreateView):
+class StreamingUploadMixin(object):
+    """
+    A mixin which receives the uploaded files of the view with the
+    StreamingBlobUploadHandler, if settings.ATTACHMENT_STREAMING_UPLOADS
+    is True. Other views are not affected.
+    
+    Upload handlers can't be changed once the request body is read, which
+    the CSRF middleware does, so the CSRF check is done by the view.
+    """
+    @method_decorator(csrf_exempt)
+    def dispatch(self, request, *args, **kwargs):
+        if getattr(settings, "ATTACHMENT_STREAMING_UPLOADS", False):
+            request.upload_handlers.insert(0, StreamingBlobUploadHandler(request))
+        return self._dispatch(request, *args, **kwargs)
+    
+    @method_decorator(csrf_protect)
+    def _dispatch(self, request, *args, **kwargs):
+        return super(StreamingUploadMixin, self).dispatch(request, *args, **kwargs)
+    
+    def form_invalid(self, form):
+        # Files received into large objects are not saved.
+        discard_uploads(self.request.FILES)
+        return super(StreamingUploadMixin, self).form_invalid(form)
+
+
+class AttachmentCreateView(StreamingUploadMixin, LoginRequiredMixin, PermissionRequiredMixin, NextMixin,
+                           CreateView):
     """
     View responsible for creating new attachments.
     """
@@ -49,6 +93,8 @@ class AttachmentCreateView(LoginRequiredMixin, PermissionRequiredMixin, NextMixi
     
     def get_form(self, form_class):
         kwargs = self.get_form_kwargs()
+        # Set the creator up front, so the form can check the quota.
+        kwargs["instance"] = self.model(creator=self.request.user)
         try:
             data = kwargs["data"]
             ctype_pk, object_pk = data.get("content_type"), data.get("object_id")
@@ -71,10 +117,19 @@ class AttachmentCreateView(LoginRequiredMixin, PermissionRequiredMixin, NextMixi
         # Set some additional attributes from request.
         form.instance.creator = self.request.user
         form.instance.ip_address = self.request.META["REMOTE_ADDR"]
-        return super(AttachmentCreateView, self).form_valid(form)
+        try:
+            # The quota ledger and the counters are updated along with the
+            # row, so either all of them are written, or none.
+            with transaction.commit_on_success(using=router.db_for_write(self.model)):
+                return super(AttachmentCreateView, self).form_valid(form)
+        except quotas.QuotaExceeded, e:
+            # The quota was used up by another upload since the form was validated.
+            form._errors["attachment"] = form.error_class(e.messages)
+            return self.form_invalid(form)
     
 
-class AttachmentEditView(LoginRequiredMixin, MultiplePermissionsRequiredMixin, NextMixin, UpdateView):
+class AttachmentEditView(StreamingUploadMixin, LoginRequiredMixin, MultiplePermissionsRequiredMixin, NextMixin,
+                         UpdateView):
     """
     Updates an existing attachment with new data.
     """
@@ -91,6 +146,15 @@ class AttachmentEditView(LoginRequiredMixin, MultiplePermissionsRequiredMixin, N
         obj = self.object.content_type \
             .get_object_for_this_type(pk=self.object.object_id)
         return form_class(obj, **self.get_form_kwargs())
+    
+    def form_valid(self, form):
+        try:
+            with transaction.commit_on_success(using=router.db_for_write(self.model)):
+                return super(AttachmentEditView, self).form_valid(form)
+        except quotas.QuotaExceeded, e:
+            # The quota was used up by another upload since the form was validated.
+            form._errors["attachment"] = form.error_class(e.messages)
+            return self.form_invalid(form)
 
     def get_template_names(self):
         names = super(AttachmentEditView, self).get_template_names()
@@ -179,11 +243,14 @@ class AttachmentDeleteView(LoginRequiredMixin, MultiplePermissionsRequiredMixin,
     
 class AttachmentDownloadView(LoginRequiredMixin, PermissionRequiredMixin, BaseDetailView, SingleObjectMixin):
     """
-    Returns the attachment file as a HttpResponse.
+    Returns the attachment file as a StreamingHttpResponse.
+    The file is sent in chunks, so a slow client does not require
+    the whole file to be held in memory.
     """
     model = Attachment
     context_object_name = "attachment"
     require_auth = getattr(settings, "REQUIRE_AUTH_DOWNLOAD", False)
+    chunk_size = getattr(settings, "ATTACHMENT_DOWNLOAD_CHUNK_SIZE", 64 * 1024)
     raise_exception = True  # If user is not allowed to download the file,
                             # return a HttpResponseForbidden response
     
@@ -199,6 +266,369 @@ class AttachmentDownloadView(LoginRequiredMixin, PermissionRequiredMixin, BaseDe
     
     def render_to_response(self, context):
         obj = context["attachment"]
-        response = HttpResponse(obj.attachment.file.read(), mimetype=obj.mimetype)
+        if not obj.is_ready:
+            return self.get_not_ready_response(obj)
+        storage = get_attachment_storage(obj)
+        if obj.encoding == GZIP and hasattr(storage, "stream_encoded") and \
+                accepts_encoding(self.request.META.get("HTTP_ACCEPT_ENCODING", ""), GZIP):
+            # The stored data is a gzip stream, which the client can
+            # decompress itself. The compressed size is not known
+            # without reading the data, so no Content-Length is sent.
+            response = StreamingHttpResponse(storage.stream_encoded(obj.attachment.name, self.chunk_size),
+                                             mimetype=obj.mimetype)
+            response["Content-Encoding"] = GZIP
+        elif obj.backend == "FileSystemStorage" and getattr(settings, "ATTACHMENT_PRECOMPRESS", False) and \
+                is_compressible(obj.mimetype, obj.size):
+            response = self.get_precompressed_response(obj)
+        else:
+            response = StreamingHttpResponse(self.get_chunks(obj), mimetype=obj.mimetype)
+            response["Content-Length"] = obj.size
+        if obj.encoding == GZIP:
+            patch_vary_headers(response, ("Accept-Encoding", ))
         response["Content-Disposition"] = "inline; filename=%s" % obj.filename
         return response
+    
+    def get_not_ready_response(self, obj):
+        """
+        Return the response for an attachment without binary data; 503
+        while it is being processed, or 410 if processing failed, as
+        the data will never be available.
+        """
+        if obj.status == STATUS_FAILED:
+            return HttpResponseGone()
+        response = HttpResponse(status=503)
+        response["Retry-After"] = 5
+        return response
+    
+    def get_object(self, queryset=None):
+        with profiling.phase("meta"):
+            return super(AttachmentDownloadView, self).get_object(queryset)
+    
+    def get_precompressed_response(self, obj):
+        """
+        Send a precompressed sibling of the file, if the
+        client accepts one of its encodings. Until the siblings
+        have been created by a worker, the file is sent as is.
+        """
+        path = get_attachment_storage(obj).path(obj.attachment.name)
+        sibling = get_precompressed(path, obj.mimetype, obj.size,
+                                    self.request.META.get("HTTP_ACCEPT_ENCODING", ""))
+        if sibling is None:
+            if get_stale_siblings(path):
+                pipeline.enqueue_once(obj, pipeline.TASK_PRECOMPRESS)
+            response = StreamingHttpResponse(self.get_chunks(obj), mimetype=obj.mimetype)
+            response["Content-Length"] = obj.size
+        else:
+            encoding, path = sibling
+            f = open(path, "rb")
+            response = StreamingHttpResponse(file_chunks(File(f), self.chunk_size), mimetype=obj.mimetype)
+            response["Content-Length"] = os.fstat(f.fileno()).st_size
+            response["Content-Encoding"] = encoding
+        patch_vary_headers(response, ("Accept-Encoding", ))
+        return response
+    
+    def get_chunks(self, obj):
+        """
+        Return an iterator over the file contents. Uses the
+        chunked reads of the storage backend if available.
+        """
+        storage = get_attachment_storage(obj)
+        if hasattr(storage, "stream"):
+            chunks = storage.stream(obj.attachment.name, self.chunk_size)
+        else:
+            chunks = profiling.timed_chunks(file_chunks(storage.open(obj.attachment.name), self.chunk_size),
+                                            "read")
+        # Read the first chunk before the response is returned, so errors
+        # raised while opening and verifying the file (i.e. a checksum
+        # mismatch) fail the request rather than truncate the response.
+        for chunk in chunks:
+            chunks = itertools.chain((chunk, ), chunks)
+            break
+        return metrics.count_chunks(chunks, "download", backend=obj.backend)
+
+
+class AttachmentDerivativeView(AttachmentDownloadView):
+    """
+    Returns a derivative (i.e. a thumbnail or preview) of an image
+    attachment. Missing derivatives are queued for the workers, and
+    the response is 503 until they are ready. See `files.derivatives`.
+    """
+    
+    def render_to_response(self, context):
+        obj = context["attachment"]
+        spec = self.kwargs["spec"]
+        if spec not in derivatives.get_specs():
+            raise Http404("No such derivative.")
+        if not obj.is_ready:
+            return self.get_not_ready_response(obj)
+        if not derivatives.is_supported(obj):
+            raise Http404("No derivatives are available for this attachment.")
+        try:
+            derivative = derivatives.get_derivative(obj, spec)
+        except derivatives.ImageTooLarge, e:
+            raise Http404(e)
+        if derivative is None:
+            # Queued for the workers.
+            response = HttpResponse(status=503)
+            response["Retry-After"] = 5
+            return response
+        response = HttpResponse(derivative.read(), mimetype=derivative.mimetype)
+        response["Content-Length"] = derivative.size
+        return response
+
+
+class AttachmentUploadView(LoginRequiredMixin, PermissionRequiredMixin, View):
+    """
+    Starts a resumable upload.
+    
+    POST the fields of the UploadSessionForm (including the security
+    fields from the attachment form) to create an upload session. The
+    response has status 201 and a Location header with the session URL.
+    See `AttachmentUploadSessionView` for how to send the file.
+    """
+    form_class = UploadSessionForm
+    permission_required = "files.add_attachment"
+    raise_exception = True
+    
+    def post(self, request, *args, **kwargs):
+        try:
+            ctype = ContentType.objects.get_for_id(request.POST.get("content_type"))
+            target = ctype.get_object_for_this_type(pk=request.POST.get("object_id"))
+        except (ObjectDoesNotExist, ValueError, TypeError):
+            return HttpResponseBadRequest("No matching content-type id and object id exists.")
+        
+        form = self.form_class(target, data=request.POST, instance=UploadSession(creator=request.user))
+        if not form.is_valid():
+            return HttpResponseBadRequest(json.dumps(form.errors), content_type="application/json")
+        session = uploads.create_session(form, request.user, request.META["REMOTE_ADDR"])
+        response = HttpResponse(status=201)
+        response["Location"] = session.get_absolute_url()
+        response["Upload-Offset"] = session.offset
+        response["Upload-Length"] = session.length
+        return response
+
+
+class AttachmentUploadSessionView(LoginRequiredMixin, PermissionRequiredMixin, View):
+    """
+    Receives the chunks of a resumable upload.
+    
+    * HEAD returns the current offset in the Upload-Offset header.
+    * PATCH appends the request body to the upload. The Upload-Offset
+      header must match the current offset of the upload.
+    * POST finalizes a complete upload into an Attachment, and
+      redirects to the attachment.
+    * DELETE aborts the upload.
+    """
+    permission_required = "files.add_attachment"
+    raise_exception = True
+    http_method_names = View.http_method_names + ["patch"]
+    
+    def get_session(self):
+        return get_object_or_404(UploadSession, token=self.kwargs["token"], creator=self.request.user)
+    
+    def head(self, request, *args, **kwargs):
+        session = self.get_session()
+        return self._offset_response(session, status=200)
+    
+    def patch(self, request, *args, **kwargs):
+        session = self.get_session()
+        try:
+            offset = int(request.META["HTTP_UPLOAD_OFFSET"])
+            length = int(request.META.get("CONTENT_LENGTH") or 0)
+        except (KeyError, ValueError):
+            return HttpResponseBadRequest("Missing or invalid Upload-Offset or Content-Length header.")
+        try:
+            uploads.append_chunk(session, request, offset, length)
+        except uploads.UploadError, e:
+            return HttpResponse(e.args[0], status=e.status)
+        return self._offset_response(session, status=204)
+    
+    def post(self, request, *args, **kwargs):
+        session = self.get_session()
+        try:
+            attachment = uploads.finalize(session)
+        except uploads.UploadError, e:
+            return HttpResponse(e.args[0], status=e.status)
+        response = HttpResponse(status=201)
+        response["Location"] = attachment.get_absolute_url()
+        return response
+    
+    def delete(self, request, *args, **kwargs):
+        uploads.abort(self.get_session())
+        return HttpResponse(status=204)
+    
+    def _offset_response(self, session, status):
+        response = HttpResponse(status=status)
+        response["Upload-Offset"] = session.offset
+        response["Upload-Length"] = session.length
+        response["Cache-Control"] = "no-store"
+        return response
+
+
+def field_getter(name):
+    return lambda attachment: getattr(attachment, name)
+
+
+def date_getter(name):
+    return lambda attachment: getattr(attachment, name).isoformat()
+
+
+class AttachmentJSONMixin(object):
+    """
+    Serializes attachments for the JSON views. Clients select the fields
+    with the "fields" query parameter (comma separated names of json_fields),
+    by default all fields are returned. Only the columns of the selected
+    fields are loaded, see json_columns.
+    """
+    json_fields = OrderedDict([
+        ("slug", field_getter("slug")),
+        ("filename", field_getter("filename")),
+        ("description", field_getter("description")),
+        ("mimetype", field_getter("mimetype")),
+        ("size", field_getter("size")),
+        ("checksum", field_getter("checksum")),
+        ("status", field_getter("status")),
+        ("is_public", field_getter("is_public")),
+        ("object_id", field_getter("object_id")),
+        ("creator", lambda attachment: attachment.creator.username),
+        ("created", date_getter("created")),
+        ("modified", date_getter("modified")),
+        ("view_url", files.get_view_url),
+        ("download_url", files.get_download_url),
+    ])
+    # The columns each field is computed from, if not the column of the same name
+    json_columns = {
+        "filename": ("attachment", ),
+        "view_url": ("slug", ),
+        "download_url": ("slug", ),
+    }
+    
+    def get_json_fields(self):
+        """
+        Return the names of the fields selected by the client.
+        Raises ValueError for unknown fields.
+        """
+        names = [name.strip() for name in self.request.GET.get("fields", "").split(",") if name.strip()]
+        unknown = [name for name in names if name not in self.json_fields]
+        if unknown:
+            raise ValueError("Unknown fields: %s. Valid fields are %s." % (", ".join(unknown),
+                                                                           ", ".join(self.json_fields)))
+        return names or self.json_fields.keys()
+    
+    def get_json_queryset(self, qs, fields, required=()):
+        """
+        Load only the columns of the fields (and the required columns)
+        of the attachments, and the creator only if it is selected.
+        """
+        columns = set(required)
+        for name in fields:
+            columns.update(self.json_columns.get(name, (name, )))
+        qs = qs.only(*columns)
+        if "creator" in fields:
+            qs = files.select_listing_related(qs, ("creator", ))
+        return qs
+    
+    def serialize(self, attachment, fields):
+        return OrderedDict((name, self.json_fields[name](attachment)) for name in fields)
+    
+    def json_response(self, data):
+        return HttpResponse(json.dumps(data), content_type="application/json")
+
+
+class AttachmentListView(AttachmentJSONMixin, View):
+    """
+    Returns the attachments of an object, which are visible to the user,
+    as JSON. The list is paginated by cursor (see `files.pagination`):
+    
+    * cursor: the next_cursor of the previous page. Default is the first page.
+    * limit: the page size. Default is ATTACHMENT_PAGE_SIZE.
+    * fields: the fields to return. Default is all fields.
+    
+    The response has the attachments in "results", and the cursor and
+    URL of the next page in "next_cursor" and "next" (or null).
+    """
+    
+    def get(self, request, *args, **kwargs):
+        try:
+            ctype = ContentType.objects.get_for_id(kwargs["content_type"])
+        except ContentType.DoesNotExist:
+            raise Http404("No such content type.")
+        try:
+            limit = int(request.GET.get("limit") or 0)
+            fields = self.get_json_fields()
+        except ValueError, e:
+            return HttpResponseBadRequest(e.args[0])
+        qs = files.get_object_attachments(files.get_model(), ctype, kwargs["object_id"], request.user)
+        # The cursor of the next page is built from the creation time
+        qs = self.get_json_queryset(qs, fields, required=("created", ))
+        try:
+            page = pagination.paginate(qs, request.GET.get("cursor"), limit)
+        except pagination.InvalidCursor, e:
+            return HttpResponseBadRequest(e.args[0])
+        
+        next_url = None
+        if page.has_next:
+            query = request.GET.copy()
+            query["cursor"] = page.next_cursor
+            next_url = "%s?%s" % (request.path, query.urlencode())
+        return self.json_response({
+            "results": [self.serialize(attachment, fields) for attachment in page],
+            "next_cursor": page.next_cursor,
+            "next": next_url,
+        })
+
+
+class AttachmentBatchView(AttachmentJSONMixin, View):
+    """
+    Returns the attachments of many objects of one content type, which
+    are visible to the user, as JSON, in a single query:
+    
+    * content_type: the content type id.
+    * object_id: the object ids, comma separated or repeated. At most
+      ATTACHMENT_MAX_BATCH_SIZE ids.
+    * fields: the fields to return. Default is all fields.
+    
+    The response maps each object id to the list of its attachments.
+    """
+    
+    def get(self, request, *args, **kwargs):
+        try:
+            ctype = ContentType.objects.get_for_id(request.GET.get("content_type"))
+        except (ContentType.DoesNotExist, ValueError, TypeError):
+            return HttpResponseBadRequest("Missing or invalid content_type.")
+        object_ids = []
+        for value in request.GET.getlist("object_id"):
+            object_ids.extend(object_id.strip() for object_id in value.split(",") if object_id.strip())
+        if not object_ids:
+            return HttpResponseBadRequest("Missing object_id.")
+        max_size = getattr(settings, "ATTACHMENT_MAX_BATCH_SIZE", 100)
+        if len(object_ids) > max_size:
+            return HttpResponseBadRequest("At most %d object ids are allowed." % max_size)
+        try:
+            fields = self.get_json_fields()
+        except ValueError, e:
+            return HttpResponseBadRequest(e.args[0])
+        
+        qs = files.get_object_attachments(files.get_model(), ctype, object_ids, request.user)
+        # The attachments are grouped by object_id
+        qs = self.get_json_queryset(qs, fields, required=("object_id", ))
+        data = OrderedDict((object_id, []) for object_id in object_ids)
+        for attachment in qs.order_by("created", "pk"):
+            data[attachment.object_id].append(self.serialize(attachment, fields))
+        return self.json_response(data)
+
+
+class AttachmentMetricsView(View):
+    """
+    Exports the metrics collected by the files.metrics.MemoryBackend
+    in the Prometheus text format. Only available to staff users and
+    clients in INTERNAL_IPS.
+    """
+    
+    def get(self, request, *args, **kwargs):
+        if not (request.user.is_staff or request.META.get("REMOTE_ADDR") in settings.INTERNAL_IPS):
+            return HttpResponseForbidden()
+        backend = metrics.get_backend(metrics.MemoryBackend)
+        if backend is None:
+            raise Http404("The files.metrics.MemoryBackend is not enabled.")
+        return HttpResponse(backend.export(), content_type="text/plain; version=0.0.4")
@@ -27,6 +27,7 @@ setup(
             "static/css/*.css",
             "static/images/*.png",
             "static/javascripts/*.js",
+            "sql/*.sql",
             "templates/attachments/*.html",
         ]
     },